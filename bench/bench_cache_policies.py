@@ -0,0 +1,120 @@
+# The MIT License (MIT)
+# Copyright (c) 2018 by the xcube development team and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Replays a tile request trace against caches with different replacement policies and compares their hit rates.
+
+Usage::
+
+    python bench/bench_cache_policies.py [--trace TRACE_FILE] [--capacity CAPACITY] [--requests NUM_REQUESTS]
+
+A trace file contains one tile key per line, e.g. the tile paths extracted from a server access log.
+Without a trace file, a synthetic trace is generated: many users request Zipf-distributed popular tiles
+at low zoom levels, while a single user every now and then pans across a large region at a high zoom level.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xcube_server.cache import Cache, MemoryCacheStore, POLICY_NAMES
+
+__author__ = "Norman Fomferra (Brockmann Consult GmbH)"
+
+
+class UnitSizeCacheStore(MemoryCacheStore):
+    """ A memory store that counts every value with size 1, so that the cache capacity is a number of tiles. """
+
+    def store_value(self, key, value):
+        return [key, value], 1
+
+
+def new_synthetic_trace(num_requests: int,
+                        num_popular_tiles: int = 5000,
+                        zipf_exponent: float = 1.1,
+                        scan_probability: float = 0.0002,
+                        scan_length: int = 2000,
+                        seed: int = 42):
+    random = np.random.RandomState(seed)
+    trace = []
+    scan_count = 0
+    while len(trace) < num_requests:
+        if random.random_sample() < scan_probability:
+            # A user pans across a large region at high zoom, requesting tiles never seen before
+            scan_count += 1
+            trace.extend(f'scan-{scan_count}/{i}' for i in range(scan_length))
+        else:
+            rank = random.zipf(zipf_exponent)
+            while rank > num_popular_tiles:
+                rank = random.zipf(zipf_exponent)
+            trace.append(f'popular/{rank}')
+    return trace[:num_requests]
+
+
+def read_trace(trace_file: str):
+    with open(trace_file) as fp:
+        return [line.strip() for line in fp if line.strip()]
+
+
+def replay(trace, policy, capacity: int):
+    cache = Cache(store=UnitSizeCacheStore(), capacity=capacity, threshold=1.0, policy=policy)
+    num_hits = 0
+    t0 = time.perf_counter()
+    for key in trace:
+        if cache.get_value(key) is not None:
+            num_hits += 1
+        else:
+            cache.put_value(key, key)
+    return num_hits / len(trace), time.perf_counter() - t0
+
+
+def main(args=None) -> int:
+    parser = argparse.ArgumentParser(description='Compare hit rates of cache replacement policies')
+    parser.add_argument('--trace', dest='trace_file', metavar='TRACE_FILE', default=None,
+                        help='Trace file with one tile key per line. Defaults to a synthetic trace.')
+    parser.add_argument('--capacity', type=int, default=1000,
+                        help='Cache capacity in number of tiles. Defaults to 1000.')
+    parser.add_argument('--requests', dest='num_requests', type=int, default=200000,
+                        help='Number of requests of the synthetic trace. Defaults to 200000.')
+    parser.add_argument('--policies', default=','.join(POLICY_NAMES),
+                        help=f'Comma-separated policy names. Defaults to {",".join(POLICY_NAMES)!r}.')
+    args_obj = parser.parse_args(args)
+
+    if args_obj.trace_file:
+        trace = read_trace(args_obj.trace_file)
+    else:
+        trace = new_synthetic_trace(args_obj.num_requests)
+
+    print(f'{len(trace)} requests, {len(set(trace))} distinct tiles, capacity {args_obj.capacity} tiles')
+    print(f'{"policy":<10}{"hit rate":>10}{"time (s)":>12}')
+    for policy_name in args_obj.policies.split(','):
+        hit_rate, duration = replay(trace, POLICY_NAMES[policy_name], args_obj.capacity)
+        print(f'{policy_name:<10}{hit_rate:>10.2%}{duration:>12.2f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,111 @@
+# The MIT License (MIT)
+# Copyright (c) 2018 by the xcube development team and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Compares the time needed to color-map tiles using Matplotlib color maps with the time needed
+using the precomputed lookup tables of :py:func:`xcube_server.im.cmaps.get_cmap_lut`.
+Both must produce identical RGBA pixels.
+
+Usage::
+
+    python bench/bench_cmap_lut.py [--cmap CMAP_NAME] [--tile-size TILE_SIZE] [--tiles NUM_TILES]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xcube_server.im.cmaps import ensure_cmaps_loaded, get_cmap_lut, apply_cmap_lut
+
+__author__ = "Norman Fomferra (Brockmann Consult GmbH)"
+
+
+def new_tiles(num_tiles: int, tile_size: int, value_min: float, value_max: float, seed: int = 42):
+    random = np.random.RandomState(seed)
+    tiles = []
+    for _ in range(num_tiles):
+        array = random.uniform(value_min - 1, value_max + 1, (tile_size, tile_size)).astype(np.float32)
+        # Some invalid values at the coast line
+        array[:, 0:tile_size // 8] = np.nan
+        array = np.ma.masked_invalid(array)
+        tiles.append(array.clip(value_min, value_max, out=array))
+    return tiles
+
+
+def map_with_cmap(tiles, cmap, value_min: float, value_max: float):
+    results = []
+    t0 = time.perf_counter()
+    for tile in tiles:
+        array = tile.copy()
+        array -= value_min
+        array *= 1.0 / (value_max - value_min)
+        results.append(cmap(array, bytes=True))
+    return results, time.perf_counter() - t0
+
+
+def map_with_lut(tiles, lut, value_min: float, value_max: float):
+    results = []
+    t0 = time.perf_counter()
+    for tile in tiles:
+        results.append(apply_cmap_lut(np.ma.getdata(tile).copy(), value_min, value_max, lut,
+                                      mask=np.ma.getmask(tile)))
+    return results, time.perf_counter() - t0
+
+
+def main(args=None) -> int:
+    parser = argparse.ArgumentParser(description='Compare color mapping using Matplotlib and lookup tables')
+    parser.add_argument('--cmap', dest='cmap_name', default='viridis',
+                        help='Matplotlib color map name. Defaults to "viridis".')
+    parser.add_argument('--tile-size', dest='tile_size', type=int, default=512,
+                        help='Tile width and height in pixels. Defaults to 512.')
+    parser.add_argument('--tiles', dest='num_tiles', type=int, default=100,
+                        help='Number of tiles. Defaults to 100.')
+    args_obj = parser.parse_args(args)
+
+    import matplotlib.cm as cm
+    ensure_cmaps_loaded()
+    cmap = cm.get_cmap(args_obj.cmap_name, 256)
+    cmap.set_bad('k', 0)
+    lut = get_cmap_lut(args_obj.cmap_name, 256)
+
+    value_min, value_max = 0.0, 24.0
+    tiles = new_tiles(args_obj.num_tiles, args_obj.tile_size, value_min, value_max)
+
+    expected, cmap_duration = map_with_cmap(tiles, cmap, value_min, value_max)
+    actual, lut_duration = map_with_lut(tiles, lut, value_min, value_max)
+    identical = all(np.array_equal(e, a) for e, a in zip(expected, actual))
+
+    print(f'{args_obj.num_tiles} tiles of {args_obj.tile_size}x{args_obj.tile_size} pixels, '
+          f'color map {args_obj.cmap_name!r}')
+    print(f'{"method":<10}{"time (s)":>12}{"ms/tile":>12}')
+    for method, duration in (('cmap', cmap_duration), ('lut', lut_duration)):
+        print(f'{method:<10}{duration:>12.3f}{1000 * duration / args_obj.num_tiles:>12.2f}')
+    print(f'speed-up {cmap_duration / lut_duration:.1f}x, pixels identical: {identical}')
+    return 0 if identical else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
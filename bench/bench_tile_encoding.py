@@ -0,0 +1,111 @@
+# The MIT License (MIT)
+# Copyright (c) 2018 by the xcube development team and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Compares the size and encoding time of color-mapped tiles for the supported tile encodings:
+RGBA and 8-bit palette PNG images with different compression levels, lossless and lossy WebP images,
+and JPEG images.
+
+Usage::
+
+    python bench/bench_tile_encoding.py [--cmap CMAP_NAME] [--tile-size TILE_SIZE] [--tiles NUM_TILES]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xcube_server.im import TileEncoding
+from xcube_server.im.cmaps import get_cmap_lut, get_cmap_lut_indexes, get_cmap_palette, new_cmap_palette_image
+
+__author__ = "Norman Fomferra (Brockmann Consult GmbH)"
+
+ENCODINGS = (
+    ('png-rgba', TileEncoding('PNG'), False),
+    ('png', TileEncoding('PNG'), True),
+    ('png-1', TileEncoding('PNG', compress_level=1), True),
+    ('png-9', TileEncoding('PNG', compress_level=9), True),
+    ('webp-ll', TileEncoding('WEBP', lossless=True), False),
+    ('webp-ll-0', TileEncoding('WEBP', lossless=True, method=0), False),
+    ('webp-80', TileEncoding('WEBP', quality=80), False),
+    ('webp-80-0', TileEncoding('WEBP', quality=80, method=0), False),
+    ('jpeg-85', TileEncoding('JPEG', quality=85), False),
+)
+
+
+def new_tile_indexes(num_tiles: int, tile_size: int, lut: np.ndarray, seed: int = 42):
+    random = np.random.RandomState(seed)
+    y, x = np.mgrid[0:tile_size, 0:tile_size]
+    tile_indexes = []
+    for _ in range(num_tiles):
+        # Smooth fields with some noise, and invalid values at the coast line
+        fx, fy, phase = random.uniform(0.005, 0.05, 3)
+        array = np.sin(fx * x + phase) * np.cos(fy * y) + random.normal(0.0, 0.05, x.shape)
+        array = array.clip(-1.0, 1.0)
+        array[:, 0:tile_size // 8] = np.nan
+        tile_indexes.append(get_cmap_lut_indexes(array, -1.0, 1.0, lut))
+    return tile_indexes
+
+
+def encode_tiles(tile_indexes, lut: np.ndarray, palette, encoding: TileEncoding, indexed: bool):
+    num_bytes = 0
+    t0 = time.perf_counter()
+    for indexes in tile_indexes:
+        if indexed:
+            image = new_cmap_palette_image(indexes, *palette)
+        else:
+            image = Image.fromarray(lut.take(indexes, axis=0, mode='clip'), mode='RGBA')
+        num_bytes += len(encoding.encode(image))
+    return num_bytes, time.perf_counter() - t0
+
+
+def main(args=None) -> int:
+    parser = argparse.ArgumentParser(description='Compare encodings of color-mapped tiles')
+    parser.add_argument('--cmap', dest='cmap_name', default='viridis',
+                        help='Matplotlib color map name. Defaults to "viridis".')
+    parser.add_argument('--tile-size', dest='tile_size', type=int, default=256,
+                        help='Tile width and height in pixels. Defaults to 256.')
+    parser.add_argument('--tiles', dest='num_tiles', type=int, default=100,
+                        help='Number of tiles. Defaults to 100.')
+    args_obj = parser.parse_args(args)
+
+    lut = get_cmap_lut(args_obj.cmap_name)
+    palette = get_cmap_palette(args_obj.cmap_name)
+    tile_indexes = new_tile_indexes(args_obj.num_tiles, args_obj.tile_size, lut)
+
+    print(f'{args_obj.num_tiles} tiles of {args_obj.tile_size}x{args_obj.tile_size} pixels, '
+          f'color map {args_obj.cmap_name!r}')
+    print(f'{"encoding":<12}{"kB/tile":>12}{"ms/tile":>12}')
+    for name, encoding, indexed in ENCODINGS:
+        num_bytes, duration = encode_tiles(tile_indexes, lut, palette, encoding, indexed)
+        print(f'{name:<12}{num_bytes / 1024 / args_obj.num_tiles:>12.1f}'
+              f'{1000 * duration / args_obj.num_tiles:>12.2f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
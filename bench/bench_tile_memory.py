@@ -0,0 +1,109 @@
+# The MIT License (MIT)
+# Copyright (c) 2018 by the xcube development team and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Measures the memory allocated while computing the tiles of a float32 variable:
+the array tiles of a :py:class:`xcube_server.im.TransformArrayImage` that flips them and
+marks invalid values, and the RGBA tiles of a :py:class:`xcube_server.im.ColorMappedRgbaImage`.
+Reports the peak of traced allocations per tile, including the array tile computed for each RGBA tile,
+and the size of the array tiles kept in the tile cache.
+
+Usage::
+
+    python bench/bench_tile_memory.py [--tile-size TILE_SIZE] [--tiles NUM_TILES] [--no-data-value VALUE]
+"""
+
+import argparse
+import os
+import sys
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xcube_server.im import FastNdarrayDownsamplingImage, TransformArrayImage, ColorMappedRgbaImage
+from xcube_server.im.tiledimage import set_default_tile_cache
+
+__author__ = "Norman Fomferra (Brockmann Consult GmbH)"
+
+
+def new_array(num_tiles: int, tile_size: int, no_data_value: float = None, seed: int = 42) -> np.ndarray:
+    random = np.random.RandomState(seed)
+    array = random.uniform(-1.0, 25.0, (tile_size, num_tiles * tile_size)).astype(np.float32)
+    # Some invalid values at the coast line
+    array[:, 0:tile_size // 8] = np.nan if no_data_value is None else no_data_value
+    return array
+
+
+def trace_tiles(image, num_tiles: int):
+    """ Compute the tiles of the first row of *image*, return the average peak of traced bytes and the tile sizes. """
+    tile_width, tile_height = image.tile_size
+    peak_sum = 0
+    tile_size_sum = 0
+    for tile_x in range(num_tiles):
+        tracemalloc.clear_traces()
+        tracemalloc.reset_peak()
+        tile = image.compute_tile(tile_x, 0, (tile_x * tile_width, 0, tile_width, tile_height))
+        peak_sum += tracemalloc.get_traced_memory()[1]
+        if isinstance(tile, np.ndarray):
+            tile_size_sum += tile.nbytes
+            mask = np.ma.getmask(tile)
+            if mask is not np.ma.nomask:
+                tile_size_sum += mask.nbytes
+        del tile
+    return peak_sum / num_tiles, tile_size_sum / num_tiles
+
+
+def main(args=None) -> int:
+    parser = argparse.ArgumentParser(description='Measure bytes allocated per array and RGBA tile')
+    parser.add_argument('--tile-size', dest='tile_size', type=int, default=512,
+                        help='Tile width and height in pixels. Defaults to 512.')
+    parser.add_argument('--tiles', dest='num_tiles', type=int, default=20,
+                        help='Number of tiles. Defaults to 20.')
+    parser.add_argument('--no-data-value', dest='no_data_value', type=float, default=None,
+                        help='No-data value of the variable. Invalid values are NaN if not given.')
+    args_obj = parser.parse_args(args)
+
+    set_default_tile_cache(no_cache=True)
+    num_tiles, tile_size = args_obj.num_tiles, args_obj.tile_size
+    array = new_array(num_tiles, tile_size, no_data_value=args_obj.no_data_value)
+    array_image = TransformArrayImage(FastNdarrayDownsamplingImage(array, (tile_size, tile_size), 0),
+                                      flip_y=True, force_masked=True, no_data_value=args_obj.no_data_value)
+    rgba_image = ColorMappedRgbaImage(array_image, value_range=(0.0, 24.0), cmap_name='viridis')
+
+    tracemalloc.start()
+    array_peak, array_tile_size = trace_tiles(array_image, num_tiles)
+    rgba_peak, _ = trace_tiles(rgba_image, num_tiles)
+    tracemalloc.stop()
+
+    input_size = tile_size * tile_size * array.itemsize
+    print(f'{num_tiles} tiles of {tile_size}x{tile_size} {array.dtype} pixels ({input_size} bytes), '
+          f'no-data value {args_obj.no_data_value}')
+    print(f'{"tile":<10}{"peak bytes":>14}{"x input":>10}')
+    for name, peak in (('array', array_peak), ('rgba', rgba_peak)):
+        print(f'{name:<10}{peak:>14.0f}{peak / input_size:>10.2f}')
+    print(f'cached array tile: {array_tile_size:.0f} bytes')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
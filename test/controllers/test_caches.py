@@ -0,0 +1,33 @@
+import unittest
+
+from test.helpers import new_test_service_context, RequestParamsMock
+from xcube_server.controllers.caches import get_caches
+from xcube_server.controllers.tiles import get_dataset_tile
+
+
+class CachesControllerTest(unittest.TestCase):
+
+    def test_get_caches(self):
+        ctx = new_test_service_context()
+        get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock())
+        get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock())
+
+        response = get_caches(ctx)
+        self.assertIn('caches', response)
+        self.assertIn('tileComputations', response)
+        self.assertIn('uniformTiles', response)
+        self.assertEqual({'numEmpty', 'numSolid', 'numComputed'}, set(response['uniformTiles'].keys()))
+        self.assertEqual({'numPending', 'numDeferred', 'encodeLatency', 'numFast', 'numStrong', 'numReencoded',
+                          'numDropped'}, set(response['adaptiveEncoding'].keys()))
+        caches = {cache['name']: cache for cache in response['caches']}
+        self.assertIn('mem_tile_cache', caches)
+        self.assertIn('pyramid_cache', caches)
+        self.assertEqual(1, caches['pyramid_cache']['num_items'])
+
+        mem_tile_cache = caches['mem_tile_cache']
+        self.assertEqual('LRU', mem_tile_cache['policy'])
+        self.assertEqual(16, mem_tile_cache['num_shards'])
+        self.assertEqual(1, mem_tile_cache['puts'])
+        self.assertEqual(1, mem_tile_cache['num_items'])
+        self.assertEqual(mem_tile_cache['size'], mem_tile_cache['bytes_put'])
+        self.assertEqual(1, mem_tile_cache['store_latency']['count'])
@@ -1,11 +1,16 @@
+import os
+import shutil
+import time
 import unittest
 
 from test.helpers import new_test_service_context, RequestParamsMock
+from xcube_server.cache import PackCacheStore, NpyFileCacheStore, ContentAddressedCacheStore, MemoryCacheStore
 from xcube_server.context import ServiceContext
 from xcube_server.controllers.tiles import get_dataset_tile, get_ne2_tile, get_dataset_tile_grid, get_ne2_tile_grid, \
-    get_legend
-from xcube_server.defaults import API_PREFIX
+    get_legend, get_dataset_tile_etag, get_ne2_tile_etag, get_tile_coverage, get_tile_grid
+from xcube_server.defaults import API_PREFIX, FILE_TILE_CACHE_CAPACITY
 from xcube_server.errors import ServiceBadRequestError, ServiceResourceNotFoundError
+from xcube_server.im import get_uniform_tiles, TileCoverage
 
 
 class TilesControllerTest(unittest.TestCase):
@@ -18,6 +23,211 @@ class TilesControllerTest(unittest.TestCase):
         tile = get_dataset_tile(ctx, 'demo', 'conc_tsm', '-20', '0', '0', RequestParamsMock())
         self.assertIsInstance(tile, bytes)
 
+    def test_get_dataset_tile_formats(self):
+        ctx = new_test_service_context()
+        png_tile = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock(), 'png')
+        self.assertEqual(b'\x89PNG', png_tile[0:4])
+        webp_tile = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock(), 'webp')
+        self.assertEqual(b'RIFF', webp_tile[0:4])
+        jpeg_tile = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock(), 'jpg')
+        self.assertEqual(b'\xff\xd8', jpeg_tile[0:2])
+        self.assertNotEqual(get_dataset_tile_etag(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock(), 'png'),
+                            get_dataset_tile_etag(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock(), 'webp'))
+
+        # Tiles without data are encoded in the requested format too
+        webp_tile = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '2', RequestParamsMock(), 'webp')
+        self.assertEqual(b'RIFF', webp_tile[0:4])
+
+        with self.assertRaises(ServiceBadRequestError) as cm:
+            get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock(), 'gif')
+        self.assertEqual('Unsupported tile format "gif"', cm.exception.reason)
+
+    def test_get_dataset_tile_without_data(self):
+        ctx = new_test_service_context()
+        uniform_tiles = get_uniform_tiles()
+        # The tile coverage is computed in the background, meanwhile tiles are computed as usual
+        tile = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '2', RequestParamsMock())
+        self.assertIsInstance(tile, bytes)
+        self.assertEqual(1, len(ctx.pyramid_cache))
+        for _ in range(100):
+            if len(ctx.tile_coverage_cache) == 1:
+                break
+            time.sleep(0.01)
+        self.assertEqual(1, len(ctx.tile_coverage_cache))
+        ctx.pyramid_cache.clear()
+
+        num_empty = uniform_tiles.num_empty
+        tile = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '2', RequestParamsMock())
+        self.assertIsInstance(tile, bytes)
+        self.assertEqual(num_empty + 1, uniform_tiles.num_empty)
+        # The tile is known to be empty, so no pyramid has been created
+        self.assertEqual(0, len(ctx.pyramid_cache))
+        self.assertIs(tile, get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '1', '2', RequestParamsMock()))
+
+        tile = get_dataset_tile(ctx, 'demo', 'conc_tsm', '1', '0', '2', RequestParamsMock())
+        self.assertIsInstance(tile, bytes)
+        self.assertEqual(1, len(ctx.pyramid_cache))
+
+    def test_get_tile_coverage(self):
+        ctx = new_test_service_context()
+        _, var = ctx.get_dataset_and_variable('demo', 'conc_tsm')
+        array = var.isel(time=0)
+        tile_grid = get_tile_grid(ctx, 'demo', 'conc_tsm', var)
+        # Not known on first request
+        self.assertIsNone(get_tile_coverage(ctx, 'arr-1', array, tile_grid))
+        for _ in range(100):
+            if 'arr-1' in ctx.tile_coverage_cache:
+                break
+            time.sleep(0.01)
+        coverage = get_tile_coverage(ctx, 'arr-1', array, tile_grid)
+        self.assertIsInstance(coverage, TileCoverage)
+        self.assertEqual(tile_grid.num_levels, coverage.num_levels)
+        self.assertIn('tile_coverage_cache', [cache['name'] for cache in ctx.get_cache_stats()])
+
+    def test_get_dataset_tile_etag(self):
+        ctx = new_test_service_context()
+        etag = get_dataset_tile_etag(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock())
+        self.assertIsInstance(etag, str)
+        self.assertTrue(etag.startswith('"') and etag.endswith('"'))
+        self.assertEqual(etag, get_dataset_tile_etag(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock()))
+        self.assertNotEqual(etag, get_dataset_tile_etag(ctx, 'demo', 'conc_tsm', '1', '0', '0', RequestParamsMock()))
+        self.assertNotEqual(etag, get_dataset_tile_etag(ctx, 'demo', 'conc_tsm', '0', '0', '0',
+                                                        RequestParamsMock(cbar='jet')))
+        self.assertNotEqual(etag, get_dataset_tile_etag(ctx, 'demo', 'conc_chl', '0', '0', '0', RequestParamsMock()))
+
+        # Reloading the dataset changes all entity tags
+        config = ctx.config
+        ctx.config = dict(config, Datasets=[dsd for dsd in config['Datasets'] if dsd['Identifier'] != 'demo'])
+        ctx.config = config
+        self.assertNotEqual(etag, get_dataset_tile_etag(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock()))
+
+        # Changing the tile encoding changes all entity tags
+        etag = get_dataset_tile_etag(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock())
+        ctx.config = dict(config, PaletteTiles=False)
+        self.assertNotEqual(etag, get_dataset_tile_etag(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock()))
+
+        # Adaptively compressed tiles are only semantically equivalent
+        ctx.config = dict(config, TileEncodings=dict(PNG=dict(Adaptive=True)))
+        weak_etag = get_dataset_tile_etag(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock())
+        self.assertTrue(weak_etag.startswith('W/"'))
+
+        with self.assertRaises(ServiceResourceNotFoundError):
+            get_dataset_tile_etag(ctx, 'demo', 'conc_ys', '0', '0', '0', RequestParamsMock())
+
+    def test_get_ne2_tile_etag(self):
+        ctx = new_test_service_context()
+        etag = get_ne2_tile_etag(ctx, '0', '0', '0', RequestParamsMock())
+        self.assertIsInstance(etag, str)
+        self.assertNotEqual(etag, get_ne2_tile_etag(ctx, '0', '1', '0', RequestParamsMock()))
+
+    def test_get_dataset_tile_with_default_rgb_tile_cache(self):
+        ctx = new_test_service_context()
+        self.assertIsInstance(ctx.rgb_tile_cache.store, ContentAddressedCacheStore)
+        self.assertIsInstance(ctx.rgb_tile_cache.store.store, MemoryCacheStore)
+        self.assertIsNone(ctx.rgb_tile_cache.parent_cache)
+        self.assertEqual(64 * 1024 * 1024, ctx.rgb_tile_cache.capacity)
+        tile_1 = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock())
+        tile_2 = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock())
+        self.assertEqual(tile_1, tile_2)
+        rgb_tile_cache_stats = ctx.rgb_tile_cache.get_stats()
+        self.assertEqual('rgb_tile_cache', rgb_tile_cache_stats['name'])
+        self.assertEqual(1, rgb_tile_cache_stats['puts'])
+        self.assertEqual(1, rgb_tile_cache_stats['hits'])
+        # The array tile has been used for the first request only
+        self.assertEqual(0, ctx.mem_tile_cache.get_stats()['hits'])
+
+        ctx.config = dict(ctx.config, TileCaches=dict(RgbTiles=dict(Store='memory', Policy='LFU')))
+        self.assertEqual(64 * 1024 * 1024, ctx.rgb_tile_cache.capacity)
+        self.assertEqual('LFU', ctx.rgb_tile_cache.get_stats()['policy'])
+
+    def test_get_dataset_tile_with_default_file_cache_capacity(self):
+        ctx = new_test_service_context()
+        cache_dir = os.path.join(ctx.base_dir, '.tile-cache')
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        try:
+            ctx.config = dict(ctx.config, TileCaches=dict(RgbTiles=dict(Store='file', Path='.tile-cache')))
+            self.assertEqual(FILE_TILE_CACHE_CAPACITY, ctx.rgb_tile_cache.capacity)
+            tile_ids = [(str(x), str(y), str(z)) for z in range(3) for y in range(1 << z) for x in range(2 << z)]
+            for x, y, z in tile_ids:
+                get_dataset_tile(ctx, 'demo', 'conc_tsm', x, y, z, RequestParamsMock())
+            # All tiles put are kept, more than one per shard
+            rgb_tile_cache_stats = ctx.rgb_tile_cache.get_stats()
+            self.assertGreater(rgb_tile_cache_stats['puts'], rgb_tile_cache_stats['num_shards'])
+            self.assertEqual(rgb_tile_cache_stats['puts'], rgb_tile_cache_stats['num_items'])
+            self.assertEqual(0, rgb_tile_cache_stats['evictions'])
+            file_store = ctx.rgb_tile_cache.store.store
+            for _ in range(100):
+                if file_store.num_pending_writes == 0:
+                    break
+                time.sleep(0.01)
+            content_files = [file_name for _, _, file_names in os.walk(cache_dir) for file_name in file_names
+                             if file_name.startswith('%23content') and file_name.endswith('.png')]
+            self.assertEqual(ctx.rgb_tile_cache.store.num_contents, len(content_files))
+            tile = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock())
+            self.assertEqual(b'\x89PNG', tile[0:4])
+            self.assertEqual(1, ctx.rgb_tile_cache.get_stats()['hits'])
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def test_get_dataset_tile_with_pack_cache(self):
+        ctx = new_test_service_context()
+        cache_dir = os.path.join(ctx.base_dir, '.tile-cache')
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        try:
+            ctx.config = dict(ctx.config, TileCaches=dict(RgbTiles=dict(Store='pack', Path='.tile-cache',
+                                                                        Capacity=1000000)))
+            self.assertIsInstance(ctx.rgb_tile_cache.store, ContentAddressedCacheStore)
+            self.assertIsInstance(ctx.rgb_tile_cache.store.store, PackCacheStore)
+            tile_1 = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock())
+            self.assertIsInstance(tile_1, bytes)
+            tile_2 = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock())
+            self.assertIsInstance(tile_2, bytes)
+            self.assertEqual(tile_1, tile_2)
+            ctx.rgb_tile_cache.store.store.close()
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def test_get_dataset_tile_with_tiers(self):
+        ctx = new_test_service_context()
+        cache_dir = os.path.join(ctx.base_dir, '.tile-cache')
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        try:
+            ctx.config = dict(ctx.config, TileCaches=dict(ArrayTiles=dict(Capacity=1,
+                                                                          Tiers=[dict(Store='npy',
+                                                                                      Path='.tile-cache',
+                                                                                      Capacity=100000000)])))
+            self.assertIsInstance(ctx.mem_tile_cache.parent_cache.store, NpyFileCacheStore)
+            tile_1 = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock())
+            # Spill the array tile to disk and force computing the RGB tile again
+            ctx.mem_tile_cache.trim()
+            self.assertEqual(0, ctx.mem_tile_cache.get_stats()['num_items'])
+            ctx.pyramid_cache.clear(dispose=False)
+            ctx.rgb_tile_cache.clear()
+            tile_2 = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock())
+            self.assertEqual(tile_1, tile_2)
+            self.assertEqual(['mem_tile_cache', 'mem_tile_cache/tier-1'],
+                             [cache['name'] for cache in ctx.get_cache_stats()[0:2]])
+            self.assertEqual(1, ctx.mem_tile_cache.get_stats()['parent_hits'])
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def test_get_dataset_tile_with_bounded_pyramid_cache(self):
+        ctx = new_test_service_context()
+        ctx.config = dict(ctx.config, TileCaches=dict(Pyramids=dict(Capacity=2)))
+        tile_1 = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock(vmin='1', vmax='5'))
+        get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock(vmin='2', vmax='5'))
+        get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock(vmin='3', vmax='5'))
+        self.assertEqual(2, len(ctx.pyramid_cache))
+        self.assertEqual(1, ctx.pyramid_cache.get_stats()['evictions'])
+        # The evicted pyramid has been disposed and its RGB tile removed
+        self.assertEqual(1, ctx.rgb_tile_cache.get_stats()['removals'])
+        # The array tile is shared by the remaining pyramids, so it has been kept and computed once only
+        self.assertEqual(0, ctx.mem_tile_cache.get_stats()['removals'])
+        self.assertEqual(1, ctx.mem_tile_cache.get_stats()['puts'])
+        tile_2 = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock(vmin='1', vmax='5'))
+        self.assertEqual(tile_1, tile_2)
+        self.assertEqual(1, ctx.mem_tile_cache.get_stats()['puts'])
+
     def test_get_dataset_tile_with_all_params(self):
         ctx = new_test_service_context()
         tile = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock(time='current', cbar='plasma',
@@ -50,8 +260,10 @@ class TilesControllerTest(unittest.TestCase):
 
         ctx = new_test_service_context()
         tile_grid = get_dataset_tile_grid(ctx, 'demo', 'conc_chl', 'ol4', 'http://bibo')
+        ds_version = ctx.get_dataset_version('demo')
+        self.assertIsNotNone(ds_version)
         self.assertEqual({
-            'url': self.base_url + '/tile/demo/conc_chl/{z}/{x}/{y}.png',
+            'url': self.base_url + f'/tile/demo/conc_chl/{ds_version}/{{z}}/{{x}}/{{y}}.png',
             'projection': 'EPSG:4326',
             'minZoom': 0,
             'maxZoom': 2,
@@ -63,7 +275,7 @@ class TilesControllerTest(unittest.TestCase):
 
         tile_grid = get_dataset_tile_grid(ctx, 'demo', 'conc_chl', 'cesium', 'http://bibo')
         self.assertEqual({
-            'url': self.base_url + '/tile/demo/conc_chl/{z}/{x}/{y}.png',
+            'url': self.base_url + f'/tile/demo/conc_chl/{ds_version}/{{z}}/{{x}}/{{y}}.png',
             'rectangle': dict(west=2.168404344971009e-19, south=50.0, east=5.0, north=52.5),
             'minimumLevel': 0,
             'maximumLevel': 2,
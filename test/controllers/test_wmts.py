@@ -13,6 +13,8 @@ class WmtsControllerTest(unittest.TestCase):
             expected_capabilities = fp.read()
         ctx = new_test_service_context()
         capabilities = get_wmts_capabilities_xml(ctx, 'http://bibo')
+        expected_capabilities = expected_capabilities.replace('@demo_version@', ctx.get_dataset_version('demo'))
+        expected_capabilities = expected_capabilities.replace('@demo_1w_version@', ctx.get_dataset_version('demo-1w'))
         # print(80 * '=')
         # print(capabilities)
         # print(80 * '=')
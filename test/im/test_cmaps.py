@@ -1,6 +1,10 @@
 from unittest import TestCase
 
-from xcube_server.im.cmaps import get_cmaps
+import matplotlib.cm as cm
+import numpy as np
+
+from xcube_server.im.cmaps import get_cmaps, get_cmap_lut, apply_cmap_lut, ensure_cmaps_loaded, get_cmap_lut_indexes, \
+    get_cmap_lut_colors, get_cmap_palette, new_cmap_palette_image
 
 
 class CmapsTest(TestCase):
@@ -46,6 +50,108 @@ class CmapsTest(TestCase):
         self.assertEqual(category_tuple[3][0], 'magma')
 
 
+class CmapLutTest(TestCase):
+
+    @staticmethod
+    def _map_with_cmap(array, cmap_name, num_colors, value_min, value_max):
+        ensure_cmaps_loaded()
+        cmap = cm.get_cmap(cmap_name, num_colors)
+        cmap.set_bad('k', 0)
+        array = array.copy()
+        array -= value_min
+        array *= 1.0 / (value_max - value_min)
+        return cmap(array, bytes=True)
+
+    def test_get_cmap_lut(self):
+        lut = get_cmap_lut('viridis')
+        self.assertIs(lut, get_cmap_lut('viridis'))
+        self.assertEqual((258, 4), lut.shape)
+        self.assertEqual(np.uint8, lut.dtype)
+        self.assertFalse(lut.flags.writeable)
+        # Invalid values are transparent
+        np.testing.assert_equal([0, 0, 0, 0], lut[-1])
+        self.assertEqual((12, 4), get_cmap_lut('viridis', 10).shape)
+
+    def test_apply_cmap_lut_is_identical_to_cmap(self):
+        random = np.random.RandomState(0)
+        for cmap_name, num_colors in (('viridis', 256), ('jet', 256), ('PuBuGn', 10)):
+            lut = get_cmap_lut(cmap_name, num_colors)
+            for dtype in (np.float32, np.float64):
+                for value_min, value_max in ((0., 1.), (0., 24.), (-3.3, 7.1)):
+                    array = random.uniform(value_min - 1, value_max + 1, (64, 64)).astype(dtype)
+                    array[0, :] = value_min
+                    array[1, :] = value_max
+                    array[2, :] = np.nan
+                    array = array.clip(value_min, value_max)
+
+                    expected = self._map_with_cmap(array, cmap_name, num_colors, value_min, value_max)
+                    actual = apply_cmap_lut(array.copy(), value_min, value_max, lut)
+                    np.testing.assert_equal(expected, actual)
+
+                    masked_array = np.ma.masked_invalid(array)
+                    masked_array[3, 0:10] = np.ma.masked
+                    expected = self._map_with_cmap(masked_array, cmap_name, num_colors, value_min, value_max)
+                    actual = apply_cmap_lut(masked_array.data.copy(), value_min, value_max, lut,
+                                            mask=masked_array.mask)
+                    np.testing.assert_equal(expected, actual)
+
+    def test_apply_cmap_lut_with_int_array(self):
+        lut = get_cmap_lut('jet')
+        array = np.array([[0, 5], [10, 2]], dtype=np.int16)
+        np.testing.assert_equal(self._map_with_cmap(array.astype(np.float64), 'jet', 256, 0, 10),
+                                apply_cmap_lut(array, 0, 10, lut))
+
+    def test_get_cmap_lut_indexes(self):
+        lut = get_cmap_lut('viridis')
+        array = np.array([[-0.5, 0.0, 0.5], [1.0, 1.5, np.nan]], dtype=np.float32)
+        indexes = get_cmap_lut_indexes(array.copy(), 0., 1., lut, mask=np.array([[0, 0, 1], [0, 0, 0]], dtype=bool))
+        self.assertEqual(np.uint16, indexes.dtype)
+        # 256 colors, "over" color equals the last color, the last entry is the "bad" color
+        np.testing.assert_equal([[0, 0, 257], [256, 256, 257]], indexes)
+        self.assertEqual(np.uint8, get_cmap_lut_indexes(array.copy(), 0., 1., get_cmap_lut('viridis', 16)).dtype)
+
+    def test_get_cmap_lut_colors(self):
+        lut = get_cmap_lut('jet')
+        indexes = np.array([[0, 7], [257, 255]], dtype=np.uint16)
+        colors = get_cmap_lut_colors(indexes, lut)
+        self.assertEqual((2, 2, 4), colors.shape)
+        self.assertEqual(np.uint8, colors.dtype)
+        np.testing.assert_equal(lut.take(indexes, axis=0), colors)
+
+    def test_get_cmap_palette(self):
+        lut = get_cmap_lut('PuBuGn', 10)
+        palette, palette_indexes = get_cmap_palette('PuBuGn', 10)
+        self.assertIs(palette, get_cmap_palette('PuBuGn', 10)[0])
+        # 10 colors, the "over" color equals the last color, and the transparent color comes first
+        self.assertEqual((11, 4), palette.shape)
+        self.assertEqual((12,), palette_indexes.shape)
+        np.testing.assert_equal([0, 0, 0, 0], palette[0])
+        np.testing.assert_equal(lut, palette[palette_indexes])
+
+    def test_new_cmap_palette_image(self):
+        lut = get_cmap_lut('viridis')
+        array = np.linspace(0., 1., 64 * 64).reshape((64, 64))
+        array[0:8, 0:8] = np.nan
+        indexes = get_cmap_lut_indexes(array, 0., 1., lut)
+        image = new_cmap_palette_image(indexes, *get_cmap_palette('viridis'))
+        self.assertEqual('P', image.mode)
+        self.assertEqual(b'\x00', image.info['transparency'])
+        np.testing.assert_equal(lut.take(indexes, axis=0), np.asarray(image.convert('RGBA')))
+
+    def test_new_cmap_palette_image_with_too_many_colors(self):
+        palette = np.zeros((300, 4), dtype=np.uint8)
+        palette[:, 0] = np.arange(300) % 256
+        palette[:, 1] = np.arange(300) // 256
+        palette[:, 3] = 255
+        palette_indexes = np.arange(300, dtype=np.uint16)
+        image = new_cmap_palette_image(np.array([[0, 299], [299, 7]]), palette, palette_indexes)
+        self.assertEqual('P', image.mode)
+        np.testing.assert_equal([[[0, 0, 0, 255], [43, 1, 0, 255]], [[43, 1, 0, 255], [7, 0, 0, 255]]],
+                                np.asarray(image.convert('RGBA')))
+        self.assertNotIn('transparency', image.info)
+        self.assertIsNone(new_cmap_palette_image(np.arange(300).reshape((10, 30)), palette, palette_indexes))
+
+
 def main():
 
     cmaps = get_cmaps()
@@ -0,0 +1,43 @@
+from unittest import TestCase
+
+import numpy as np
+
+from xcube_server.im import TileGrid, GeoExtent, TileCoverage
+
+
+class TileCoverageTest(TestCase):
+    def test_create_from_mask(self):
+        tile_grid = TileGrid(2, 2, 1, 2, 2, GeoExtent())
+        mask = np.zeros((4, 8), dtype=np.bool_)
+        mask[0, 7] = True
+        mask[3, 2] = True
+        coverage = TileCoverage.create_from_mask(mask, tile_grid)
+        self.assertEqual(2, coverage.num_levels)
+        self.assertEqual([[False, False, False, True],
+                          [False, True, False, False]], coverage.get_level_bitmap(1).tolist())
+        self.assertEqual([[True, True]], coverage.get_level_bitmap(0).tolist())
+        self.assertEqual(0.25, coverage.coverage)
+
+        self.assertTrue(coverage.has_data(3, 0, 1))
+        self.assertFalse(coverage.has_data(0, 0, 1))
+        self.assertFalse(coverage.has_data(2, 1, 1))
+        # Tiles outside the pyramid are unknown
+        self.assertTrue(coverage.has_data(-1, 0, 1))
+        self.assertTrue(coverage.has_data(4, 0, 1))
+        self.assertTrue(coverage.has_data(0, 0, 2))
+
+    def test_create_from_mask_flip_y(self):
+        tile_grid = TileGrid(1, 2, 2, 2, 2, GeoExtent())
+        mask = np.zeros((4, 4), dtype=np.bool_)
+        mask[0, 0] = True
+        coverage = TileCoverage.create_from_mask(mask, tile_grid, flip_y=True)
+        self.assertEqual([[False, False],
+                          [True, False]], coverage.get_level_bitmap(0).tolist())
+
+    def test_create_from_mask_with_partial_tiles(self):
+        tile_grid = TileGrid(1, 2, 2, 3, 3, GeoExtent())
+        mask = np.zeros((5, 5), dtype=np.bool_)
+        mask[4, 4] = True
+        coverage = TileCoverage.create_from_mask(mask, tile_grid)
+        self.assertEqual([[False, False],
+                          [False, True]], coverage.get_level_bitmap(0).tolist())
@@ -1,10 +1,16 @@
+import io
+import threading
+import time
 from unittest import TestCase
 
 import numpy as np
+from PIL import Image
 
+from xcube_server.cache import Cache, MemoryCacheStore, POLICY_GDS
 from xcube_server.im import TileGrid, GeoExtent
 from xcube_server.im.tiledimage import ImagePyramid, OpImage, create_ndarray_downsampling_image, \
-    TransformArrayImage, FastNdarrayDownsamplingImage
+    TransformArrayImage, FastNdarrayDownsamplingImage, get_tile_flight, get_tile_image_id, ColorMappedRgbaImage, \
+    UniformTiles, get_uniform_tiles
 from xcube_server.im.utils import aggregate_ndarray_mean
 
 
@@ -127,19 +133,44 @@ class NdarrayImageTest(TestCase):
         self.assertEqual(target_image.size, (6, 4))
         self.assertEqual(target_image.num_tiles, (3, 2))
 
-        self.assertEqual(target_image.get_tile(0, 0).tolist(), [[0, 1],
-                                                                [6, 7]])
-        self.assertEqual(target_image.get_tile(1, 0).tolist(), [[2, 3],
-                                                                [None, 9]])
-        self.assertEqual(target_image.get_tile(2, 0).tolist(), [[4, 5],
-                                                                [10, 11]])
-
-        self.assertEqual(target_image.get_tile(0, 1).tolist(), [[12, 13],
-                                                                [18, 19]])
-        self.assertEqual(target_image.get_tile(1, 1).tolist(), [[14, 15],
-                                                                [20, 21]])
-        self.assertEqual(target_image.get_tile(2, 1).tolist(), [[16, None],
-                                                                [22, 23]])
+        # Floating point tiles are not masked, invalid values are NaN
+        self.assertNotIsInstance(target_image.get_tile(1, 0), np.ma.MaskedArray)
+        np.testing.assert_equal(target_image.get_tile(0, 0), [[0, 1],
+                                                              [6, 7]])
+        np.testing.assert_equal(target_image.get_tile(1, 0), [[2, 3],
+                                                              [np.nan, 9]])
+        np.testing.assert_equal(target_image.get_tile(2, 0), [[4, 5],
+                                                              [10, 11]])
+
+        np.testing.assert_equal(target_image.get_tile(0, 1), [[12, 13],
+                                                              [18, 19]])
+        np.testing.assert_equal(target_image.get_tile(1, 1), [[14, 15],
+                                                              [20, 21]])
+        np.testing.assert_equal(target_image.get_tile(2, 1), [[16, np.nan],
+                                                              [22, 23]])
+
+    def test_force_masked_float32(self):
+        a = np.arange(0, 24, dtype=np.float32)
+        a.shape = 4, 6
+        a[0, 0] = np.nan
+        a[3, 1] = -999.
+        source_image = FastNdarrayDownsamplingImage(a, (2, 2), 0)
+        target_image = TransformArrayImage(source_image, flip_y=True, force_masked=True, no_data_value=-999.)
+        tile = target_image.get_tile(0, 0)
+        self.assertEqual(np.float32, tile.dtype)
+        self.assertTrue(tile.flags.c_contiguous)
+        np.testing.assert_equal(tile, [[18, np.nan],
+                                       [12, 13]])
+        np.testing.assert_equal(target_image.get_tile(0, 1), [[6, 7],
+                                                              [np.nan, 1]])
+        # The source array is never modified
+        self.assertEqual(-999., a[3, 1])
+
+        target_image = TransformArrayImage(source_image, force_masked=True, valid_range=(2, 20))
+        np.testing.assert_equal(target_image.get_tile(0, 0), [[np.nan, np.nan],
+                                                              [6, 7]])
+        np.testing.assert_equal(target_image.get_tile(2, 1), [[16, 17],
+                                                              [np.nan, np.nan]])
 
     def test_force_2d(self):
         a = np.arange(0, 48, dtype=np.int32)
@@ -150,6 +181,8 @@ class NdarrayImageTest(TestCase):
         self.assertEqual(target_image.size, (6, 4))
         self.assertEqual(target_image.tile_size, (2, 2))
         self.assertEqual(target_image.num_tiles, (3, 2))
+        self.assertEqual(target_image.get_tile(1, 1).tolist(), [[14, 15],
+                                                                [20, 21]])
 
     def test_pad_tile(self):
         a = np.arange(0, 6, dtype=np.float32)
@@ -168,6 +201,153 @@ class NdarrayImageTest(TestCase):
         np.testing.assert_equal(b, np.array([[0., 1., 2., np.nan],
                                              [3., 4., 5., np.nan],
                                              [np.nan, np.nan, np.nan, np.nan]]))
+        self.assertEqual(np.float32, b.dtype)
+        b = FastNdarrayDownsamplingImage.pad_tile(a.astype(np.int16), (4, 2))
+        self.assertEqual(np.float64, b.dtype)
+        np.testing.assert_equal(b, np.array([[0., 1., 2., np.nan],
+                                             [3., 4., 5., np.nan]]))
+
+
+class CountingTiledImage(OpImage):
+    def __init__(self, tile_cache=None):
+        super().__init__((4, 4), (2, 2), (2, 2), mode='float32', format='ndarray', tile_cache=tile_cache)
+        self.num_computed = 0
+        self.started = threading.Event()
+        self.proceed = threading.Event()
+
+    def compute_tile(self, tile_x, tile_y, rectangle):
+        self.num_computed += 1
+        self.started.set()
+        self.proceed.wait(5)
+        return np.full((2, 2), tile_x + 10 * tile_y, np.float32)
+
+
+class OpImageTest(TestCase):
+    def test_concurrent_tile_computations_are_shared(self):
+        image = CountingTiledImage(tile_cache=Cache(MemoryCacheStore(), capacity=1024 * 1024))
+        flight = get_tile_flight()
+        num_shared = flight.num_shared
+
+        tiles = []
+        threads = [threading.Thread(target=lambda: tiles.append(image.get_tile(1, 1))) for _ in range(4)]
+        threads[0].start()
+        self.assertTrue(image.started.wait(5))
+        for thread in threads[1:]:
+            thread.start()
+        while flight.num_shared < num_shared + 3:
+            time.sleep(0.001)
+        image.proceed.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, image.num_computed)
+        self.assertEqual(4, len(tiles))
+        for tile in tiles:
+            self.assertEqual([[11, 11], [11, 11]], tile.tolist())
+
+        # now served from cache
+        image.get_tile(1, 1)
+        self.assertEqual(1, image.num_computed)
+
+    def test_compute_time_is_cost(self):
+        cache = Cache(MemoryCacheStore(), capacity=1024 * 1024, policy=POLICY_GDS)
+        image = CountingTiledImage(tile_cache=cache)
+        image.proceed.set()
+        image.get_tile(0, 1)
+        self.assertEqual(1, len(cache._item_dict))
+        item = next(iter(cache._item_dict.values()))
+        self.assertGreater(item.cost, 0.)
+        self.assertLess(item.cost, 5.)
+
+        # Tiles computed faster than min_cost are not cached
+        image = CountingTiledImage(tile_cache=Cache(MemoryCacheStore(), capacity=1024 * 1024, min_cost=60.))
+        image.proceed.set()
+        image.get_tile(0, 1)
+        image.get_tile(0, 1)
+        self.assertEqual(2, image.num_computed)
+
+    def test_dispose_removes_namespace(self):
+        cache = Cache(MemoryCacheStore(), capacity=1024 * 1024, namespace_function=get_tile_image_id)
+        image_1 = CountingTiledImage(tile_cache=cache)
+        image_2 = CountingTiledImage(tile_cache=cache)
+        for image in (image_1, image_2):
+            image.proceed.set()
+            image.get_tile(0, 0)
+            image.get_tile(1, 1)
+        self.assertEqual(4, cache.num_items)
+        image_1.dispose()
+        self.assertEqual(2, cache.num_items)
+        self.assertTrue(cache.has_value(image_2.get_tile_id(0, 0)))
+        self.assertFalse(cache.has_value(image_1.get_tile_id(0, 0)))
+
+    def test_get_tile_image_id(self):
+        image = CountingTiledImage()
+        self.assertEqual(image.id, get_tile_image_id(image.get_tile_id(1, 0)))
+        self.assertEqual('rgb-a/b/3', get_tile_image_id('rgb-a/b/3/12/7'))
+
+
+class ColorMappedRgbaImageTest(TestCase):
+    def _new_image(self, array, encode=True):
+        source_image = TransformArrayImage(FastNdarrayDownsamplingImage(array, (2, 2), 0), force_masked=True)
+        return ColorMappedRgbaImage(source_image, value_range=(0., 10.), cmap_name='jet',
+                                    encode=encode, format='PNG')
+
+    def test_uniform_tiles_are_shared(self):
+        a = np.array([[np.nan, np.nan, 2., 2.],
+                      [np.nan, np.nan, 2., 2.],
+                      [1., 2., np.nan, np.nan],
+                      [3., 4., np.nan, np.nan]], dtype=np.float32)
+        image = self._new_image(a)
+        uniform_tiles = get_uniform_tiles()
+        num_empty, num_solid, num_computed = (uniform_tiles.num_empty, uniform_tiles.num_solid,
+                                              uniform_tiles.num_computed)
+
+        empty_tile = image.get_tile(0, 0)
+        self.assertIsInstance(empty_tile, bytes)
+        self.assertIs(empty_tile, image.get_tile(1, 1))
+        solid_tile = image.get_tile(1, 0)
+        self.assertIsNot(empty_tile, solid_tile)
+        image.get_tile(0, 1)
+
+        self.assertEqual(num_empty + 2, uniform_tiles.num_empty)
+        self.assertEqual(num_solid + 1, uniform_tiles.num_solid)
+        self.assertEqual(num_computed + 1, uniform_tiles.num_computed)
+
+    def test_uniform_tiles_equal_computed_tiles(self):
+        a = np.array([[2., 2., 2., 2.],
+                      [2., 2., 2., np.nan]], dtype=np.float32)
+        image = self._new_image(a, encode=False)
+        solid_tile = image.get_tile(0, 0)
+        computed_tile = image.get_tile(1, 0)
+        self.assertEqual(solid_tile.getpixel((0, 0)), computed_tile.getpixel((0, 0)))
+        self.assertEqual((0, 0, 0, 0), computed_tile.getpixel((1, 1)))
+
+    def test_indexed_tiles(self):
+        a = np.array([[1., 2., 3., 4.],
+                      [5., 6., np.nan, 8.]], dtype=np.float32)
+        source_image = TransformArrayImage(FastNdarrayDownsamplingImage(a, (4, 2), 0), force_masked=True)
+        rgba_tile = ColorMappedRgbaImage(source_image, value_range=(0., 10.), cmap_name='jet',
+                                         encode=True, format='PNG').get_tile(0, 0)
+        indexed_tile = ColorMappedRgbaImage(source_image, value_range=(0., 10.), cmap_name='jet',
+                                            encode=True, format='PNG', indexed=True).get_tile(0, 0)
+        rgba_image = Image.open(io.BytesIO(rgba_tile))
+        indexed_image = Image.open(io.BytesIO(indexed_tile))
+        self.assertEqual('RGBA', rgba_image.mode)
+        self.assertEqual('P', indexed_image.mode)
+        np.testing.assert_equal(np.asarray(rgba_image), np.asarray(indexed_image.convert('RGBA')))
+
+    def test_get_tile(self):
+        uniform_tiles = UniformTiles(capacity=2)
+        tile = uniform_tiles.get_tile((4, 4), 'RGBA', (0, 0, 0, 0), 'PNG', is_empty=True)
+        self.assertIsInstance(tile, bytes)
+        self.assertIs(tile, uniform_tiles.get_tile((4, 4), 'RGBA', (0, 0, 0, 0), 'PNG', is_empty=True))
+        image = uniform_tiles.get_tile((4, 2), 'RGBA', (255, 0, 0, 255))
+        self.assertEqual((4, 2), image.size)
+        self.assertEqual((255, 0, 0, 255), image.getpixel((3, 1)))
+        self.assertEqual(2, uniform_tiles.num_empty)
+        self.assertEqual(1, uniform_tiles.num_solid)
+        uniform_tiles.clear()
+        self.assertEqual(0, uniform_tiles.num_empty)
 
 
 class ImagePyramidTest(TestCase):
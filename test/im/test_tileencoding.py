@@ -0,0 +1,164 @@
+import io
+import time
+from unittest import TestCase
+
+import numpy as np
+from PIL import Image
+
+from xcube_server.cache import Cache, MemoryCacheStore
+from xcube_server.im import TileEncoding, AdaptiveTileEncoding, AdaptiveEncoder, get_adaptive_encoder
+from xcube_server.im import tileencoding
+
+
+class TileEncodingTest(TestCase):
+    def test_from_extension(self):
+        encoding = TileEncoding.from_extension('webp', quality=50)
+        self.assertEqual('WEBP', encoding.format)
+        self.assertEqual('image/webp', encoding.mime_type)
+        self.assertEqual(dict(quality=50), encoding.options)
+        self.assertEqual('JPEG', TileEncoding.from_extension('JPG').format)
+        self.assertEqual('image/png', TileEncoding.from_extension('png').mime_type)
+        self.assertIsNone(TileEncoding.from_extension('gif'))
+
+    def test_id(self):
+        encoding = TileEncoding('WEBP', quality=50, lossless=False)
+        self.assertEqual('webp-lossless=False-quality=50', encoding.id)
+        self.assertEqual(TileEncoding('WEBP', lossless=False, quality=50), encoding)
+        self.assertEqual(hash(TileEncoding('WEBP', lossless=False, quality=50)), hash(encoding))
+        self.assertNotEqual(TileEncoding('WEBP'), encoding)
+        self.assertEqual('png', TileEncoding().id)
+
+    def test_encode(self):
+        array = np.zeros((4, 4, 4), dtype=np.uint8)
+        array[:, :, 0] = 255
+        array[:, 2:, 3] = 255
+        image = Image.fromarray(array, mode='RGBA')
+        for encoding, expected_mode in ((TileEncoding('PNG', compress_level=1), 'RGBA'),
+                                        (TileEncoding('WEBP', lossless=True), 'RGBA'),
+                                        (TileEncoding('JPEG', quality=90), 'RGB')):
+            decoded_image = Image.open(io.BytesIO(encoding.encode(image)))
+            self.assertEqual(encoding.format, decoded_image.format)
+            self.assertEqual(expected_mode, decoded_image.mode)
+            if expected_mode == 'RGBA':
+                # Colors of transparent pixels may be dropped
+                decoded_array = np.asarray(decoded_image)
+                np.testing.assert_equal(array[:, :, 3], decoded_array[:, :, 3])
+                np.testing.assert_equal(array[:, 2:], decoded_array[:, 2:])
+
+
+def _new_image(size=64):
+    y, x = np.mgrid[0:size, 0:size]
+    array = np.zeros((size, size, 4), dtype=np.uint8)
+    array[:, :, 0] = x * 255 // size
+    array[:, :, 1] = (x * y) % 256
+    array[:, :, 3] = 255
+    return Image.fromarray(array, mode='RGBA')
+
+
+class AdaptiveEncoderTest(TestCase):
+    def test_is_busy(self):
+        encoder = AdaptiveEncoder(max_backlog=0.15)
+        self.assertTrue(encoder.is_idle)
+        self.assertFalse(encoder.is_busy)
+        encoder.notify_encoded(0.1, False)
+        self.assertAlmostEqual(0.1, encoder.encode_latency)
+        encoder.begin_request()
+        self.assertFalse(encoder.is_idle)
+        self.assertFalse(encoder.is_busy)
+        encoder.begin_request()
+        self.assertEqual(2, encoder.num_pending)
+        self.assertTrue(encoder.is_busy)
+        encoder.end_request()
+        encoder.end_request()
+        self.assertTrue(encoder.is_idle)
+        self.assertFalse(encoder.is_busy)
+
+    def test_reencode_deferred(self):
+        encoder = AdaptiveEncoder(max_backlog=0.0)
+        encoding = AdaptiveTileEncoding('PNG', fast_options=dict(compress_level=0), encoder=encoder,
+                                        compress_level=9)
+        self.assertFalse(encoding.deterministic)
+        self.assertEqual('png-compress_level=9-adaptive-compress_level=0', encoding.id)
+        cache = Cache(MemoryCacheStore(), capacity=1024 * 1024)
+        image = _new_image()
+        strong_tile = TileEncoding('PNG', compress_level=9).encode(image)
+
+        # Not busy
+        self.assertEqual(strong_tile, encoding.encode(image, tile_id='a/0/0', tile_cache=cache))
+        self.assertEqual(0, encoder.num_deferred)
+
+        encoder.notify_encoded(0.1, False)
+        encoder.begin_request()
+        # Tiles that cannot be replaced are never encoded cheaply
+        self.assertEqual(strong_tile, encoding.encode(image))
+        fast_tile = encoding.encode(image, tile_id='a/0/1', tile_cache=cache)
+        self.assertNotEqual(strong_tile, fast_tile)
+        cache.put_value('a/0/1', fast_tile)
+        encoding.encode(image, tile_id='a/1/1', tile_cache=cache)
+        self.assertEqual(2, encoder.num_deferred)
+        self.assertEqual(2, encoder.num_fast)
+        self.assertEqual(3, encoder.num_strong)
+
+        # Tiles are not re-encoded while the server is busy
+        self.assertEqual(0, encoder.reencode_deferred())
+        encoder.end_request()
+        # Tile "a/1/1" has not been cached, so it is skipped
+        self.assertEqual(1, encoder.reencode_deferred())
+        self.assertEqual(0, encoder.num_deferred)
+        self.assertEqual(1, encoder.num_reencoded)
+        self.assertEqual(strong_tile, cache.get_value('a/0/1'))
+        np.testing.assert_equal(np.asarray(Image.open(io.BytesIO(fast_tile))),
+                                np.asarray(Image.open(io.BytesIO(strong_tile))))
+
+    def test_reencode_deferred_keeps_cost(self):
+        encoder = AdaptiveEncoder()
+        encoding = AdaptiveTileEncoding('PNG', encoder=encoder)
+        parent_cache = Cache(MemoryCacheStore(), capacity=1024 * 1024)
+        cache = Cache(MemoryCacheStore(), capacity=1024 * 1024, parent_cache=parent_cache)
+        cache.put_value('a/0/0', b'fast', cost=0.5)
+        parent_cache.put_value('a/0/0', b'fast')
+        encoder.defer(encoding, _new_image(), 'a/0/0', cache)
+        self.assertEqual(1, encoder.reencode_deferred())
+        self.assertEqual(encoding.encode_strong(_new_image()), cache.get_value('a/0/0'))
+        self.assertEqual(0.5, cache.get_cost('a/0/0'))
+        self.assertTrue(parent_cache.has_value('a/0/0'))
+
+    def test_shared_encoder_is_started_on_first_use(self):
+        shared_encoder = tileencoding._ADAPTIVE_ENCODER
+        tileencoding._ADAPTIVE_ENCODER = None
+        try:
+            encoder = get_adaptive_encoder()
+            self.assertIs(encoder, get_adaptive_encoder())
+            self.assertIsNone(encoder._thread)
+            encoding = AdaptiveTileEncoding('PNG')
+            self.assertIs(encoder, encoding.encoder)
+            self.assertIsNotNone(encoder._thread)
+        finally:
+            tileencoding._ADAPTIVE_ENCODER = shared_encoder
+
+    def test_defer_drops_oldest_tiles(self):
+        image = _new_image(16)
+        encoder = AdaptiveEncoder(capacity=2 * 16 * 16 * 4)
+        encoding = AdaptiveTileEncoding('PNG', encoder=encoder)
+        cache = Cache(MemoryCacheStore(), capacity=1024 * 1024)
+        for tile_id in ('a/0/0', 'a/0/1', 'a/0/0', 'a/1/0'):
+            encoder.defer(encoding, image, tile_id, cache)
+        self.assertEqual(2, encoder.num_deferred)
+        self.assertEqual(1, encoder.num_dropped)
+        encoder.clear()
+        self.assertEqual(0, encoder.num_deferred)
+        self.assertEqual(0, encoder.num_dropped)
+
+    def test_start(self):
+        encoder = AdaptiveEncoder()
+        encoding = AdaptiveTileEncoding('PNG', encoder=encoder)
+        cache = Cache(MemoryCacheStore(), capacity=1024 * 1024)
+        cache.put_value('a/0/0', b'fast')
+        encoder.start()
+        encoder.defer(encoding, _new_image(), 'a/0/0', cache)
+        for _ in range(100):
+            if encoder.num_reencoded:
+                break
+            time.sleep(0.01)
+        self.assertEqual(1, encoder.num_reencoded)
+        self.assertEqual(encoding.encode_strong(_new_image()), cache.get_value('a/0/0'))
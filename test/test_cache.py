@@ -1,8 +1,16 @@
 import os
 import shutil
+import threading
+import time
 from unittest import TestCase
 
-from xcube_server.cache import CacheStore, Cache, MemoryCacheStore, FileCacheStore
+import numpy as np
+
+from xcube_server.cache import CacheStore, Cache, MemoryCacheStore, FileCacheStore, POLICY_LRU, POLICY_MRU, \
+    POLICY_LFU, POLICY_RR, POLICY_ARC, POLICY_TINYLFU, POLICY_GDS, new_evictor, get_policy, LruEvictor, MruEvictor, \
+    LfuEvictor, RandomEvictor, SortingEvictor, ArcEvictor, TinyLfuEvictor, GreedyDualSizeEvictor, FrequencySketch, \
+    ShardedCache, SingleFlight, PackCacheStore, CompressedMemoryCacheStore, NpyFileCacheStore, LruObjectCache, \
+    ContentAddressedCacheStore
 
 
 class MemoryCacheStoreTest(TestCase):
@@ -42,6 +50,49 @@ class MemoryCacheStoreTest(TestCase):
             self.cache_store.discard_value('e', self.stored_value_b)
 
 
+class CompressedMemoryCacheStoreTest(TestCase):
+    def setUp(self):
+        self.cache_store = CompressedMemoryCacheStore()
+
+    def test_array(self):
+        value = np.linspace(0., 1., 256 * 256).reshape((256, 256))
+        stored_value, size = self.cache_store.store_value('a', value)
+        self.assertLess(size, value.nbytes)
+        restored_value = self.cache_store.restore_value('a', stored_value)
+        self.assertNotIsInstance(restored_value, np.ma.MaskedArray)
+        self.assertEqual(value.dtype, restored_value.dtype)
+        np.testing.assert_equal(restored_value, value)
+        restored_value[0, 0] = 1.
+
+    def test_masked_array(self):
+        value = np.ma.masked_invalid(np.array([[1., np.nan, 3.], [np.nan, 5., 6.], [7., 8., np.nan]],
+                                              dtype=np.float32))
+        stored_value, size = self.cache_store.store_value('a', value)
+        restored_value = self.cache_store.restore_value('a', stored_value)
+        self.assertIsInstance(restored_value, np.ma.MaskedArray)
+        self.assertEqual(np.float32, restored_value.dtype)
+        np.testing.assert_equal(restored_value.mask, value.mask)
+        np.testing.assert_equal(restored_value.filled(0.), value.filled(0.))
+
+        value = np.ma.array([1, 2, 3])
+        stored_value, size = self.cache_store.store_value('b', value)
+        restored_value = self.cache_store.restore_value('b', stored_value)
+        self.assertIsInstance(restored_value, np.ma.MaskedArray)
+        self.assertIs(np.ma.nomask, restored_value.mask)
+
+    def test_other_values(self):
+        stored_value, size = self.cache_store.store_value('a', 'S' * 256)
+        self.assertEqual(305, size)
+        self.assertEqual('S' * 256, self.cache_store.restore_value('a', stored_value))
+
+    def test_discard_value(self):
+        stored_value, size = self.cache_store.store_value('a', np.zeros((8, 8)))
+        self.cache_store.discard_value('a', stored_value)
+        self.assertIsNone(self.cache_store.restore_value('a', stored_value))
+        with self.assertRaises(ValueError):
+            self.cache_store.restore_value('b', stored_value)
+
+
 class FileCacheStoreTest(TestCase):
     DIR = '__test_file_cache__'
 
@@ -123,6 +174,84 @@ class CacheTest(TestCase):
     def setUp(self):
         pass
 
+    def test_stats(self):
+        parent_cache = Cache(store=TracingCacheStore(), capacity=1000, threshold=1.0, name='parent')
+        cache = Cache(store=TracingCacheStore(), capacity=200, threshold=1.0, parent_cache=parent_cache,
+                      name='child')
+        cache.put_value('k1', 'x')
+        cache.put_value('k2', 'x')
+        cache.put_value('k3', 'x')
+        self.assertEqual('x', cache.get_value('k3'))
+        self.assertEqual('x', cache.get_value('k1'))
+        self.assertIsNone(cache.get_value('k4'))
+        cache.remove_value('k3')
+
+        stats = cache.get_stats()
+        self.assertEqual('child', stats['name'])
+        self.assertEqual('LRU', stats['policy'])
+        self.assertEqual(1, stats['num_items'])
+        self.assertEqual(100, stats['size'])
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['parent_hits'])
+        self.assertEqual(1, stats['misses'])
+        # k1 has been promoted from the parent cache, evicting k2
+        self.assertEqual(4, stats['puts'])
+        self.assertEqual(400, stats['bytes_put'])
+        self.assertEqual(2, stats['evictions'])
+        self.assertEqual(200, stats['bytes_evicted'])
+        self.assertEqual(1, stats['removals'])
+        self.assertAlmostEqual(1 / 3, stats['hit_ratio'])
+        self.assertEqual(4, stats['store_latency']['count'])
+        self.assertEqual(4, sum(bucket['count'] for bucket in stats['store_latency']['buckets']))
+        self.assertTrue(parent_cache.has_value('k1'))
+        self.assertTrue(parent_cache.has_value('k2'))
+        self.assertEqual('parent', parent_cache.get_stats()['name'])
+        self.assertEqual(1, parent_cache.get_stats()['hits'])
+
+    def test_promotion_keeps_cost(self):
+        parent_cache = Cache(store=MemoryCacheStore(), capacity=1000, policy=POLICY_GDS)
+        cache = Cache(store=MemoryCacheStore(), capacity=1000, policy=POLICY_GDS, parent_cache=parent_cache)
+        parent_cache.put_value('k1', 'x', cost=2.5)
+        self.assertIsNone(cache.get_cost('k1'))
+        self.assertEqual('x', cache.get_value('k1'))
+        self.assertTrue(cache.has_value('k1'))
+        self.assertEqual(2.5, cache.get_cost('k1'))
+        self.assertIsNone(cache.get_cost('k2'))
+
+    def test_replace_value(self):
+        parent_cache = Cache(store=MemoryCacheStore(), capacity=1000)
+        cache = Cache(store=MemoryCacheStore(), capacity=1000, policy=POLICY_GDS, parent_cache=parent_cache)
+        parent_cache.put_value('k1', 'x')
+        cache.put_value('k2', 'y', cost=2.5)
+        self.assertFalse(cache.replace_value('k1', 'z'))
+        self.assertFalse(cache.has_value('k1'))
+        self.assertEqual('x', parent_cache.get_value('k1'))
+        self.assertTrue(cache.replace_value('k2', 'z'))
+        self.assertEqual('z', cache.get_value('k2'))
+        self.assertEqual(2.5, cache.get_cost('k2'))
+        # Unlike put_value(), replace_value() does not touch the parent cache
+        parent_cache.put_value('k2', 'y')
+        self.assertTrue(cache.replace_value('k2', 'w'))
+        self.assertEqual('y', parent_cache.get_value('k2'))
+
+        sharded_cache = ShardedCache(store=MemoryCacheStore(), capacity=1600, num_shards=4)
+        sharded_cache.put_value('k1', 'x', cost=1.5)
+        self.assertTrue(sharded_cache.replace_value('k1', 'y'))
+        self.assertFalse(sharded_cache.replace_value('k2', 'y'))
+        self.assertEqual('y', sharded_cache.get_value('k1'))
+        self.assertEqual(1.5, sharded_cache.get_cost('k1'))
+
+        sharded_cache = ShardedCache(store=TracingCacheStore(), capacity=1600, name='sharded', num_shards=4)
+        for i in range(10):
+            sharded_cache.put_value('k%s' % i, 'x')
+            sharded_cache.get_value('k%s' % i)
+        stats = sharded_cache.get_stats()
+        self.assertEqual('sharded', stats['name'])
+        self.assertEqual(4, stats['num_shards'])
+        self.assertEqual(10, stats['puts'])
+        self.assertEqual(10, stats['hits'])
+        self.assertEqual(10, stats['restore_latency']['count'])
+
     def test_store_and_restore_and_discard(self):
         cache_store = TracingCacheStore()
         cache = Cache(store=cache_store, capacity=1000)
@@ -188,3 +317,924 @@ class CacheTest(TestCase):
         self.assertEqual(cache.get_value('k5'), 'yyyy')
         self.assertEqual(cache.size, 600)
         self.assertEqual(cache_store.trace, 'can_load_from_key(k5);load_from_key(k5);restore(k5, S/yyyy);')
+
+
+class EvictorTest(TestCase):
+    @staticmethod
+    def _new_cache(policy):
+        # every value has size 100, so the cache can hold 3 values
+        return Cache(store=TracingCacheStore(), capacity=300, threshold=1.0, policy=policy)
+
+    @staticmethod
+    def _keys(cache):
+        return sorted(cache._item_dict.keys())
+
+    def test_new_evictor(self):
+        self.assertIsInstance(new_evictor(POLICY_LRU), LruEvictor)
+        self.assertIsInstance(new_evictor(POLICY_MRU), MruEvictor)
+        self.assertIsInstance(new_evictor(POLICY_LFU), LfuEvictor)
+        self.assertIsInstance(new_evictor(POLICY_RR), RandomEvictor)
+        self.assertIsInstance(new_evictor(LfuEvictor), LfuEvictor)
+        self.assertIsInstance(new_evictor(lambda item: item.creation_time), SortingEvictor)
+
+    def test_lru(self):
+        cache = self._new_cache(POLICY_LRU)
+        for key in ('k1', 'k2', 'k3'):
+            cache.put_value(key, 'x')
+        cache.get_value('k1')
+        cache.put_value('k4', 'x')
+        self.assertEqual(['k1', 'k3', 'k4'], self._keys(cache))
+        self.assertEqual(300, cache.size)
+
+    def test_mru(self):
+        cache = self._new_cache(POLICY_MRU)
+        for key in ('k1', 'k2', 'k3'):
+            cache.put_value(key, 'x')
+        cache.get_value('k1')
+        cache.put_value('k4', 'x')
+        self.assertEqual(['k2', 'k3', 'k4'], self._keys(cache))
+
+    def test_lfu(self):
+        cache = self._new_cache(POLICY_LFU)
+        for key in ('k1', 'k2', 'k3'):
+            cache.put_value(key, 'x')
+        cache.get_value('k1')
+        cache.get_value('k1')
+        cache.get_value('k3')
+        cache.put_value('k4', 'x')
+        self.assertEqual(['k1', 'k3', 'k4'], self._keys(cache))
+        cache.put_value('k5', 'x')
+        self.assertEqual(['k1', 'k3', 'k5'], self._keys(cache))
+        cache.remove_value('k5')
+        cache.put_value('k6', 'x')
+        cache.put_value('k7', 'x')
+        self.assertEqual(['k1', 'k3', 'k7'], self._keys(cache))
+
+    def test_rr(self):
+        cache = self._new_cache(POLICY_RR)
+        for i in range(100):
+            cache.put_value('k%s' % i, 'x')
+            self.assertIn('k%s' % i, cache._item_dict)
+        self.assertEqual(3, len(cache._item_dict))
+        self.assertEqual(300, cache.size)
+
+    def test_arc(self):
+        cache = self._new_cache(POLICY_ARC)
+        for key in ('k1', 'k2', 'k3'):
+            cache.put_value(key, 'x')
+        cache.get_value('k1')
+        # A scan of items used once does not flush k1, which has been used twice
+        for i in range(10):
+            cache.put_value('s%s' % i, 'x')
+        self.assertIn('k1', cache._item_dict)
+        self.assertEqual(300, cache.size)
+        # A recently evicted key that is added again is considered frequently used
+        evictor = cache._evictor
+        self.assertEqual(0, evictor.target_t1_size)
+        cache.put_value('s7', 'x')
+        self.assertIn('s7', cache._item_dict)
+        self.assertEqual(100, evictor.target_t1_size)
+        self.assertEqual(300, cache.size)
+
+    def test_tinylfu(self):
+        cache = Cache(store=TracingCacheStore(), capacity=1000, threshold=1.0, policy=POLICY_TINYLFU)
+        for i in range(10):
+            cache.put_value('k%s' % i, 'x')
+        for _ in range(3):
+            for i in range(5):
+                cache.get_value('k%s' % i)
+        # A scan of items used once does not flush the popular items
+        for i in range(100):
+            cache.put_value('s%s' % i, 'x')
+        for i in range(5):
+            self.assertIn('k%s' % i, cache._item_dict)
+        self.assertEqual(1000, cache.size)
+        cache.remove_value('k0')
+        self.assertEqual(900, cache.size)
+        cache.clear()
+        self.assertEqual(0, cache.size)
+
+    def test_gds(self):
+        cache = self._new_cache(POLICY_GDS)
+        cache.put_value('k1', 'x', cost=0.5)
+        cache.put_value('k2', 'x', cost=0.001)
+        cache.put_value('k3', 'x', cost=0.2)
+        cache.put_value('k4', 'x', cost=0.1)
+        self.assertEqual(['k1', 'k3', 'k4'], self._keys(cache))
+        self.assertAlmostEqual(0.001 / 100, cache._evictor.inflation)
+        # Accessed items gain priority
+        cache.get_value('k4')
+        cache.put_value('k5', 'x', cost=0.15)
+        self.assertEqual(['k1', 'k4', 'k5'], self._keys(cache))
+        # Evicted items inflate the priority of new items, so that old ones eventually age out
+        cache.put_value('k6', 'x')
+        self.assertEqual(['k1', 'k5', 'k6'], self._keys(cache))
+        self.assertIsInstance(new_evictor(get_policy('GDS')), GreedyDualSizeEvictor)
+
+    def test_min_cost(self):
+        cache = Cache(store=TracingCacheStore(), capacity=300, threshold=1.0, min_cost=0.01)
+        self.assertEqual(0.01, cache.min_cost)
+        cache.put_value('k1', 'x', cost=0.05)
+        cache.put_value('k2', 'x', cost=0.001)
+        cache.put_value('k3', 'x')
+        self.assertEqual(['k1', 'k3'], self._keys(cache))
+        # A cheap value replaces an expensive one by removing it
+        cache.put_value('k1', 'y', cost=0.001)
+        self.assertEqual(['k3'], self._keys(cache))
+        self.assertEqual(0.01, ShardedCache(min_cost=0.01).min_cost)
+
+    def test_frequency_sketch(self):
+        sketch = FrequencySketch(width=64, sample_size=1000)
+        for _ in range(20):
+            sketch.increment('a')
+        sketch.increment('b')
+        self.assertEqual(15, sketch.frequency('a'))
+        self.assertGreaterEqual(sketch.frequency('b'), 1)
+        self.assertLessEqual(sketch.frequency('c'), sketch.frequency('b'))
+        for i in range(1000):
+            sketch.increment(i)
+        self.assertLess(sketch.frequency('a'), 15)
+
+    def test_get_policy(self):
+        self.assertIs(POLICY_LRU, get_policy('LRU'))
+        self.assertIs(POLICY_ARC, get_policy('arc'))
+        self.assertIs(POLICY_TINYLFU, get_policy('TinyLFU'))
+        self.assertIsInstance(new_evictor(get_policy('ARC'), max_size=100), ArcEvictor)
+        self.assertIsInstance(new_evictor(get_policy('TinyLFU'), max_size=100), TinyLfuEvictor)
+        with self.assertRaises(ValueError):
+            get_policy('FIFO')
+
+    def test_custom_policy(self):
+        cache = self._new_cache(lambda item: -item.creation_time)
+        for key in ('k1', 'k2', 'k3', 'k4'):
+            cache.put_value(key, 'x')
+        self.assertEqual(['k1', 'k2', 'k4'], self._keys(cache))
+
+    def test_item_is_compact(self):
+        item = Cache.Item()
+        with self.assertRaises(AttributeError):
+            item.foo = 42
+        cache = self._new_cache(POLICY_LRU)
+        cache.put_value('k1', 'x')
+        cache.put_value('k2', 'x')
+        item1 = cache._item_dict['k1']
+        item2 = cache._item_dict['k2']
+        self.assertLess(item1.access_time, item2.access_time)
+        cache.get_value('k1')
+        self.assertGreater(item1.access_time, item2.access_time)
+        self.assertLess(item1.creation_time, item2.creation_time)
+
+
+class BlockingCacheStore(MemoryCacheStore):
+    def __init__(self):
+        self.entered = threading.Event()
+        self.proceed = threading.Event()
+
+    def store_value(self, key, value):
+        if key == 'slow':
+            self.entered.set()
+            self.proceed.wait(5)
+        return super().store_value(key, value)
+
+
+class CacheConcurrencyTest(TestCase):
+    def test_store_io_is_done_outside_lock(self):
+        cache_store = BlockingCacheStore()
+        cache = Cache(store=cache_store, capacity=10000)
+        cache.put_value('fast', 'a')
+
+        thread = threading.Thread(target=cache.put_value, args=('slow', 'b'))
+        thread.start()
+        try:
+            self.assertTrue(cache_store.entered.wait(5))
+            # while the slow store operation is in progress, other keys remain accessible
+            self.assertEqual('a', cache.get_value('fast'))
+            cache.put_value('other', 'c')
+            self.assertEqual('c', cache.get_value('other'))
+            self.assertIsNone(cache.get_value('slow'))
+        finally:
+            cache_store.proceed.set()
+            thread.join()
+        self.assertEqual('b', cache.get_value('slow'))
+
+    def test_restore_of_item_evicted_concurrently_is_a_miss(self):
+        for cache_store in (MemoryCacheStore(), CompressedMemoryCacheStore(),
+                            ContentAddressedCacheStore(MemoryCacheStore())):
+            cache = Cache(store=cache_store, capacity=10000)
+            cache.put_value('a', b'abc')
+            # get_value() looks up the item and its stored value while holding the lock, restores it later
+            item = cache._item_dict['a']
+            stored_value = item.stored_value
+            cache.remove_value('a')
+            self.assertIsNone(cache._restore_item(item, 'a', stored_value))
+            self.assertIsNone(cache._restore_item(item, 'a', item.stored_value))
+            self.assertIsNone(cache.get_value('a'))
+
+
+class ShardedCacheTest(TestCase):
+    def test_put_get_remove(self):
+        cache = ShardedCache(store=TracingCacheStore(), capacity=8000, num_shards=4)
+        self.assertEqual(4, len(cache.shards))
+        self.assertEqual(8000, cache.capacity)
+        self.assertEqual(6000, cache.max_size)
+        for i in range(20):
+            cache.put_value('k%s' % i, 'x')
+        self.assertEqual(2000, cache.size)
+        self.assertEqual(2000, sum(shard.size for shard in cache.shards))
+        self.assertTrue(sum(1 for shard in cache.shards if shard.size > 0) > 1)
+        for i in range(20):
+            self.assertEqual('x', cache.get_value('k%s' % i))
+        cache.remove_value('k0')
+        self.assertIsNone(cache.get_value('k0'))
+        self.assertEqual(1900, cache.size)
+        cache.clear()
+        self.assertEqual(0, cache.size)
+
+    def test_each_shard_has_own_budget(self):
+        cache = ShardedCache(store=TracingCacheStore(), capacity=1200, threshold=1.0, num_shards=4)
+        for i in range(100):
+            cache.put_value('k%s' % i, 'x')
+        for shard in cache.shards:
+            self.assertLessEqual(shard.size, 300)
+        self.assertLessEqual(cache.size, 1200)
+
+    def test_concurrent_access(self):
+        cache = ShardedCache(store=MemoryCacheStore(), capacity=100000, num_shards=8)
+        errors = []
+
+        def work(thread_index):
+            try:
+                for i in range(500):
+                    key = 'k%s' % ((i * 7 + thread_index) % 300)
+                    value = cache.get_value(key)
+                    if value is None:
+                        cache.put_value(key, key)
+                    elif value != key:
+                        errors.append((key, value))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertLessEqual(cache.size, cache.max_size)
+
+
+class SingleFlightTest(TestCase):
+    def test_concurrent_calls_are_shared(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        proceed = threading.Event()
+        calls = []
+
+        def compute(x):
+            calls.append(x)
+            started.set()
+            proceed.wait(5)
+            return x * 2
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flight.do('k', compute, 21)))
+        leader.start()
+        self.assertTrue(started.wait(5))
+        followers = [threading.Thread(target=lambda: results.append(flight.do('k', compute, 21))) for _ in range(3)]
+        for follower in followers:
+            follower.start()
+        while flight.num_shared < 3:
+            time.sleep(0.001)
+        self.assertEqual(1, flight.num_in_flight)
+        proceed.set()
+        for thread in [leader] + followers:
+            thread.join()
+
+        self.assertEqual([21], calls)
+        self.assertEqual([42, 42, 42, 42], results)
+        self.assertEqual(1, flight.num_calls)
+        self.assertEqual(3, flight.num_shared)
+        self.assertEqual(0, flight.num_in_flight)
+
+        # subsequent calls are performed again
+        self.assertEqual(4, flight.do('k', lambda: 4))
+        self.assertEqual(2, flight.num_calls)
+
+    def test_errors_are_raised(self):
+        flight = SingleFlight()
+
+        def fail():
+            raise ValueError('argh')
+
+        with self.assertRaises(ValueError):
+            flight.do('k', fail)
+        self.assertEqual(0, flight.num_in_flight)
+
+
+class FileCacheStoreIndexTest(TestCase):
+    DIR = '__test_file_cache_index__'
+
+    def setUp(self):
+        shutil.rmtree(self.DIR, ignore_errors=True)
+        os.mkdir(self.DIR)
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR, ignore_errors=True)
+
+    def _store_previous_run(self):
+        cache_store = FileCacheStore(self.DIR, ".dat")
+        cache_store.store_value('img/0/0', b'a' * 100)
+        cache_store.store_value('img/0/1', b'b' * 200)
+        cache_store.store_value('img/1/0', b'c' * 300)
+        os.utime(cache_store._key_to_path('img/0/0'), (1000, 1000))
+        os.utime(cache_store._key_to_path('img/0/1'), (3000, 3000))
+        os.utime(cache_store._key_to_path('img/1/0'), (2000, 2000))
+        with open(os.path.join(self.DIR, 'img', 'other.txt'), 'w') as fp:
+            fp.write('not a cached value')
+
+    def test_scan_values(self):
+        self._store_previous_run()
+
+        cache_store = FileCacheStore(self.DIR, ".dat")
+        self.assertFalse(cache_store.index_complete)
+        self.assertTrue(cache_store.can_load_from_key('img/0/0'))
+
+        values = list(cache_store.scan_values())
+        self.assertTrue(cache_store.index_complete)
+        self.assertEqual([('img/0/0', os.path.join(self.DIR, 'img', '0', '0.dat'), 100),
+                          ('img/1/0', os.path.join(self.DIR, 'img', '1', '0.dat'), 300),
+                          ('img/0/1', os.path.join(self.DIR, 'img', '0', '1.dat'), 200)],
+                         [(key, os.path.normpath(path), size) for key, path, size in values])
+
+        self.assertTrue(cache_store.can_load_from_key('img/0/1'))
+        self.assertFalse(cache_store.can_load_from_key('img/other'))
+        self.assertEqual((cache_store._key_to_path('img/1/0'), 300), cache_store.load_from_key('img/1/0'))
+
+        cache_store.discard_value('img/1/0', None)
+        self.assertFalse(cache_store.can_load_from_key('img/1/0'))
+        cache_store.store_value('img/2/0', b'd')
+        self.assertTrue(cache_store.can_load_from_key('img/2/0'))
+
+    def test_cache_recover(self):
+        self._store_previous_run()
+
+        cache = Cache(store=FileCacheStore(self.DIR, ".dat"), capacity=550, threshold=1.0)
+        cache.recover()
+        self.assertEqual(500, cache.size)
+        # the least recently used file has been evicted to stay within budget
+        self.assertFalse(os.path.exists(os.path.join(self.DIR, 'img', '0', '0.dat')))
+        self.assertEqual(b'c' * 300, cache.get_value('img/1/0'))
+        self.assertEqual(b'b' * 200, cache.get_value('img/0/1'))
+
+        cache.put_value('img/3/0', b'e' * 200)
+        self.assertEqual(400, cache.size)
+        self.assertFalse(os.path.exists(os.path.join(self.DIR, 'img', '1', '0.dat')))
+
+    def test_sharded_cache_recover(self):
+        self._store_previous_run()
+
+        cache = ShardedCache(store=FileCacheStore(self.DIR, ".dat"), capacity=100000, num_shards=4)
+        cache.recover()
+        self.assertEqual(600, cache.size)
+        self.assertEqual(b'a' * 100, cache.get_value('img/0/0'))
+
+
+class FileCacheStoreLayoutTest(TestCase):
+    DIR = '__test_file_cache_layout__'
+
+    def setUp(self):
+        shutil.rmtree(self.DIR, ignore_errors=True)
+        os.mkdir(self.DIR)
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR, ignore_errors=True)
+
+    def _list_files(self):
+        return sorted(os.path.relpath(os.path.join(dir_path, file_name), self.DIR).replace(os.sep, '/')
+                      for dir_path, _, file_names in os.walk(self.DIR) for file_name in file_names)
+
+    def test_sharded(self):
+        cache_store = FileCacheStore(self.DIR, ".png", sharded=True)
+        path, size = cache_store.store_value('rgb-x/2/3/4', b'abc')
+        self.assertEqual(3, size)
+        self.assertEqual(os.path.join(self.DIR, '92', 'f7', 'rgb-x%2F2%2F3%2F4.png'), path)
+        self.assertEqual(['92/f7/rgb-x%2F2%2F3%2F4.png'], self._list_files())
+        self.assertEqual(b'abc', cache_store.restore_value('rgb-x/2/3/4', path))
+
+        values = list(FileCacheStore(self.DIR, ".png", sharded=True).scan_values())
+        self.assertEqual([('rgb-x/2/3/4', path, 3)], values)
+
+        # empty directories are removed as well
+        cache_store.discard_value('rgb-x/2/3/4', path)
+        self.assertEqual([], os.listdir(self.DIR))
+
+    def test_discard_removes_empty_dirs(self):
+        cache_store = FileCacheStore(self.DIR, ".dat")
+        cache_store.store_value('a/b/c', b'1')
+        cache_store.store_value('a/d', b'2')
+        cache_store.discard_value('a/b/c', None)
+        self.assertEqual(['a/d.dat'], self._list_files())
+        cache_store.discard_value('a/d', None)
+        self.assertEqual([], os.listdir(self.DIR))
+
+    def test_scan_removes_stale_temp_files(self):
+        cache_store = FileCacheStore(self.DIR, ".dat")
+        cache_store.store_value('a', b'1')
+        temp_path = os.path.join(self.DIR, 'b.dat.1234.tmp')
+        with open(temp_path, 'wb') as fp:
+            fp.write(b'2')
+        os.utime(temp_path, (1000, 1000))
+        self.assertEqual([('a', os.path.join(self.DIR, 'a.dat'), 1)], list(cache_store.scan_values()))
+        self.assertEqual(['a.dat'], self._list_files())
+
+    def test_write_behind(self):
+        cache_store = FileCacheStore(self.DIR, ".dat", sharded=True, write_behind=True)
+        stored_value, size = cache_store.store_value('a', b'abc')
+        self.assertEqual(3, size)
+        self.assertTrue(cache_store.can_load_from_key('a'))
+        self.assertEqual(b'abc', cache_store.restore_value('a', stored_value))
+
+        cache_store.flush()
+        self.assertEqual(0, cache_store.num_pending_writes)
+        self.assertTrue(os.path.isfile(stored_value))
+        self.assertEqual(b'abc', cache_store.restore_value('a', stored_value))
+        self.assertEqual(1, len(self._list_files()))
+
+        cache_store.store_value('a', b'defg')
+        cache_store.store_value('b', b'hij')
+        cache_store.discard_value('b', None)
+        cache_store.flush()
+        self.assertEqual(b'defg', cache_store.restore_value('a', stored_value))
+        self.assertFalse(cache_store.can_load_from_key('b'))
+        self.assertEqual(1, len(self._list_files()))
+
+    def test_write_behind_with_cache(self):
+        cache = Cache(store=FileCacheStore(self.DIR, ".dat", write_behind=True), capacity=10, threshold=1.0)
+        for i in range(10):
+            cache.put_value('k%s' % i, b'xxxx')
+            self.assertEqual(b'xxxx', cache.get_value('k%s' % i))
+        cache.store.flush()
+        self.assertEqual(['k8.dat', 'k9.dat'], self._list_files())
+
+
+class PackCacheStoreTest(TestCase):
+    DIR = os.path.join(os.path.dirname(__file__), '.pack-cache')
+
+    def setUp(self):
+        shutil.rmtree(self.DIR, ignore_errors=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR, ignore_errors=True)
+
+    def test_store_and_restore_value(self):
+        cache_store = PackCacheStore(self.DIR)
+        stored_value, size = cache_store.store_value('a/b/1', b'abc')
+        self.assertEqual(3, size)
+        self.assertTrue(cache_store.can_load_from_key('a/b/1'))
+        self.assertFalse(cache_store.can_load_from_key('a/b/2'))
+        value = cache_store.restore_value('a/b/1', stored_value)
+        self.assertIsInstance(value, memoryview)
+        self.assertEqual(b'abc', value)
+        self.assertEqual((stored_value, 3), cache_store.load_from_key('a/b/1'))
+
+        cache_store.discard_value('a/b/1', stored_value)
+        self.assertFalse(cache_store.can_load_from_key('a/b/1'))
+        self.assertIsNone(cache_store.restore_value('a/b/1', stored_value))
+        cache_store.close()
+
+    def test_reopen(self):
+        cache_store = PackCacheStore(self.DIR, max_pack_size=16)
+        cache_store.store_value('a', b'0123456789')
+        cache_store.store_value('b', b'abcdefghij')
+        cache_store.store_value('c', b'ABCDEFGHIJ')
+        cache_store.store_value('a', b'9876543210')
+        cache_store.discard_value('b', None)
+        cache_store.close()
+
+        cache_store = PackCacheStore(self.DIR, max_pack_size=16)
+        scanned = list(cache_store.scan_values())
+        self.assertEqual(['c', 'a'], [key for key, _, _ in scanned])
+        self.assertEqual(b'ABCDEFGHIJ', cache_store.restore_value('c', scanned[0][1]))
+        self.assertEqual(b'9876543210', cache_store.restore_value('a', scanned[1][1]))
+        self.assertEqual(26, cache_store.garbage_size)
+        cache_store.close()
+
+    def test_reopen_after_discard(self):
+        cache_store = PackCacheStore(self.DIR)
+        for key in 'abc':
+            cache_store.store_value(key, key.encode() * 10)
+        cache_store.discard_value('b', None)
+        cache_store.close()
+
+        cache_store = PackCacheStore(self.DIR)
+        self.assertEqual(['a', 'c'], [key for key, _, _ in cache_store.scan_values()])
+        self.assertIsNone(cache_store.restore_value('b', None))
+        cache_store.close()
+
+    def test_compact(self):
+        cache_store = PackCacheStore(self.DIR, max_pack_size=32)
+        for i in range(10):
+            cache_store.store_value(str(i), bytes(10 * [i]))
+        view = cache_store.restore_value('0', None)
+        for i in range(0, 10, 2):
+            cache_store.discard_value(str(i), None)
+        self.assertEqual(65, cache_store.garbage_size)
+
+        cache_store.compact()
+        self.assertEqual(0, cache_store.garbage_size)
+        self.assertEqual(65, cache_store.size)
+        for i in range(1, 10, 2):
+            self.assertEqual(bytes(10 * [i]), cache_store.restore_value(str(i), None))
+        # Views restored before compaction remain valid
+        self.assertEqual(bytes(10 * [0]), view)
+        cache_store.close()
+
+        cache_store = PackCacheStore(self.DIR, max_pack_size=32)
+        self.assertEqual(['1', '3', '5', '7', '9'], [key for key, _, _ in cache_store.scan_values()])
+        cache_store.close()
+
+    def test_close(self):
+        cache_store = PackCacheStore(self.DIR)
+        stored_value, _ = cache_store.store_value('a', b'abc')
+        # A running compaction is waited for
+        cache_store._compaction_lock.acquire()
+        thread = threading.Thread(target=cache_store.close)
+        thread.start()
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+        cache_store._compaction_lock.release()
+        thread.join()
+
+        with self.assertRaises(OSError):
+            cache_store.store_value('b', b'def')
+        self.assertIsNone(cache_store.restore_value('a', stored_value))
+        cache_store.discard_value('a', stored_value)
+        cache_store.compact()
+        cache_store.close()
+
+        # Nothing has been written after closing
+        cache_store = PackCacheStore(self.DIR)
+        self.assertEqual(['a'], [key for key, _, _ in cache_store.scan_values()])
+        cache_store.close()
+
+    def test_cache_recover(self):
+        cache_store = PackCacheStore(self.DIR)
+        cache = Cache(store=cache_store, capacity=100)
+        cache.put_value('a', b'0123456789')
+        cache.put_value('b', b'abcdefghij')
+        cache_store.close()
+
+        cache = Cache(store=PackCacheStore(self.DIR), capacity=100)
+        cache.recover()
+        self.assertEqual(20, cache.size)
+        self.assertEqual(b'abcdefghij', cache.get_value('b'))
+
+
+class NpyFileCacheStoreTest(TestCase):
+    DIR = '__test_npy_cache__'
+
+    def setUp(self):
+        shutil.rmtree(self.DIR, ignore_errors=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR, ignore_errors=True)
+
+    def test_store_and_restore_value(self):
+        cache_store = NpyFileCacheStore(self.DIR)
+        value = np.arange(12, dtype=np.float32).reshape((3, 4))
+        path, size = cache_store.store_value('a/0/1', value)
+        self.assertTrue(path.endswith('.npy'))
+        self.assertEqual(os.path.getsize(path), size)
+        np.testing.assert_equal(np.load(path), value)
+
+        restored_value = cache_store.restore_value('a/0/1', path)
+        self.assertIsInstance(restored_value, np.memmap)
+        self.assertNotIsInstance(restored_value, np.ma.MaskedArray)
+        self.assertEqual(np.float32, restored_value.dtype)
+        np.testing.assert_equal(restored_value, value)
+        # Copy-on-write
+        restored_value[0, 0] = 100.
+        np.testing.assert_equal(np.load(path), value)
+
+    def test_store_and_restore_masked_value(self):
+        cache_store = NpyFileCacheStore(self.DIR)
+        value = np.ma.masked_invalid(np.array([[1., np.nan], [np.nan, 4.]]))
+        path, size = cache_store.store_value('b', value)
+        restored_value = cache_store.restore_value('b', path)
+        self.assertIsInstance(restored_value, np.ma.MaskedArray)
+        np.testing.assert_equal(restored_value.mask, [[False, True], [True, False]])
+        np.testing.assert_equal(restored_value.filled(0.), [[1., 0.], [0., 4.]])
+
+        cache_store.discard_value('b', path)
+        self.assertFalse(os.path.exists(path))
+
+    def test_tiers(self):
+        disk_cache = Cache(store=NpyFileCacheStore(self.DIR, write_behind=True), capacity=1000000, threshold=1.0)
+        mem_cache = Cache(store=MemoryCacheStore(), capacity=2 * 800, threshold=1.0, parent_cache=disk_cache)
+        for i in range(4):
+            mem_cache.put_value('k%s' % i, np.full((10, 10), i, dtype=np.float64))
+        self.assertEqual(['k2', 'k3'], sorted(mem_cache._item_dict.keys()))
+        self.assertEqual(['k0', 'k1'], sorted(disk_cache._item_dict.keys()))
+
+        # Promotion on hit, the disk tier keeps its copy
+        np.testing.assert_equal(mem_cache.get_value('k0'), np.full((10, 10), 0.))
+        self.assertTrue(mem_cache.has_value('k0'))
+        self.assertTrue(disk_cache.has_value('k0'))
+        self.assertEqual(['k0', 'k1', 'k2'], sorted(disk_cache._item_dict.keys()))
+        disk_cache.store.flush()
+        np.testing.assert_equal(mem_cache.get_value('k2'), np.full((10, 10), 2.))
+
+
+class CacheSnapshotTest(TestCase):
+    DIR = os.path.join(os.path.dirname(__file__), '.cache-snapshot')
+
+    def setUp(self):
+        shutil.rmtree(self.DIR, ignore_errors=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR, ignore_errors=True)
+
+    def _test_write_and_read_snapshot(self, store_class):
+        path = os.path.join(self.DIR, 'tiles.snapshot')
+        cache = ShardedCache(store=store_class(), capacity=1000000, threshold=1.0, num_shards=4)
+        masked_value = np.ma.masked_invalid(np.array([[1., np.nan], [3., 4.]], dtype=np.float32))
+        cache.put_value('a', masked_value, cost=0.5)
+        cache.put_value('b', np.arange(6, dtype=np.int16).reshape((2, 3)))
+        cache.put_value('c', b'PNG')
+        cache.put_value('d', 'not written')
+        for _ in range(3):
+            cache.get_value('a')
+            cache.get_value('b')
+            cache.get_value('c')
+            cache.get_value('d')
+        cache.put_value('e', np.zeros(4))
+        cache.get_value('e')
+
+        self.assertEqual(3, cache.write_snapshot(path, fraction=0.8, tag_function=lambda key: key.upper()))
+
+        cache = ShardedCache(store=store_class(), capacity=1000000, threshold=1.0, num_shards=4)
+        self.assertEqual(2, cache.read_snapshot(path, tag_filter=lambda key, tag: tag != 'C'))
+        self.assertFalse(cache.has_value('c'))
+        self.assertFalse(cache.has_value('e'))
+
+        restored_value = cache.get_value('a')
+        self.assertIsInstance(restored_value, np.ma.MaskedArray)
+        self.assertEqual(np.float32, restored_value.dtype)
+        np.testing.assert_equal(restored_value.mask, [[False, True], [False, False]])
+        np.testing.assert_equal(restored_value.filled(0.), [[1., 0.], [3., 4.]])
+        restored_value = cache.get_value('b')
+        np.testing.assert_equal(restored_value, np.arange(6, dtype=np.int16).reshape((2, 3)))
+        # Copy-on-write
+        restored_value[0, 0] = 100
+
+        item = cache._get_shard('a')._item_dict['a']
+        self.assertEqual(0.5, item.cost)
+        self.assertEqual(5, item.access_count)
+
+        # Snapshots can be replaced while their values are in use
+        self.assertEqual(2, cache.write_snapshot(path))
+        self.assertEqual(0, cache.read_snapshot(path))
+
+    def test_memory_store(self):
+        self._test_write_and_read_snapshot(MemoryCacheStore)
+
+    def test_compressed_memory_store(self):
+        self._test_write_and_read_snapshot(CompressedMemoryCacheStore)
+
+    def test_store_without_snapshots(self):
+        path = os.path.join(self.DIR, 'tiles.snapshot')
+        cache = Cache(store=FileCacheStore(self.DIR, '.png'), capacity=1000000, threshold=1.0)
+        cache.put_value('a', b'PNG')
+        self.assertEqual(0, cache.write_snapshot(path))
+        self.assertEqual(0, Cache().read_snapshot(path))
+
+    def test_invalid_snapshot(self):
+        path = os.path.join(self.DIR, 'tiles.snapshot')
+        os.makedirs(self.DIR)
+        with open(path, 'wb') as fp:
+            fp.write(b'PNG')
+        with self.assertRaises(ValueError):
+            Cache().read_snapshot(path)
+
+
+class LruObjectCacheTest(TestCase):
+    def test_eviction_and_dispose(self):
+        disposed = []
+        cache = LruObjectCache(2, dispose=disposed.append, name='objects')
+        self.assertEqual('A', cache.get_or_create('a', lambda: 'A'))
+        self.assertEqual('B', cache.get_or_create('b', lambda: 'B'))
+        self.assertEqual('A', cache.get_or_create('a', lambda: 'X'))
+        self.assertEqual('C', cache.get_or_create('c', lambda: 'C'))
+        self.assertEqual(['B'], disposed)
+        self.assertEqual(2, len(cache))
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIsNone(cache.get('b'))
+
+        self.assertTrue(cache.remove('a'))
+        self.assertFalse(cache.remove('a'))
+        self.assertEqual(['B', 'A'], disposed)
+        cache.clear(dispose=False)
+        self.assertEqual(['B', 'A'], disposed)
+        self.assertEqual(0, len(cache))
+
+        self.assertEqual(dict(name='objects', capacity=2, num_items=0, hits=1, misses=3, removals=1, evictions=1,
+                              hit_ratio=0.25),
+                         cache.get_stats())
+
+        with self.assertRaises(ValueError):
+            LruObjectCache(0)
+
+    def test_single_flight(self):
+        cache = LruObjectCache(10)
+        entered = threading.Event()
+        release = threading.Event()
+        num_calls = []
+
+        def factory():
+            num_calls.append(1)
+            entered.set()
+            release.wait(5)
+            return object()
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_create('a', factory)))
+                   for _ in range(4)]
+        threads[0].start()
+        entered.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(num_calls))
+        self.assertEqual(4, len(results))
+        self.assertTrue(all(result is results[0] for result in results))
+
+
+class CacheNamespaceTest(TestCase):
+    @staticmethod
+    def _get_namespace(key):
+        return key.split('/')[0]
+
+    def test_remove_namespace(self):
+        parent_cache = Cache(MemoryCacheStore(), capacity=10000, threshold=1.0, namespace_function=self._get_namespace)
+        cache = Cache(MemoryCacheStore(), capacity=3 * 48, threshold=1.0, parent_cache=parent_cache,
+                      namespace_function=self._get_namespace)
+        for key in ('a/1', 'a/2', 'b/1', 'a/3', 'b/2'):
+            cache.put_value(key, np.zeros(6))
+        # 'a/1' and 'a/2' have been evicted into the parent cache
+        self.assertEqual(['a/3', 'b/1', 'b/2'], sorted(cache._item_dict.keys()))
+        self.assertEqual({'a': ['a/3'], 'b': ['b/1', 'b/2']},
+                         {ns: sorted(items.keys()) for ns, items in cache._namespaces.items()})
+
+        self.assertEqual(1, cache.remove_namespace('a'))
+        self.assertEqual(['b/1', 'b/2'], sorted(cache._item_dict.keys()))
+        self.assertEqual([], sorted(parent_cache._item_dict.keys()))
+        self.assertEqual(['b'], list(cache._namespaces.keys()))
+        self.assertEqual({}, parent_cache._namespaces)
+        self.assertEqual(0, cache.remove_namespace('x'))
+
+        cache.clear()
+        self.assertEqual({}, cache._namespaces)
+
+        with self.assertRaises(ValueError):
+            Cache().remove_namespace('a')
+
+    def test_sharded_remove_namespace(self):
+        parent_cache = ShardedCache(capacity=10000, threshold=1.0, namespace_function=self._get_namespace)
+        cache = ShardedCache(capacity=10000, threshold=1.0, parent_cache=parent_cache,
+                             namespace_function=self._get_namespace, num_shards=4)
+        keys = ['%s/%d' % (ns, i) for ns in 'ab' for i in range(10)]
+        for key in keys:
+            cache.put_value(key, key)
+            parent_cache.put_value(key, key)
+        self.assertEqual(10, cache.remove_namespace('a'))
+        for key in keys:
+            self.assertEqual(key.startswith('b'), cache.has_value(key))
+            self.assertEqual(key.startswith('b'), parent_cache.has_value(key))
+
+
+class RacingContentAddressedCacheStore(ContentAddressedCacheStore):
+    """ Calls *on_store* once, before storing the next value. """
+
+    on_store = None
+
+    def store_value(self, key, value):
+        on_store, self.on_store = self.on_store, None
+        if on_store is not None:
+            on_store(key)
+        return super().store_value(key, value)
+
+
+class ConcurrentStoringFileCacheStore(FileCacheStore):
+    """ Calls *on_discard* once, before discarding the next value. """
+
+    on_discard = None
+
+    def discard_value(self, key, stored_value):
+        on_discard, self.on_discard = self.on_discard, None
+        if on_discard is not None:
+            on_discard()
+        super().discard_value(key, stored_value)
+
+
+class ContentAddressedCacheStoreTest(TestCase):
+    DIR = '__test_content_cache__'
+
+    def setUp(self):
+        shutil.rmtree(self.DIR, ignore_errors=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.DIR, ignore_errors=True)
+
+    def test_discard_and_store_same_content_concurrently(self):
+        inner_store = ConcurrentStoringFileCacheStore(self.DIR, '.png')
+        cache_store = ContentAddressedCacheStore(inner_store)
+        stored_value_a, _ = cache_store.store_value('a', b'EMPTY')
+        results = []
+        threads = []
+
+        def store_same_content():
+            thread = threading.Thread(target=lambda: results.append(cache_store.store_value('b', b'EMPTY')))
+            thread.start()
+            # The store must wait for the discard to finish
+            thread.join(0.2)
+            threads.append(thread)
+
+        inner_store.on_discard = store_same_content
+        cache_store.discard_value('a', stored_value_a)
+        threads[0].join()
+        stored_value_b, _ = results[0]
+        self.assertEqual(1, cache_store.num_contents)
+        self.assertEqual(b'EMPTY', bytes(cache_store.restore_value('b', stored_value_b)))
+
+    def test_racing_puts_release_their_contents(self):
+        for other_value in (b'EMPTY', b'DATA'):
+            for inner_store in (MemoryCacheStore(), FileCacheStore(self.DIR, '.png')):
+                cache_store = RacingContentAddressedCacheStore(inner_store, persistent=True)
+                cache = Cache(cache_store, capacity=1000000)
+                cache_store.on_store = lambda key: cache.put_value(key, other_value)
+                cache.put_value('a', b'EMPTY')
+                self.assertEqual(b'EMPTY', bytes(cache.get_value('a')))
+                self.assertEqual(1, cache_store.num_contents)
+                self.assertEqual([1], [content.ref_count for content in cache_store._contents.values()])
+                if isinstance(inner_store, FileCacheStore):
+                    # The reference of the winning put has been kept
+                    self.assertTrue(inner_store.can_load_from_key('a'))
+                cache.remove_value('a')
+                self.assertEqual(0, cache_store.num_contents)
+
+    def test_identical_values_are_stored_once(self):
+        inner_store = MemoryCacheStore()
+        cache_store = ContentAddressedCacheStore(inner_store)
+        stored_value_a, size_a = cache_store.store_value('a', b'EMPTY' * 100)
+        stored_value_b, size_b = cache_store.store_value('b', b'EMPTY' * 100)
+        stored_value_c, size_c = cache_store.store_value('c', b'DATA' * 100)
+        self.assertEqual(2, cache_store.num_contents)
+        self.assertEqual(inner_store.store_value('x', b'EMPTY' * 100)[1], size_a)
+        self.assertEqual(24, size_b)
+        self.assertIs(cache_store.restore_value('a', stored_value_a), cache_store.restore_value('b', stored_value_b))
+        self.assertEqual(b'DATA' * 100, cache_store.restore_value('c', stored_value_c))
+
+        cache_store.discard_value('a', stored_value_a)
+        self.assertEqual(2, cache_store.num_contents)
+        self.assertEqual(b'EMPTY' * 100, cache_store.restore_value('b', stored_value_b))
+        cache_store.discard_value('b', stored_value_b)
+        self.assertEqual(1, cache_store.num_contents)
+        with self.assertRaises(OSError):
+            cache_store.restore_value('b', stored_value_b)
+
+    def test_cache_with_pack_store(self):
+        cache = Cache(ContentAddressedCacheStore(PackCacheStore(self.DIR), persistent=True), capacity=1000000)
+        for i in range(10):
+            cache.put_value('empty/%d' % i, b'EMPTY' * 100)
+        cache.put_value('data/0', b'DATA' * 100)
+        self.assertEqual(2, cache.store.num_contents)
+        self.assertEqual(500 + 9 * 24 + 400, cache.size)
+        self.assertEqual(b'EMPTY' * 100, bytes(cache.get_value('empty/7')))
+        cache.remove_value('empty/0')
+        cache.remove_value('data/0')
+        cache.store.store.close()
+
+        # References and contents are recovered after a restart
+        cache = Cache(ContentAddressedCacheStore(PackCacheStore(self.DIR), persistent=True), capacity=1000000)
+        cache.recover()
+        self.assertEqual(1, cache.store.num_contents)
+        self.assertEqual(9, cache.num_items)
+        self.assertEqual(500 + 8 * 24, cache.size)
+        self.assertIsNone(cache.get_value('empty/0'))
+        self.assertIsNone(cache.get_value('data/0'))
+        self.assertEqual(b'EMPTY' * 100, bytes(cache.get_value('empty/9')))
+        cache.store.store.close()
+
+    def test_cache_with_file_store(self):
+        cache = Cache(ContentAddressedCacheStore(FileCacheStore(self.DIR, '.png', sharded=True), persistent=True),
+                      capacity=1000000)
+        for i in range(3):
+            cache.put_value('empty/%d' % i, b'EMPTY' * 100)
+        # One content file and three reference files
+        self.assertEqual(4, sum(len(file_names) for _, _, file_names in os.walk(self.DIR)))
+        cache.clear()
+        self.assertEqual(0, sum(len(file_names) for _, _, file_names in os.walk(self.DIR)))
@@ -1,9 +1,13 @@
+import os
+import shutil
 import unittest
 
 import xarray as xr
 
-from test.helpers import new_test_service_context
-from xcube_server.errors import ServiceResourceNotFoundError
+from test.helpers import new_test_service_context, RequestParamsMock
+from xcube_server.controllers.tiles import get_dataset_tile
+from xcube_server.errors import ServiceResourceNotFoundError, ServiceConfigError
+from xcube_server.im import TileEncoding, AdaptiveTileEncoding
 
 
 class ServiceContextTest(unittest.TestCase):
@@ -38,6 +42,87 @@ class ServiceContextTest(unittest.TestCase):
         self.assertNotIn('demo', ctx.dataset_cache)
         self.assertNotIn('demo2', ctx.dataset_cache)
 
+    def test_get_dataset_generation(self):
+        ctx = new_test_service_context()
+        config = ctx.config
+        self.assertEqual(0, ctx.get_dataset_generation('demo'))
+        ctx.get_dataset('demo')
+        tile_ids = []
+        for _ in range(2):
+            get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock())
+            tile_ids.extend(key for shard in ctx.mem_tile_cache.shards for key in shard._item_dict.keys()
+                            if key not in tile_ids)
+            self.assertEqual('demo', ctx.get_tile_dataset_name(tile_ids[-1]))
+            # Reload dataset
+            ctx.config = dict(config, Datasets=[dsd for dsd in config['Datasets'] if dsd['Identifier'] != 'demo'])
+            ctx.config = config
+            # Tiles of closed datasets are no longer attributed to them
+            self.assertIsNone(ctx.get_tile_dataset_name(tile_ids[-1]))
+        self.assertEqual(2, ctx.get_dataset_generation('demo'))
+        self.assertEqual(0, ctx.get_dataset_generation('demo-1w'))
+        # Tiles of the reloaded dataset have new identifiers
+        self.assertEqual(2, len(tile_ids))
+        self.assertNotEqual(tile_ids[0], tile_ids[1])
+        # Tile identifiers are hashes of fixed length
+        self.assertEqual(len(tile_ids[0]), len(tile_ids[1]))
+
+    def test_evicted_pyramids_release_tile_dataset_names(self):
+        ctx = new_test_service_context()
+        ctx.config = dict(ctx.config, TileCaches=dict(Pyramids=dict(Capacity=1)))
+        get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock(vmin='1', vmax='5'))
+        rgb_image_ids = {image_id for image_id in ctx.tile_image_dataset_names.keys() if image_id.startswith('rgb-')}
+        self.assertTrue(rgb_image_ids)
+        get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock(vmin='2', vmax='5'))
+        self.assertEqual(1, ctx.pyramid_cache.get_stats()['evictions'])
+        self.assertFalse(rgb_image_ids & set(ctx.tile_image_dataset_names.keys()))
+        # The array tile is shared with the live pyramid, so it is still attributed to its dataset
+        array_tile_ids = [key for shard in ctx.mem_tile_cache.shards for key in shard._item_dict.keys()]
+        self.assertEqual(1, len(array_tile_ids))
+        self.assertEqual('demo', ctx.get_tile_dataset_name(array_tile_ids[0]))
+
+    def test_tile_caches_are_flushed_when_replaced(self):
+        ctx = new_test_service_context()
+        cache_dir = os.path.join(ctx.base_dir, '.tile-cache')
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        try:
+            config = ctx.config
+            ctx.config = dict(config, TileCaches=dict(RgbTiles=dict(Store='file', Path='.tile-cache')))
+            file_store = ctx.rgb_tile_cache.store.store
+            self.assertTrue(file_store.write_behind)
+            for x in range(4):
+                get_dataset_tile(ctx, 'demo', 'conc_tsm', str(x), '0', '1', RequestParamsMock())
+            ctx.flush_tile_caches()
+            self.assertEqual(0, file_store.num_pending_writes)
+
+            get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock())
+            ctx.config = config
+            self.assertEqual(0, file_store.num_pending_writes)
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def test_tile_caches_are_closed_when_replaced(self):
+        ctx = new_test_service_context()
+        cache_dir = os.path.join(ctx.base_dir, '.tile-cache')
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        try:
+            config = dict(ctx.config, TileCaches=dict(RgbTiles=dict(Store='pack', Path='.tile-cache')))
+            ctx.config = config
+            pack_store = ctx.rgb_tile_cache.store.store
+            get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock())
+            tile_keys = [key for key, _, _ in pack_store.scan_values()]
+            self.assertTrue(tile_keys)
+
+            ctx.config = dict(config, TileCaches=dict(RgbTiles=dict(Store='pack', Path='.tile-cache', Policy='LFU')))
+            # The old store has been closed before the new one has been opened for the same directory
+            with self.assertRaises(OSError):
+                pack_store.store_value('x', b'x')
+            new_pack_store = ctx.rgb_tile_cache.store.store
+            self.assertIsNot(pack_store, new_pack_store)
+            self.assertEqual(tile_keys, [key for key, _, _ in new_pack_store.scan_values()])
+            ctx.close_tile_caches()
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
     def test_get_dataset_and_variable(self):
         ctx = new_test_service_context()
         ds, var = ctx.get_dataset_and_variable('demo', 'conc_tsm')
@@ -101,3 +186,140 @@ class ServiceContextTest(unittest.TestCase):
         with self.assertRaises(ServiceResourceNotFoundError) as cm:
             ctx.get_feature_collection(collection_name="bibo")
         self.assertEqual('HTTP 404: Feature collection "bibo" not found', f"{cm.exception}")
+
+    def test_get_dataset_fingerprint(self):
+        ctx = new_test_service_context()
+        fingerprint = ctx.get_dataset_fingerprint('demo')
+        self.assertIsInstance(fingerprint, str)
+        self.assertEqual(fingerprint, ctx.get_dataset_fingerprint('demo'))
+        self.assertIsNone(ctx.get_dataset_fingerprint('demox'))
+
+        ctx.config = dict(ctx.config, Datasets=[dict(dsd, Style='bibo') for dsd in ctx.config['Datasets']])
+        self.assertNotEqual(fingerprint, ctx.get_dataset_fingerprint('demo'))
+
+    def test_get_opened_dataset_fingerprint(self):
+        ctx = new_test_service_context()
+        self.assertNotIn('demo', ctx.dataset_cache)
+        fingerprint = ctx.get_opened_dataset_fingerprint('demo')
+        self.assertIn('demo', ctx.dataset_cache)
+        self.assertEqual(ctx.get_dataset_fingerprint('demo'), fingerprint)
+
+        # The opened dataset keeps its fingerprint, even if its configuration changes
+        ctx.config = dict(ctx.config, Datasets=[dict(dsd, Style='bibo') for dsd in ctx.config['Datasets']])
+        self.assertEqual(fingerprint, ctx.get_opened_dataset_fingerprint('demo'))
+        self.assertNotEqual(fingerprint, ctx.get_dataset_fingerprint('demo'))
+
+    def test_get_dataset_version(self):
+        ctx = new_test_service_context()
+        ds_version = ctx.get_dataset_version('demo')
+        self.assertIsInstance(ds_version, str)
+        self.assertEqual(16, len(ds_version))
+        self.assertTrue(ctx.get_opened_dataset_fingerprint('demo').startswith(ds_version))
+        self.assertNotEqual(ds_version, ctx.get_dataset_version('demo-1w'))
+
+        # Reopened datasets with a changed configuration have a new version
+        config = ctx.config
+        ctx.config = dict(config, Datasets=[dict(dsd, Style='bibo') for dsd in config['Datasets']
+                                            if dsd['Identifier'] != 'demo'])
+        ctx.config = dict(config, Datasets=[dict(dsd, Style='bibo') for dsd in config['Datasets']])
+        self.assertNotEqual(ds_version, ctx.get_dataset_version('demo'))
+
+    def test_get_tile_max_age(self):
+        ctx = new_test_service_context()
+        self.assertEqual(600, ctx.get_tile_max_age())
+        self.assertEqual(600, ctx.get_tile_max_age('demo'))
+        ctx.config = dict(ctx.config, TileMaxAge=60,
+                          Datasets=[dict(dsd, TileMaxAge=0) if dsd['Identifier'] == 'demo' else dsd
+                                    for dsd in ctx.config['Datasets']])
+        self.assertEqual(60, ctx.get_tile_max_age())
+        self.assertEqual(0, ctx.get_tile_max_age('demo'))
+        self.assertEqual(60, ctx.get_tile_max_age('demo-1w'))
+
+        ctx.config = dict(ctx.config, TileMaxAge='1h')
+        with self.assertRaises(ServiceConfigError):
+            ctx.get_tile_max_age()
+
+    def test_get_tile_encoding(self):
+        ctx = new_test_service_context()
+        self.assertEqual(TileEncoding('PNG'), ctx.get_tile_encoding('demo', 'png'))
+        self.assertEqual(TileEncoding('JPEG'), ctx.get_tile_encoding('demo', 'jpg'))
+        self.assertIsNone(ctx.get_tile_encoding('demo', 'gif'))
+
+        ctx.config = dict(ctx.config,
+                          TileEncodings=dict(PNG=dict(CompressLevel=1), WebP=dict(Lossless=True, Quality=50)),
+                          Datasets=[dict(dsd, TileEncodings=dict(webp=dict(Quality=100)))
+                                    if dsd['Identifier'] == 'demo' else dsd
+                                    for dsd in ctx.config['Datasets']])
+        self.assertEqual(TileEncoding('PNG', compress_level=1), ctx.get_tile_encoding('demo', 'png'))
+        self.assertEqual(TileEncoding('WEBP', lossless=True, quality=100), ctx.get_tile_encoding('demo', 'webp'))
+        self.assertEqual(TileEncoding('WEBP', lossless=True, quality=50), ctx.get_tile_encoding('demo-1w', 'webp'))
+        self.assertEqual(TileEncoding('WEBP', lossless=True, quality=50), ctx.get_tile_encoding(None, 'webp'))
+
+        ctx.config = dict(ctx.config, TileEncodings=dict(PNG=dict(CompressLevel=10)))
+        with self.assertRaises(ServiceConfigError):
+            ctx.get_tile_encoding(None, 'png')
+        ctx.config = dict(ctx.config, TileEncodings=dict(JPEG=dict(Lossless=True)))
+        with self.assertRaises(ServiceConfigError):
+            ctx.get_tile_encoding(None, 'jpg')
+
+        ctx.config = dict(ctx.config, TileEncodings=dict(PNG=dict(Adaptive=True, FastCompressLevel=2)))
+        encoding = ctx.get_tile_encoding(None, 'png')
+        self.assertIsInstance(encoding, AdaptiveTileEncoding)
+        self.assertEqual(dict(compress_level=9), encoding.options)
+        self.assertEqual('png-compress_level=9-adaptive-compress_level=2', encoding.id)
+        ctx.config = dict(ctx.config, TileEncodings=dict(PNG=dict(Adaptive=True, FastCompressLevel=-1)))
+        with self.assertRaises(ServiceConfigError):
+            ctx.get_tile_encoding(None, 'png')
+
+    def test_get_palette_tiles(self):
+        ctx = new_test_service_context()
+        self.assertTrue(ctx.get_palette_tiles())
+        ctx.config = dict(ctx.config, PaletteTiles=False)
+        self.assertFalse(ctx.get_palette_tiles())
+
+        ctx.config = dict(ctx.config, PaletteTiles='no')
+        with self.assertRaises(ServiceConfigError):
+            ctx.get_palette_tiles()
+
+    def test_write_and_read_tile_cache_snapshots(self):
+        ctx = new_test_service_context()
+        snapshot_path = os.path.join(ctx.base_dir, '.snapshots', 'array-tiles.snapshot')
+        shutil.rmtree(os.path.dirname(snapshot_path), ignore_errors=True)
+        try:
+            config = dict(ctx.config,
+                          TileCaches=dict(ArrayTiles=dict(Snapshot=dict(Path='.snapshots/array-tiles.snapshot',
+                                                                        Fraction=1.0))))
+            ctx.config = config
+            tile = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock())
+            tile_ids = list(ctx.mem_tile_cache.shards[0]._item_dict.keys())
+            for shard in ctx.mem_tile_cache.shards[1:]:
+                tile_ids.extend(shard._item_dict.keys())
+            self.assertEqual(1, len(tile_ids))
+            self.assertEqual('demo', ctx.get_tile_dataset_name(tile_ids[0]))
+            ctx.write_tile_cache_snapshots()
+            self.assertTrue(os.path.isfile(snapshot_path))
+
+            ctx = new_test_service_context()
+            ctx.config = config
+            ctx.read_tile_cache_snapshots()
+            self.assertTrue(ctx.mem_tile_cache.has_value(tile_ids[0]))
+            self.assertEqual('demo', ctx.get_tile_dataset_name(tile_ids[0]))
+            self.assertEqual(tile, get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock()))
+            self.assertEqual(1, ctx.mem_tile_cache.get_stats()['hits'])
+
+            # Tiles are tagged with the fingerprint of the opened dataset, even if the dataset changes meanwhile
+            ctx.config = dict(config, Datasets=[dict(dsd, Style='bibo') for dsd in config['Datasets']])
+            self.assertIn('demo', ctx.dataset_cache)
+            ctx.write_tile_cache_snapshots()
+            ctx = new_test_service_context()
+            ctx.config = config
+            ctx.read_tile_cache_snapshots()
+            self.assertTrue(ctx.mem_tile_cache.has_value(tile_ids[0]))
+
+            # Tiles of changed datasets are skipped
+            ctx = new_test_service_context()
+            ctx.config = dict(config, Datasets=[dict(dsd, Style='bibo') for dsd in config['Datasets']])
+            ctx.read_tile_cache_snapshots()
+            self.assertFalse(ctx.mem_tile_cache.has_value(tile_ids[0]))
+        finally:
+            shutil.rmtree(os.path.dirname(snapshot_path), ignore_errors=True)
@@ -1,7 +1,11 @@
+import json
+import unittest
+
 from tornado.testing import AsyncHTTPTestCase
 
 from test.helpers import new_test_service_context
 from xcube_server.app import new_application
+from xcube_server.handlers import get_accepted_tile_format
 # For usage of the tornado.testing.AsyncHTTPTestCase see http://www.tornadoweb.org/en/stable/testing.html
 from xcube_server.defaults import API_PREFIX, DEFAULT_NAME
 
@@ -83,7 +87,8 @@ class HandlersTest(AsyncHTTPTestCase):
                                             '&TileMatrix=0'
                                             '&TileRow=0'
                                             '&TileCol=0')
-        self.assertBadRequestResponse(response, 'Value for "format" parameter must be "image/png"')
+        self.assertBadRequestResponse(response, 'Value for "format" parameter must be one of '
+                                                '"image/png", "image/webp", "image/jpeg"')
 
         response = self.fetch(self.prefix + '/wmts/kvp'
                                             '?Service=WMTS'
@@ -127,6 +132,75 @@ class HandlersTest(AsyncHTTPTestCase):
         response = self.fetch(self.prefix + '/tile/demo/conc_chl/0/0/0.png')
         self.assertResponseOK(response)
 
+    def test_fetch_dataset_tile_not_modified(self):
+        response = self.fetch(self.prefix + '/tile/demo/conc_chl/0/0/0.png')
+        self.assertResponseOK(response)
+        etag = response.headers.get('ETag')
+        self.assertIsNotNone(etag)
+        self.assertEqual('max-age=600', response.headers.get('Cache-Control'))
+
+        response = self.fetch(self.prefix + '/tile/demo/conc_chl/0/0/0.png', headers={'If-None-Match': etag})
+        self.assertEqual(304, response.code)
+        self.assertEqual(b'', response.body)
+        self.assertEqual(etag, response.headers.get('ETag'))
+
+        response = self.fetch(self.prefix + '/tile/demo/conc_chl/0/0/0.png?cbar=jet', headers={'If-None-Match': etag})
+        self.assertResponseOK(response)
+        self.assertNotEqual(etag, response.headers.get('ETag'))
+
+    def test_fetch_versioned_dataset_tile(self):
+        response = self.fetch(self.prefix + '/tilegrid/demo/conc_chl/ol4')
+        self.assertResponseOK(response)
+        url = json.loads(response.body.decode('utf-8'))['url']
+        ds_version = url.split('/')[-4]
+        self.assertNotEqual('conc_chl', ds_version)
+
+        response = self.fetch(self.prefix + f'/tile/demo/conc_chl/{ds_version}/0/0/0.png')
+        self.assertResponseOK(response)
+        self.assertEqual('public, max-age=31536000, immutable', response.headers.get('Cache-Control'))
+        etag = response.headers.get('ETag')
+
+        response = self.fetch(self.prefix + f'/wmts/1.0.0/tile/demo/conc_chl/{ds_version}/0/0/0.png')
+        self.assertResponseOK(response)
+        self.assertEqual('public, max-age=31536000, immutable', response.headers.get('Cache-Control'))
+        self.assertEqual(etag, response.headers.get('ETag'))
+
+        # Outdated versions are served the current tile, but not as immutable
+        response = self.fetch(self.prefix + '/tile/demo/conc_chl/0123456789abcdef/0/0/0.png')
+        self.assertResponseOK(response)
+        self.assertEqual('max-age=600', response.headers.get('Cache-Control'))
+        self.assertEqual(etag, response.headers.get('ETag'))
+
+    def test_fetch_dataset_tile_formats(self):
+        response = self.fetch(self.prefix + '/tile/demo/conc_chl/0/0/0.png')
+        self.assertResponseOK(response)
+        self.assertEqual('image/png', response.headers.get('Content-Type'))
+        etag = response.headers.get('ETag')
+
+        response = self.fetch(self.prefix + '/tile/demo/conc_chl/0/0/0.webp')
+        self.assertResponseOK(response)
+        self.assertEqual('image/webp', response.headers.get('Content-Type'))
+        self.assertEqual(b'RIFF', response.body[0:4])
+        self.assertNotEqual(etag, response.headers.get('ETag'))
+
+        response = self.fetch(self.prefix + '/wmts/1.0.0/tile/demo/conc_chl/0/0/0.jpg')
+        self.assertResponseOK(response)
+        self.assertEqual('image/jpeg', response.headers.get('Content-Type'))
+
+        response = self.fetch(self.prefix + '/tile/demo/conc_chl/0/0/0.gif')
+        self.assertBadRequestResponse(response, 'Unsupported tile format "gif"')
+
+    def test_fetch_dataset_tile_with_accept_header(self):
+        response = self.fetch(self.prefix + '/tile/demo/conc_chl/0/0/0',
+                              headers={'Accept': 'image/avif,image/webp,*/*'})
+        self.assertResponseOK(response)
+        self.assertEqual('image/webp', response.headers.get('Content-Type'))
+        self.assertEqual('Accept', response.headers.get('Vary'))
+
+        response = self.fetch(self.prefix + '/tile/demo/conc_chl/0/0/0')
+        self.assertResponseOK(response)
+        self.assertEqual('image/png', response.headers.get('Content-Type'))
+
     def test_fetch_dataset_tile_with_params(self):
         response = self.fetch(self.prefix + '/tile/demo/conc_chl/0/0/0.png?time=current&cbar=jet')
         self.assertResponseOK(response)
@@ -143,6 +217,14 @@ class HandlersTest(AsyncHTTPTestCase):
         response = self.fetch(self.prefix + '/tile/ne2/0/0/0.jpg')
         self.assertResponseOK(response)
 
+    def test_fetch_ne2_tile_not_modified(self):
+        response = self.fetch(self.prefix + '/tile/ne2/0/0/0.jpg')
+        self.assertResponseOK(response)
+        etag = response.headers.get('ETag')
+        self.assertIsNotNone(etag)
+        response = self.fetch(self.prefix + '/tile/ne2/0/0/0.jpg', headers={'If-None-Match': etag})
+        self.assertEqual(304, response.code)
+
     def test_fetch_ne2_tile_grid(self):
         response = self.fetch(self.prefix + '/tilegrid/ne2/ol4')
         self.assertResponseOK(response)
@@ -151,6 +233,12 @@ class HandlersTest(AsyncHTTPTestCase):
         response = self.fetch(self.prefix + '/datasets')
         self.assertResponseOK(response)
 
+    def test_fetch_caches_json(self):
+        response = self.fetch(self.prefix + '/caches')
+        self.assertResponseOK(response)
+        caches = json.loads(response.body.decode('utf-8'))['caches']
+        self.assertEqual('mem_tile_cache', caches[0]['name'])
+
     def test_fetch_variables_json(self):
         response = self.fetch(self.prefix + '/variables/demo')
         self.assertResponseOK(response)
@@ -259,3 +347,14 @@ class HandlersTest(AsyncHTTPTestCase):
     @property
     def prefix(self):
         return f"/{DEFAULT_NAME}{API_PREFIX}"
+
+
+class GetAcceptedTileFormatTest(unittest.TestCase):
+
+    def test_get_accepted_tile_format(self):
+        self.assertEqual('png', get_accepted_tile_format(None))
+        self.assertEqual('png', get_accepted_tile_format('image/png,*/*;q=0.8'))
+        self.assertEqual('webp', get_accepted_tile_format('image/avif,image/webp,image/apng,*/*;q=0.8'))
+        self.assertEqual('webp', get_accepted_tile_format('image/WebP; q=0.5'))
+        self.assertEqual('png', get_accepted_tile_format('image/webp;q=0,image/*'))
+        self.assertEqual('png', get_accepted_tile_format('image/jpeg'))
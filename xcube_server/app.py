@@ -34,7 +34,7 @@ from xcube_server.handlers import GetTileNE2Handler, GetTileDatasetHandler, Info
     GetDatasetsJsonHandler, FindFeaturesHandler, FindDatasetFeaturesHandler, GetVariablesJsonHandler, \
     GetCoordinatesJsonHandler, TimeSeriesInfoHandler, TimeSeriesForPointHandler, WMTSKvpHandler, \
     TimeSeriesForGeometryHandler, TimeSeriesForFeaturesHandler, TimeSeriesForGeometriesHandler, \
-    GetFeatureCollectionsHandler, GetLegendHandler
+    GetFeatureCollectionsHandler, GetLegendHandler, GetCachesJsonHandler
 from xcube_server.service import url_pattern, Service
 
 __author__ = "Norman Fomferra (Brockmann Consult GmbH)"
@@ -47,9 +47,19 @@ def new_application(name: str=DEFAULT_NAME):
         (prefix + url_pattern('/'), InfoHandler),
         (prefix + url_pattern('/wmts/kvp'), WMTSKvpHandler),
         (prefix + url_pattern('/wmts/1.0.0/WMTSCapabilities.xml'), GetWMTSCapabilitiesXmlHandler),
-        (prefix + url_pattern('/wmts/1.0.0/tile/{{ds_name}}/{{var_name}}/{{z}}/{{y}}/{{x}}.png'),
+        (prefix + url_pattern('/wmts/1.0.0/tile/{{ds_name}}/{{var_name}}/{{z}}/{{y}}/{{x}}\\.{{tile_format}}'),
+         GetTileDatasetHandler),
+        (prefix + url_pattern('/wmts/1.0.0/tile/{{ds_name}}/{{var_name}}/{{ds_version}}/{{z}}/{{y}}/{{x}}'
+                              '\\.{{tile_format}}'),
+         GetTileDatasetHandler),
+        (prefix + url_pattern('/tile/{{ds_name}}/{{var_name}}/{{z}}/{{x}}/{{y}}\\.{{tile_format}}'),
+         GetTileDatasetHandler),
+        (prefix + url_pattern('/tile/{{ds_name}}/{{var_name}}/{{ds_version}}/{{z}}/{{x}}/{{y}}\\.{{tile_format}}'),
+         GetTileDatasetHandler),
+        # Tile format negotiated by "Accept" header
+        (prefix + url_pattern('/tile/{{ds_name}}/{{var_name}}/{{z}}/{{x}}/{{y}}'), GetTileDatasetHandler),
+        (prefix + url_pattern('/tile/{{ds_name}}/{{var_name}}/{{ds_version}}/{{z}}/{{x}}/{{y}}'),
          GetTileDatasetHandler),
-        (prefix + url_pattern('/tile/{{ds_name}}/{{var_name}}/{{z}}/{{x}}/{{y}}.png'), GetTileDatasetHandler),
         (prefix + url_pattern('/tile/ne2/{{z}}/{{x}}/{{y}}.jpg'), GetTileNE2Handler),
         (prefix + url_pattern('/tilegrid/{{ds_name}}/{{var_name}}/{{format_name}}'), GetTileGridDatasetHandler),
         (prefix + url_pattern('/tilegrid/ne2/{{format_name}}'), GetTileGridNE2Handler),
@@ -59,6 +69,7 @@ def new_application(name: str=DEFAULT_NAME):
         (prefix + url_pattern('/legend/{{ds_name}}/{{var_name}}.png'), GetLegendHandler),
         (prefix + url_pattern('/colorbars'), GetColorBarsJsonHandler),
         (prefix + url_pattern('/colorbars.html'), GetColorBarsHtmlHandler),
+        (prefix + url_pattern('/caches'), GetCachesJsonHandler),
         (prefix + url_pattern('/ts'), TimeSeriesInfoHandler),
         (prefix + url_pattern('/ts/{{ds_name}}/{{var_name}}/point'), TimeSeriesForPointHandler),
         (prefix + url_pattern('/ts/{{ds_name}}/{{var_name}}/geometry'), TimeSeriesForGeometryHandler),
@@ -20,18 +20,45 @@
 # SOFTWARE.
 
 
+import bisect
+import hashlib
+import io
+import heapq
+import itertools
+import json
+import logging
+import math
+import mmap
 import os
 import os.path
+import queue
+import random
+import struct
 import sys
+import threading
 import time
+import urllib.parse
+import uuid
 from abc import ABCMeta, abstractmethod
-from threading import RLock
+from collections import OrderedDict
+from threading import Event, Lock, RLock
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numcodecs
+import numpy as np
 
 __author__ = "Norman Fomferra (Brockmann Consult GmbH)"
 
 # _DEBUG_CACHE = True
 _DEBUG_CACHE = False
 
+_LOG = logging.getLogger('xcube')
+
+_TEMP_FILE_EXT = '.tmp'
+
+_SNAPSHOT_MAGIC = b'XCSNAP01'
+_SNAPSHOT_ALIGNMENT = 64
+
 
 class CacheStore(metaclass=ABCMeta):
     """
@@ -85,6 +112,42 @@ class CacheStore(metaclass=ABCMeta):
         """
         pass
 
+    def scan_values(self) -> Iterator[Tuple[Any, Any, Any]]:
+        """
+        Scan the values already held by this store, e.g. values stored by a previous server run.
+        Values should be generated in the order they have last been used, oldest first.
+        The default implementation generates nothing.
+
+        :return: an iterator of (key, stored_value, stored_size) triples
+        """
+        return iter(())
+
+    def snapshot_value(self, key, stored_value) -> Optional[Tuple[Dict[str, Any], List[Any]]]:
+        """
+        Get a JSON-serializable description of a stored value and the buffers holding its data,
+        so that it can be written to a cache snapshot, see :py:meth:`Cache.write_snapshot`.
+        The default implementation returns None, that is, values of this store are not written to snapshots.
+
+        :param key: the key
+        :param stored_value: the stored representation of the value
+        :return: a 2-element sequence containing the description and a list of buffers, or None
+        """
+        return None
+
+    def load_snapshot_value(self, key, info: Dict[str, Any], buffers: List[memoryview]):
+        """
+        Load a stored value representation from a description and buffers returned by :py:meth:`snapshot_value`.
+        The buffers are copy-on-write views into a memory-mapped snapshot file, so their data is only read
+        from disk when it is used.
+
+        :param key: the key
+        :param info: the description of the value
+        :param buffers: the buffers holding the value's data
+        :return: a 2-element sequence containing the stored representation of the value and it's size
+        :raise ValueError: if the value cannot be loaded by this store
+        """
+        raise ValueError(f'{type(self).__name__} does not support snapshots')
+
 
 class MemoryCacheStore(CacheStore):
     """
@@ -127,49 +190,1040 @@ class MemoryCacheStore(CacheStore):
             raise ValueError('key does not match stored value')
         stored_value[1] = None
 
+    def snapshot_value(self, key, stored_value):
+        """
+        Numpy arrays and byte strings can be written to snapshots.
+        :param key: the key
+        :param stored_value: the stored representation of the value
+        :return: the description of the value and its buffers, or None
+        """
+        return _snapshot_plain_value(stored_value[1])
+
+    def load_snapshot_value(self, key, info, buffers):
+        """
+        Numpy arrays are loaded as memory-mapped arrays, byte strings as memory views.
+        :param key: the key
+        :param info: the description of the value
+        :param buffers: the buffers holding the value's data
+        :return: the tuple (stored value, size)
+        """
+        value = _load_snapshot_plain_value(info, buffers)
+        return [key, value], _compute_object_size(value)
+
+
+class CompressedMemoryCacheStore(CacheStore):
+    """
+    Memory store for numpy arrays, e.g. raw array tiles, which keeps the arrays compressed.
+    The data and the mask of masked arrays are compressed separately, the mask as a bit array.
+    The stored size is the number of compressed bytes.
+    Values that are not numeric numpy arrays are stored as-is.
+
+    :param codec: a numcodecs codec, defaults to Blosc with LZ4 compression and byte shuffling
+    """
+
+    def __init__(self, codec=None):
+        if codec is None:
+            codec = numcodecs.Blosc(cname='lz4', clevel=5, shuffle=numcodecs.Blosc.SHUFFLE)
+        self._codec = codec
+
+    def can_load_from_key(self, key) -> bool:
+        # This store type does not maintain key-value pairs on its own
+        return False
+
+    def load_from_key(self, key):
+        raise NotImplementedError()
+
+    def store_value(self, key, value):
+        """
+        :param key: the key
+        :param value: the original value
+        :return: the tuple (stored value, size) where stored value is the sequence [key, compressed value].
+        """
+        if not isinstance(value, np.ndarray) or value.dtype.hasobject:
+            return [key, value], _compute_object_size(value)
+
+        data = np.ascontiguousarray(np.ma.getdata(value))
+        encoded_data = self._codec.encode(data)
+        size = len(encoded_data)
+        encoded_mask = None
+        fill_value = None
+        is_masked = isinstance(value, np.ma.MaskedArray)
+        if is_masked:
+            fill_value = value.fill_value
+            mask = np.ma.getmask(value)
+            if mask is not np.ma.nomask:
+                encoded_mask = self._codec.encode(np.packbits(mask, axis=None))
+                size += len(encoded_mask)
+        return [key, (data.dtype, data.shape, encoded_data, is_masked, encoded_mask, fill_value)], size
+
+    def restore_value(self, key, stored_value):
+        """
+        :param key: the key
+        :param stored_value: the stored representation of the value
+        :return: the original value.
+        """
+        if key != stored_value[0]:
+            raise ValueError('key does not match stored value')
+        compressed_value = stored_value[1]
+        if not isinstance(compressed_value, tuple):
+            return compressed_value
+        dtype, shape, encoded_data, is_masked, encoded_mask, fill_value = compressed_value
+        data = np.empty(shape, dtype=dtype)
+        self._codec.decode(encoded_data, out=data)
+        if not is_masked:
+            return data
+        if encoded_mask is None:
+            mask = np.ma.nomask
+        else:
+            num_elements = data.size
+            packed_mask = np.empty((num_elements + 7) // 8, dtype=np.uint8)
+            self._codec.decode(encoded_mask, out=packed_mask)
+            mask = np.unpackbits(packed_mask)[:num_elements].view(np.bool_).reshape(shape)
+        return np.ma.MaskedArray(data, mask=mask, fill_value=fill_value)
+
+    def discard_value(self, key, stored_value):
+        """
+        Clears the value in the given stored_value.
+        :param key: the key
+        :param stored_value: the stored representation of the value
+        """
+        if key != stored_value[0]:
+            raise ValueError('key does not match stored value')
+        stored_value[1] = None
+
+    def snapshot_value(self, key, stored_value):
+        """
+        Compressed arrays are written as-is, together with the codec configuration.
+        :param key: the key
+        :param stored_value: the stored representation of the value
+        :return: the description of the value and its buffers, or None
+        """
+        compressed_value = stored_value[1]
+        if not isinstance(compressed_value, tuple):
+            return _snapshot_plain_value(compressed_value)
+        dtype, shape, encoded_data, is_masked, encoded_mask, fill_value = compressed_value
+        info = dict(type='compressed',
+                    codec=self._codec.get_config(),
+                    dtype=dtype.str,
+                    shape=list(shape),
+                    masked=is_masked,
+                    fill_value=_to_json_scalar(fill_value))
+        buffers = [encoded_data] if encoded_mask is None else [encoded_data, encoded_mask]
+        return info, buffers
+
+    def load_snapshot_value(self, key, info, buffers):
+        """
+        Compressed arrays are decompressed from the snapshot file only when they are restored.
+        :param key: the key
+        :param info: the description of the value
+        :param buffers: the buffers holding the value's data
+        :return: the tuple (stored value, size)
+        """
+        if info['type'] != 'compressed':
+            value = _load_snapshot_plain_value(info, buffers)
+            return [key, value], _compute_object_size(value)
+        if info['codec'] != self._codec.get_config():
+            raise ValueError('snapshot value has been compressed by a different codec')
+        encoded_data = buffers[0]
+        encoded_mask = buffers[1] if len(buffers) > 1 else None
+        compressed_value = (np.dtype(info['dtype']), tuple(info['shape']), encoded_data,
+                            info['masked'], encoded_mask, info['fill_value'])
+        return [key, compressed_value], sum(len(buffer) for buffer in buffers)
+
 
 class FileCacheStore(CacheStore):
     """
     Simple file store for values which can be written and read as bytes, e.g. encoded PNG images.
+
+    Files are written to temporary files first and then renamed, so that readers never see partially
+    written files.
+
+    The store keeps an in-memory index of the keys and sizes of the files it holds. The index is
+    populated by :py:meth:`scan_values`, which should be called once at startup, e.g. by :py:meth:`Cache.recover`.
+    Until the scan has completed, key lookups fall back to testing the existence of files.
+
+    :param cache_dir: the cache directory
+    :param ext: the filename extension
+    :param sharded: if True, files are stored in a two-level directory hierarchy derived from the hash of their keys,
+           which keeps directories small. Otherwise a key is used as relative path of its file.
+    :param write_behind: if True, files are written by a background thread and :py:meth:`store_value`
+           returns immediately. Values are served from memory until they have been written.
     """
 
-    def __init__(self, cache_dir: str, ext: str):
+    def __init__(self, cache_dir: str, ext: str, sharded: bool = False, write_behind: bool = False):
         self.cache_dir = cache_dir
         self.ext = ext
+        self.sharded = sharded
+        self.write_behind = write_behind
+        self._index = dict()
+        self._index_complete = False
+        self._scan_touched_keys = None
+        self._pending_values = dict()
+        self._write_queue = queue.Queue() if write_behind else None
+        self._writer_thread = None
+        self._lock = Lock()
+
+    @property
+    def index_complete(self) -> bool:
+        """ True, if the index has been fully populated by :py:meth:`scan_values`. """
+        return self._index_complete
+
+    @property
+    def num_pending_writes(self) -> int:
+        """ Number of values not yet written to files. Always zero, if *write_behind* is False. """
+        return len(self._pending_values)
 
     def can_load_from_key(self, key) -> bool:
+        with self._lock:
+            if key in self._index:
+                return True
+            if self._index_complete:
+                return False
         path = self._key_to_path(key)
         return os.path.exists(path)
 
     def load_from_key(self, key):
         path = self._key_to_path(key)
-        return path, os.path.getsize(path)
+        with self._lock:
+            size = self._index.get(key)
+        if size is None:
+            size = os.path.getsize(path)
+        return path, size
 
     def store_value(self, key, value):
         path = self._key_to_path(key)
-        dir_path = os.path.dirname(path)
-        if not os.path.exists(dir_path):
-            os.makedirs(dir_path, exist_ok=True)
-        with open(path, 'wb') as fp:
-            fp.write(value)
-        return path, os.path.getsize(path)
+        data = self._encode_value(value)
+        size = len(data)
+        if self.write_behind:
+            with self._lock:
+                self._pending_values[key] = value
+                self._index[key] = size
+                self._touch_key(key)
+                self._ensure_writer_thread()
+            self._write_queue.put((key, value, data))
+            return path, size
+        self._write_file(path, data)
+        with self._lock:
+            self._index[key] = size
+            self._touch_key(key)
+        return path, size
 
     def restore_value(self, key, stored_value):
+        if self.write_behind:
+            with self._lock:
+                value = self._pending_values.get(key)
+            if value is not None:
+                return value
+        return self._read_file(self._key_to_path(key))
+
+    def discard_value(self, key, stored_value):
         path = self._key_to_path(key)
+        # Removing the file while holding the lock prevents the writer thread from re-creating it
+        with self._lock:
+            self._pending_values.pop(key, None)
+            self._index.pop(key, None)
+            self._touch_key(key)
+            try:
+                os.remove(path)
+            except OSError:
+                return
+        self._remove_empty_dirs(os.path.dirname(path))
+
+    def flush(self):
+        """
+        Block until all pending values have been written. Does nothing, if *write_behind* is False.
+        """
+        if self._write_queue is not None:
+            self._write_queue.join()
+
+    def scan_values(self):
+        """
+        Scan the cache directory for files stored by a previous server run and build the in-memory index.
+        Files are generated in order of their modification times, oldest first.
+        Keys stored or discarded while the scan is in progress take precedence over scanned ones.
+        Temporary files left over from interrupted writes are removed.
+
+        :return: an iterator of (key, stored_value, stored_size) triples
+        """
+        with self._lock:
+            self._scan_touched_keys = set()
+        entries = []
+        if os.path.isdir(self.cache_dir):
+            for path, stat in _scan_files(self.cache_dir):
+                if path.endswith(self.ext):
+                    entries.append((stat.st_mtime, self._path_to_key(path), path, stat.st_size))
+                elif path.endswith(_TEMP_FILE_EXT) and time.time() - stat.st_mtime > 60:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+        entries.sort(key=lambda entry: entry[0])
+        with self._lock:
+            touched_keys = self._scan_touched_keys
+            entries = [entry for entry in entries if entry[1] not in touched_keys]
+            for _, key, _, size in entries:
+                self._index[key] = size
+            self._scan_touched_keys = None
+            self._index_complete = True
+        return iter([(key, path, size) for _, key, path, size in entries])
+
+    def _touch_key(self, key):
+        if self._scan_touched_keys is not None:
+            self._scan_touched_keys.add(key)
+
+    def _ensure_writer_thread(self):
+        if self._writer_thread is None:
+            self._writer_thread = threading.Thread(target=self._run_writer,
+                                                   name='xcube-file-cache-writer',
+                                                   daemon=True)
+            self._writer_thread.start()
+
+    def _encode_value(self, value):
+        """
+        Encode *value* into the bytes to be written. May be overridden by subclasses.
+        :return: a bytes-like object
+        """
+        return value
+
+    def _read_file(self, path):
+        """
+        Read a value from the file at *path*. May be overridden by subclasses.
+        :raise OSError: if the file cannot be read
+        """
         with open(path, 'rb') as fp:
             return fp.read()
 
-    def discard_value(self, key, stored_value):
+    def _run_writer(self):
+        while True:
+            key, value, data = self._write_queue.get()
+            try:
+                self._write_pending_value(key, value, data)
+            except OSError as error:
+                _LOG.error(f'failed to write cached value for key {key!r}: {error}')
+                with self._lock:
+                    if self._pending_values.get(key) is value:
+                        del self._pending_values[key]
+                        self._index.pop(key, None)
+            finally:
+                self._write_queue.task_done()
+
+    def _write_pending_value(self, key, value, data):
+        with self._lock:
+            if self._pending_values.get(key) is not value:
+                # discarded or superseded in the meantime
+                return
         path = self._key_to_path(key)
-        try:
-            os.remove(path)
-            # TODO (forman): also remove empty directories up to self.cache_dir
-        except IOError:
-            pass
+        temp_path = self._write_temp_file(path, data)
+        with self._lock:
+            if self._pending_values.get(key) is value:
+                os.replace(temp_path, path)
+                del self._pending_values[key]
+                return
+        os.remove(temp_path)
+
+    def _write_file(self, path, value):
+        temp_path = self._write_temp_file(path, value)
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def _write_temp_file(path, value) -> str:
+        dir_path = os.path.dirname(path)
+        temp_path = '%s.%s%s' % (path, uuid.uuid4().hex, _TEMP_FILE_EXT)
+        for _ in range(3):
+            os.makedirs(dir_path, exist_ok=True)
+            try:
+                with open(temp_path, 'wb') as fp:
+                    fp.write(value)
+                return temp_path
+            except FileNotFoundError:
+                # directory has just been removed by a concurrent discard, try again
+                pass
+        raise FileNotFoundError(f'failed to create {temp_path!r}')
+
+    def _remove_empty_dirs(self, dir_path):
+        cache_dir = os.path.abspath(self.cache_dir)
+        dir_path = os.path.abspath(dir_path)
+        while dir_path != cache_dir and dir_path.startswith(cache_dir):
+            try:
+                os.rmdir(dir_path)
+            except OSError:
+                # not empty
+                break
+            dir_path = os.path.dirname(dir_path)
 
     def _key_to_path(self, key):
+        if self.sharded:
+            key = str(key)
+            digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+            return os.path.join(self.cache_dir, digest[0:2], digest[2:4], urllib.parse.quote(key, safe='') + self.ext)
         return os.path.join(self.cache_dir, str(key) + self.ext)
 
+    def _path_to_key(self, path):
+        if self.sharded:
+            file_name = os.path.basename(path)
+            return urllib.parse.unquote(file_name[:-len(self.ext)] if self.ext else file_name)
+        rel_path = os.path.relpath(path, self.cache_dir)
+        return rel_path[:-len(self.ext)].replace(os.sep, '/') if self.ext else rel_path.replace(os.sep, '/')
+
+
+class NpyFileCacheStore(FileCacheStore):
+    """
+    File store for numpy arrays, e.g. raw array tiles, using the NumPy ``.npy`` format.
+    The mask of a masked array is appended to the same file as a second ``.npy`` array.
+
+    Restored arrays are copy-on-write memory maps of the files, so restoring a value does not read it
+    until it is actually used, and modifying it never modifies the file.
+
+    :param cache_dir: the cache directory
+    :param sharded: if True, files are stored in a two-level directory hierarchy derived from the hash of their keys
+    :param write_behind: if True, files are written by a background thread
+    """
+
+    def __init__(self, cache_dir: str, sharded: bool = True, write_behind: bool = False):
+        super().__init__(cache_dir, '.npy', sharded=sharded, write_behind=write_behind)
+
+    def _encode_value(self, value):
+        buffer = io.BytesIO()
+        np.lib.format.write_array(buffer, np.ascontiguousarray(np.ma.getdata(value)), allow_pickle=False)
+        if isinstance(value, np.ma.MaskedArray):
+            np.lib.format.write_array(buffer, np.ma.getmaskarray(value), allow_pickle=False)
+        return buffer.getbuffer()
+
+    def _read_file(self, path):
+        arrays = []
+        file_size = os.path.getsize(path)
+        with open(path, 'rb') as fp:
+            while fp.tell() < file_size:
+                version = np.lib.format.read_magic(fp)
+                if version == (1, 0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fp)
+                else:
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fp)
+                offset = fp.tell()
+                num_bytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+                if num_bytes == 0:
+                    array = np.empty(shape, dtype=dtype)
+                else:
+                    array = np.memmap(path, dtype=dtype, mode='c', offset=offset, shape=shape,
+                                      order='F' if fortran_order else 'C')
+                arrays.append(array)
+                fp.seek(offset + num_bytes)
+        if len(arrays) == 2:
+            return np.ma.MaskedArray(arrays[0], mask=arrays[1])
+        return arrays[0]
+
+
+class PackCacheStore(CacheStore):
+    """
+    A store for values which can be written and read as bytes, e.g. encoded PNG images, that appends values
+    to large pack files instead of writing one file per value.
+
+    A pack record comprises the key's length as 16-bit integer, the UTF-8 encoded key, and the value bytes.
+    The location of a key's current record is kept in an append-only index file of fixed-size records, which is
+    memory-mapped and replayed when the store is opened, so that the store survives restarts.
+    Restored values are zero-copy memoryviews into memory-mapped pack files.
+
+    Discarded values leave garbage in the pack files. If the garbage exceeds *compaction_threshold* of the
+    total pack size, the live records of all completed pack files are copied into new ones by a background
+    thread, see :py:meth:`compact`.
+
+    :param pack_dir: the directory that holds the pack and index files
+    :param max_pack_size: the size in bytes after which a new pack file is started
+    :param compaction_threshold: the ratio of garbage bytes to total pack bytes that triggers a compaction
+    :param min_compaction_size: the minimum number of garbage bytes that triggers a compaction
+    """
+
+    # key digest, pack number, record offset, key length, value length, flags
+    _INDEX_RECORD = struct.Struct('<16sIQHIH')
+    _INDEX_FILE_NAME = 'index.dat'
+    _PACK_FILE_PREFIX = 'pack-'
+    _PACK_FILE_EXT = '.dat'
+    _KEY_HEADER = struct.Struct('<H')
+    _FLAG_DELETED = 1
+
+    def __init__(self,
+                 pack_dir: str,
+                 max_pack_size: int = 256 * 1024 * 1024,
+                 compaction_threshold: float = 0.5,
+                 min_compaction_size: int = 16 * 1024 * 1024):
+        self.pack_dir = pack_dir
+        self.max_pack_size = max_pack_size
+        self.compaction_threshold = compaction_threshold
+        self.min_compaction_size = min_compaction_size
+        # key -> (pack number, value offset, value length), in order of storage
+        self._entries = dict()
+        self._pack_sizes = dict()
+        self._garbage_sizes = dict()
+        self._maps = dict()
+        self._active_pack_no = None
+        self._active_pack_file = None
+        self._index_file = None
+        self._compacting = False
+        self._closed = False
+        self._lock = RLock()
+        self._compaction_lock = Lock()
+        os.makedirs(pack_dir, exist_ok=True)
+        self._open()
+
+    @property
+    def size(self) -> int:
+        """ Total size of all pack files in bytes. """
+        with self._lock:
+            return sum(self._pack_sizes.values())
+
+    @property
+    def garbage_size(self) -> int:
+        """ Size of the records in pack files that are no longer referenced, in bytes. """
+        with self._lock:
+            return sum(self._garbage_sizes.values())
+
+    def can_load_from_key(self, key) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def load_from_key(self, key):
+        with self._lock:
+            entry = self._entries[key]
+        return entry, entry[2]
+
+    def store_value(self, key, value):
+        key_bytes = str(key).encode('utf-8')
+        value_size = len(value)
+        record_size = self._KEY_HEADER.size + len(key_bytes) + value_size
+        with self._lock:
+            if self._closed:
+                raise OSError(f'pack cache store {self.pack_dir!r} has been closed')
+            pack_size = self._pack_sizes[self._active_pack_no]
+            if pack_size > 0 and pack_size + record_size > self.max_pack_size:
+                self._start_new_active_pack()
+                pack_size = 0
+            pack_no = self._active_pack_no
+            self._active_pack_file.write(self._KEY_HEADER.pack(len(key_bytes)) + key_bytes)
+            self._active_pack_file.write(value)
+            self._pack_sizes[pack_no] = pack_size + record_size
+            entry = pack_no, pack_size + self._KEY_HEADER.size + len(key_bytes), value_size
+            self._forget_entry(key)
+            self._entries[key] = entry
+            self._index_file.write(self._INDEX_RECORD.pack(_key_digest(key_bytes), pack_no, pack_size,
+                                                           len(key_bytes), value_size, 0))
+        return entry, value_size
+
+    def restore_value(self, key, stored_value):
+        # Look up the key rather than using stored_value, because compaction may have moved the record
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._closed:
+                return None
+            pack_no, offset, length = entry
+            pack_map = self._get_map(pack_no, offset + length)
+        return memoryview(pack_map)[offset:offset + length]
+
+    def discard_value(self, key, stored_value):
+        with self._lock:
+            entry = self._forget_entry(key)
+            if entry is None or self._closed:
+                return
+            key_bytes = str(key).encode('utf-8')
+            # The tombstone points to the discarded record, so that its key can be verified when replayed
+            pack_no, value_offset, _ = entry
+            record_offset = value_offset - len(key_bytes) - self._KEY_HEADER.size
+            self._index_file.write(self._INDEX_RECORD.pack(_key_digest(key_bytes), pack_no, record_offset,
+                                                           len(key_bytes), 0, self._FLAG_DELETED))
+            start_compaction = not self._compacting and self._is_compaction_due()
+            if start_compaction:
+                self._compacting = True
+        if start_compaction:
+            threading.Thread(target=self.compact, name='xcube-pack-cache-compaction', daemon=True).start()
+
+    def scan_values(self):
+        """
+        Generate the values held by this store, in the order they have been stored, oldest first.
+
+        :return: an iterator of (key, stored_value, stored_size) triples
+        """
+        with self._lock:
+            return iter([(key, entry, entry[2]) for key, entry in self._entries.items()])
+
+    def compact(self):
+        """
+        Copy the live records of all completed pack files into new pack files and remove the old ones.
+        New values are written to a new active pack file while the compaction is in progress.
+        """
+        with self._compaction_lock:
+            try:
+                if not self._closed:
+                    self._compact()
+            finally:
+                with self._lock:
+                    self._compacting = False
+
+    def close(self):
+        """
+        Wait for a running compaction and close all files. Afterwards, values can no longer be stored or restored.
+        Must be called before another store is opened for the same *pack_dir*.
+        """
+        with self._compaction_lock:
+            with self._lock:
+                if self._closed:
+                    return
+                self._closed = True
+                self._active_pack_file.close()
+                self._index_file.close()
+                self._maps.clear()
+
+    def _compact(self):
+        with self._lock:
+            self._start_new_active_pack()
+            old_pack_nos = [pack_no for pack_no in self._pack_sizes if pack_no != self._active_pack_no]
+            old_entries = [(key, entry) for key, entry in self._entries.items() if entry[0] in old_pack_nos]
+            old_maps = {pack_no: self._get_map(pack_no, self._pack_sizes[pack_no]) for pack_no in old_pack_nos}
+            pack_no = self._new_pack_no()
+            self._pack_sizes[pack_no] = 0
+            self._garbage_sizes[pack_no] = 0
+
+        # Copy the live records without holding the lock
+        new_entries = dict()
+        pack_file = open(self._get_pack_path(pack_no), 'ab', buffering=0)
+        pack_size = 0
+        try:
+            for key, (old_pack_no, offset, length) in old_entries:
+                key_bytes = str(key).encode('utf-8')
+                record_size = self._KEY_HEADER.size + len(key_bytes) + length
+                if pack_size > 0 and pack_size + record_size > self.max_pack_size:
+                    pack_file.close()
+                    with self._lock:
+                        self._pack_sizes[pack_no] = pack_size
+                        pack_no = self._new_pack_no()
+                        self._pack_sizes[pack_no] = 0
+                        self._garbage_sizes[pack_no] = 0
+                    pack_file = open(self._get_pack_path(pack_no), 'ab', buffering=0)
+                    pack_size = 0
+                pack_file.write(self._KEY_HEADER.pack(len(key_bytes)) + key_bytes)
+                pack_file.write(memoryview(old_maps[old_pack_no])[offset:offset + length])
+                new_entries[key] = pack_no, pack_size + self._KEY_HEADER.size + len(key_bytes), length
+                pack_size += record_size
+        finally:
+            pack_file.close()
+
+        with self._lock:
+            self._pack_sizes[pack_no] = pack_size
+            for (key, old_entry) in old_entries:
+                new_entry = new_entries[key]
+                if self._entries.get(key) == old_entry:
+                    self._entries[key] = new_entry
+                else:
+                    # discarded or replaced while we were copying
+                    self._add_garbage(key, new_entry)
+            for old_pack_no in old_pack_nos:
+                del self._pack_sizes[old_pack_no]
+                del self._garbage_sizes[old_pack_no]
+                self._maps.pop(old_pack_no, None)
+            self._write_index()
+        old_maps.clear()
+
+        for old_pack_no in old_pack_nos:
+            try:
+                os.remove(self._get_pack_path(old_pack_no))
+            except OSError as error:
+                _LOG.warning(f'failed to remove pack file: {error}')
+
+    def _open(self):
+        for file_name in os.listdir(self.pack_dir):
+            if file_name.startswith(self._PACK_FILE_PREFIX) and file_name.endswith(self._PACK_FILE_EXT):
+                try:
+                    pack_no = int(file_name[len(self._PACK_FILE_PREFIX):-len(self._PACK_FILE_EXT)])
+                except ValueError:
+                    continue
+                self._pack_sizes[pack_no] = os.path.getsize(os.path.join(self.pack_dir, file_name))
+                self._garbage_sizes[pack_no] = 0
+
+        index_path = os.path.join(self.pack_dir, self._INDEX_FILE_NAME)
+        if os.path.exists(index_path) and os.path.getsize(index_path) >= self._INDEX_RECORD.size:
+            self._replay_index(index_path)
+
+        # Everything not referenced by the index is garbage
+        live_sizes = {pack_no: 0 for pack_no in self._pack_sizes}
+        for key, (pack_no, _, length) in self._entries.items():
+            live_sizes[pack_no] += self._KEY_HEADER.size + len(str(key).encode('utf-8')) + length
+        for pack_no, pack_size in self._pack_sizes.items():
+            self._garbage_sizes[pack_no] = pack_size - live_sizes[pack_no]
+
+        if self._pack_sizes:
+            self._active_pack_no = max(self._pack_sizes)
+            self._active_pack_file = open(self._get_pack_path(self._active_pack_no), 'ab', buffering=0)
+        else:
+            self._start_new_active_pack()
+        self._write_index()
+
+    def _replay_index(self, index_path):
+        record_size = self._INDEX_RECORD.size
+        with open(index_path, 'rb') as fp:
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as index_map:
+                num_records = len(index_map) // record_size
+                for i in range(num_records):
+                    digest, pack_no, record_offset, key_length, value_length, flags = \
+                        self._INDEX_RECORD.unpack_from(index_map, i * record_size)
+                    pack_size = self._pack_sizes.get(pack_no)
+                    if pack_size is None:
+                        continue
+                    value_offset = record_offset + self._KEY_HEADER.size + key_length
+                    if not flags & self._FLAG_DELETED and value_offset + value_length > pack_size:
+                        # truncated record, e.g. after a crash
+                        continue
+                    pack_map = self._get_map(pack_no, pack_size)
+                    if pack_map is None:
+                        continue
+                    key_bytes = pack_map[record_offset + self._KEY_HEADER.size:value_offset]
+                    if _key_digest(key_bytes) != digest:
+                        continue
+                    key = key_bytes.decode('utf-8')
+                    self._entries.pop(key, None)
+                    if not flags & self._FLAG_DELETED:
+                        self._entries[key] = pack_no, value_offset, value_length
+
+    def _write_index(self):
+        """ Rewrite the index file from the current entries. Must be called with the lock held. """
+        if self._index_file is not None:
+            self._index_file.close()
+        index_path = os.path.join(self.pack_dir, self._INDEX_FILE_NAME)
+        temp_path = index_path + _TEMP_FILE_EXT
+        with open(temp_path, 'wb') as fp:
+            for key, (pack_no, value_offset, value_length) in self._entries.items():
+                key_bytes = str(key).encode('utf-8')
+                record_offset = value_offset - len(key_bytes) - self._KEY_HEADER.size
+                fp.write(self._INDEX_RECORD.pack(_key_digest(key_bytes), pack_no, record_offset,
+                                                 len(key_bytes), value_length, 0))
+        os.replace(temp_path, index_path)
+        self._index_file = open(index_path, 'ab', buffering=0)
+
+    def _start_new_active_pack(self):
+        if self._active_pack_file is not None:
+            self._active_pack_file.close()
+        self._active_pack_no = self._new_pack_no()
+        self._pack_sizes[self._active_pack_no] = 0
+        self._garbage_sizes[self._active_pack_no] = 0
+        self._active_pack_file = open(self._get_pack_path(self._active_pack_no), 'ab', buffering=0)
+
+    def _new_pack_no(self) -> int:
+        return max(self._pack_sizes) + 1 if self._pack_sizes else 0
+
+    def _get_pack_path(self, pack_no: int) -> str:
+        return os.path.join(self.pack_dir, '%s%06d%s' % (self._PACK_FILE_PREFIX, pack_no, self._PACK_FILE_EXT))
+
+    def _get_map(self, pack_no: int, min_size: int):
+        """ Get a memory map of the given pack file that covers at least *min_size* bytes. """
+        pack_map = self._maps.get(pack_no)
+        if pack_map is None or len(pack_map) < min_size:
+            if min_size == 0:
+                return None
+            with open(self._get_pack_path(pack_no), 'rb') as fp:
+                # Previously returned memoryviews keep the old map alive
+                pack_map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[pack_no] = pack_map
+        return pack_map
+
+    def _forget_entry(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._add_garbage(key, entry)
+        return entry
+
+    def _add_garbage(self, key, entry):
+        pack_no, _, length = entry
+        if pack_no in self._garbage_sizes:
+            self._garbage_sizes[pack_no] += self._KEY_HEADER.size + len(str(key).encode('utf-8')) + length
+
+    def _is_compaction_due(self) -> bool:
+        garbage_size = sum(self._garbage_sizes.values())
+        return garbage_size >= self.min_compaction_size \
+            and garbage_size >= self.compaction_threshold * sum(self._pack_sizes.values())
+
+
+class ContentAddressedCacheStore(CacheStore):
+    """
+    A store for byte values, e.g. encoded PNG images, that stores identical values only once.
+    Values are stored in the wrapped *store* under a key derived from the MD5 digest of their content,
+    and every key only refers to its value's content. A content is discarded from the wrapped store
+    when the last key referring to it is discarded.
+
+    Cache capacities account a content's size to the key that stored it first. All other keys
+    referring to the same content count with the size of the reference only.
+
+    :param store: the wrapped store, e.g. a :py:class:`FileCacheStore` or a :py:class:`PackCacheStore`
+    :param persistent: if True, the references from keys to contents are also written to the wrapped store,
+           so that they can be recovered by :py:meth:`scan_values` after a restart
+    """
+
+    _CONTENT_KEY_PREFIX = '#content/'
+    _REFERENCE_MAGIC = b'XCREF01:'
+    _REFERENCE_SIZE = len(_REFERENCE_MAGIC) + 16
+
+    class _Content:
+        __slots__ = ('stored_value', 'size', 'ref_count')
+
+        def __init__(self, stored_value, size, ref_count):
+            self.stored_value = stored_value
+            self.size = size
+            self.ref_count = ref_count
+
+    def __init__(self, store: CacheStore, persistent: bool = False):
+        self._store = store
+        self._persistent = persistent
+        self._contents = dict()
+        self._lock = RLock()
+
+    @property
+    def store(self) -> CacheStore:
+        """ The wrapped store. """
+        return self._store
+
+    @property
+    def num_contents(self) -> int:
+        """ Number of distinct contents stored. """
+        return len(self._contents)
+
+    def can_load_from_key(self, key) -> bool:
+        # References are only known once stored or scanned
+        return False
+
+    def load_from_key(self, key):
+        raise NotImplementedError()
+
+    def store_value(self, key, value):
+        """
+        :param key: the key
+        :param value: the original value, a bytes-like object
+        :return: the tuple (stored value, size) where stored value is the tuple (digest, stored reference)
+        """
+        digest = hashlib.md5(value).digest()
+        content_key = self._get_content_key(digest)
+        with self._lock:
+            content = self._contents.get(digest)
+            if content is not None:
+                content.ref_count += 1
+                size = self._REFERENCE_SIZE
+            else:
+                stored_value, size = self._store.store_value(content_key, value)
+                self._contents[digest] = self._Content(stored_value, size, 1)
+        stored_reference = None
+        if self._persistent:
+            stored_reference, _ = self._store.store_value(key, self._REFERENCE_MAGIC + digest)
+        return (digest, stored_reference), size
+
+    def restore_value(self, key, stored_value):
+        digest, _ = stored_value
+        with self._lock:
+            content = self._contents.get(digest)
+        if content is None:
+            raise OSError(f'content of key {key!r} has been discarded')
+        return self._store.restore_value(self._get_content_key(digest), content.stored_value)
+
+    def discard_value(self, key, stored_value):
+        digest, stored_reference = stored_value
+        if stored_reference is not None:
+            self._store.discard_value(key, stored_reference)
+        with self._lock:
+            content = self._contents.get(digest)
+            if content is None:
+                return
+            content.ref_count -= 1
+            if content.ref_count > 0:
+                return
+            del self._contents[digest]
+            # Discard while holding the lock, so that a concurrent store_value() of the same content
+            # cannot store it under the same content key before it is discarded
+            self._store.discard_value(self._get_content_key(digest), content.stored_value)
+
+    def scan_values(self):
+        """
+        Recover the references and contents held by the wrapped store, if *persistent* is True.
+        Contents no longer referred to and references to missing contents are discarded.
+
+        :return: an iterator of (key, stored_value, stored_size) triples
+        """
+        if not self._persistent:
+            return iter(())
+        references = []
+        scanned_contents = dict()
+        for key, stored_value, stored_size in self._store.scan_values():
+            if key.startswith(self._CONTENT_KEY_PREFIX):
+                try:
+                    digest = bytes.fromhex(key[len(self._CONTENT_KEY_PREFIX):])
+                except ValueError:
+                    continue
+                scanned_contents[digest] = self._Content(stored_value, stored_size, 0)
+            else:
+                try:
+                    reference = bytes(self._store.restore_value(key, stored_value))
+                except OSError:
+                    continue
+                if len(reference) == self._REFERENCE_SIZE and reference.startswith(self._REFERENCE_MAGIC):
+                    references.append((key, reference[len(self._REFERENCE_MAGIC):], stored_value))
+        values = []
+        with self._lock:
+            for key, digest, stored_reference in references:
+                content = self._contents.get(digest)
+                if content is None:
+                    content = scanned_contents.pop(digest, None)
+                    if content is None:
+                        self._store.discard_value(key, stored_reference)
+                        continue
+                    self._contents[digest] = content
+                    size = content.size
+                else:
+                    size = self._REFERENCE_SIZE
+                content.ref_count += 1
+                values.append((key, (digest, stored_reference), size))
+            # Contents stored again since the scan started are live
+            orphans = [(digest, content) for digest, content in scanned_contents.items()
+                       if digest not in self._contents]
+        for digest, content in orphans:
+            self._store.discard_value(self._get_content_key(digest), content.stored_value)
+        return iter(values)
+
+    def _get_content_key(self, digest: bytes) -> str:
+        return self._CONTENT_KEY_PREFIX + digest.hex()
+
+
+def _snapshot_plain_value(value) -> Optional[Tuple[Dict[str, Any], List[Any]]]:
+    if isinstance(value, (bytes, memoryview)):
+        return dict(type='bytes'), [value]
+    if not isinstance(value, np.ndarray) or value.dtype.hasobject:
+        return None
+    data = np.ascontiguousarray(np.ma.getdata(value))
+    info = dict(type='array', dtype=data.dtype.str, shape=list(data.shape), masked=False)
+    buffers = [data]
+    if isinstance(value, np.ma.MaskedArray):
+        info.update(masked=True, fill_value=_to_json_scalar(value.fill_value))
+        mask = np.ma.getmask(value)
+        if mask is not np.ma.nomask:
+            buffers.append(np.ascontiguousarray(mask))
+    return info, buffers
+
+
+def _load_snapshot_plain_value(info: Dict[str, Any], buffers: List[memoryview]):
+    value_type = info['type']
+    if value_type == 'bytes':
+        return buffers[0]
+    if value_type != 'array':
+        raise ValueError(f'unexpected snapshot value type {value_type!r}')
+    shape = tuple(info['shape'])
+    data = np.frombuffer(buffers[0], dtype=np.dtype(info['dtype'])).reshape(shape)
+    if not info['masked']:
+        return data
+    mask = np.frombuffer(buffers[1], dtype=np.bool_).reshape(shape) if len(buffers) > 1 else np.ma.nomask
+    return np.ma.MaskedArray(data, mask=mask, fill_value=info['fill_value'])
+
+
+def _to_json_scalar(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _write_snapshot(path: str,
+                    store: CacheStore,
+                    items: List['Cache.Item'],
+                    fraction: float,
+                    tag_function: Optional[Callable[[Any], Any]]) -> int:
+    # Rank items by access count and recency and write the hottest ones, coldest first,
+    # so that reading the snapshot reproduces their order
+    items = sorted(items, key=lambda item: (item.access_count, item.access_time))
+    num_hot_items = int(math.ceil(max(0.0, min(1.0, fraction)) * len(items)))
+    items = items[len(items) - num_hot_items:]
+    entries = []
+    buffers = []
+    offset = 0
+    for item in items:
+        key = item.key
+        if not isinstance(key, str):
+            continue
+        tag = None
+        if tag_function is not None:
+            tag = tag_function(key)
+            if tag is None:
+                continue
+        snapshot = store.snapshot_value(key, item.stored_value)
+        if snapshot is None:
+            continue
+        info, value_buffers = snapshot
+        buffer_ranges = []
+        for buffer in value_buffers:
+            buffer = memoryview(buffer).cast('B')
+            buffer_ranges.append([offset, len(buffer)])
+            buffers.append((offset, buffer))
+            offset = _align_snapshot_offset(offset + len(buffer))
+        entries.append(dict(key=key, tag=tag, access_count=item.access_count, cost=item.cost,
+                            info=info, buffers=buffer_ranges))
+
+    header = json.dumps(dict(version=1, entries=entries)).encode('utf-8')
+    data_offset = _align_snapshot_offset(len(_SNAPSHOT_MAGIC) + 8 + len(header))
+    dir_path = os.path.dirname(path)
+    if dir_path:
+        os.makedirs(dir_path, exist_ok=True)
+    temp_path = '%s.%s%s' % (path, uuid.uuid4().hex, _TEMP_FILE_EXT)
+    try:
+        with open(temp_path, 'wb') as fp:
+            fp.write(_SNAPSHOT_MAGIC)
+            fp.write(struct.pack('<Q', len(header)))
+            fp.write(header)
+            for buffer_offset, buffer in buffers:
+                fp.seek(data_offset + buffer_offset)
+                fp.write(buffer)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return len(entries)
+
+
+def _read_snapshot(path: str,
+                   store: CacheStore,
+                   tag_filter: Optional[Callable[[Any, Any], bool]]) -> Iterator[Tuple[Any, Any, Any, int, Any]]:
+    with open(path, 'rb') as fp:
+        if fp.read(len(_SNAPSHOT_MAGIC)) != _SNAPSHOT_MAGIC:
+            raise ValueError(f'{path!r} is not a cache snapshot file')
+        header_size, = struct.unpack('<Q', fp.read(8))
+        header = json.loads(fp.read(header_size).decode('utf-8'))
+        # Private copy-on-write mapping: restored values are writable and the file may be replaced any time
+        data = memoryview(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY))
+    data_offset = _align_snapshot_offset(len(_SNAPSHOT_MAGIC) + 8 + header_size)
+    for entry in header['entries']:
+        key = entry['key']
+        if tag_filter is not None and not tag_filter(key, entry['tag']):
+            continue
+        buffers = [data[data_offset + offset: data_offset + offset + size] for offset, size in entry['buffers']]
+        try:
+            stored_value, stored_size = store.load_snapshot_value(key, entry['info'], buffers)
+        except (ValueError, KeyError, TypeError) as e:
+            _LOG.warning(f'skipped value for key {key!r} in cache snapshot {path!r}: {e}')
+            continue
+        yield key, stored_value, stored_size, entry['access_count'], entry['cost']
+
+
+def _align_snapshot_offset(offset: int) -> int:
+    return (offset + _SNAPSHOT_ALIGNMENT - 1) // _SNAPSHOT_ALIGNMENT * _SNAPSHOT_ALIGNMENT
+
+
+def _key_digest(key_bytes: bytes) -> bytes:
+    return hashlib.md5(key_bytes).digest()
+
+
+def _scan_files(dir_path: str) -> Iterator[Tuple[str, os.stat_result]]:
+    """ Recursively generate (path, stat) pairs for all files in *dir_path*. """
+    try:
+        entries = list(os.scandir(dir_path))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _scan_files(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry.path, entry.stat(follow_symlinks=False)
+        except OSError:
+            # file removed concurrently
+            pass
+
 
 def _policy_lru(item):
     return item.access_time
@@ -196,86 +1250,908 @@ POLICY_LFU = _policy_lfu
 #: Discard items by Random Replacement
 POLICY_RR = _policy_rr
 
-_T0 = time.clock()
+# Monotonic logical clock used to stamp cache items. Calling next() on an itertools.count
+# is atomic in CPython, so no lock is required.
+_CLOCK = itertools.count(1)
 
 
-class Cache:
+class Evictor(metaclass=ABCMeta):
     """
-    An implementation of a cache.
-    See https://en.wikipedia.org/wiki/Cache_algorithms
+    Keeps track of the items of a :py:class:`Cache` and selects the items to be evicted
+    according to some cache replacement policy.
+
+    All methods are called by the owning cache while it holds its lock,
+    so implementations do not need to be thread-safe.
+
+    :param max_size: the size the owning cache trims itself to, in units used by the cache store.
+                     Only adaptive evictors make use of it.
     """
 
-    class Item:
+    def __init__(self, max_size: Optional[float] = None):
+        self.max_size = max_size
+
+    @abstractmethod
+    def add(self, item: 'Cache.Item') -> None:
         """
-        Cache-private class representing an item in the cache.
+        Called after a new item has been added to the cache.
+        :param item: the new item
         """
 
-        def __init__(self):
-            self.key = None
-            self.stored_value = None
-            self.stored_size = 0
-            self.creation_time = 0
-            self.access_time = 0
-            self.access_count = 0
+    @abstractmethod
+    def access(self, item: 'Cache.Item') -> None:
+        """
+        Called after an existing item has been accessed.
+        :param item: the accessed item
+        """
 
-        @staticmethod
-        def load_from_key(store, key):
-            if not store.can_load_from_key(key):
-                return None
-            item = Cache.Item()
-            item._load_from_key(store, key)
-            return item
+    @abstractmethod
+    def remove(self, item: 'Cache.Item') -> None:
+        """
+        Called after an item has been explicitly removed from the cache.
+        :param item: the removed item
+        """
 
-        def store(self, store, key, value):
-            self.key = key
-            self.access_count = 0
-            self._access()
-            stored_value, stored_size = store.store_value(key, value)
-            self.stored_value = stored_value
-            self.stored_size = stored_size
+    @abstractmethod
+    def evict(self) -> Optional['Cache.Item']:
+        """
+        Select the next item to be evicted, forget about it, and return it.
+        :return: the evicted item or None, if there are no items left
+        """
 
-        def restore(self, store, key):
-            self._access()
-            return store.restore_value(key, self.stored_value)
+    @abstractmethod
+    def clear(self) -> None:
+        """
+        Forget about all items.
+        """
 
-        def discard(self, store, key):
-            store.discard_value(key, self.stored_value)
-            self.__init__()
 
-        def _load_from_key(self, store, key):
-            self.key = key
-            self.access_count = 0
-            self._access()
-            stored_value, stored_size = store.load_from_key(key)
-            self.stored_value = stored_value
-            self.stored_size = stored_size
+class LruEvictor(Evictor):
+    """
+    Evicts Least Recently Used items first. All operations are O(1).
+    """
 
-        def _access(self):
-            self.access_time = time.clock() - _T0
-            self.access_count += 1
+    def __init__(self, max_size: Optional[float] = None):
+        super().__init__(max_size=max_size)
+        self._items = OrderedDict()
 
-    def __init__(self, store=MemoryCacheStore(), capacity=1000, threshold=0.75, policy=POLICY_LRU, parent_cache=None):
-        """
-        Constructor.
+    def add(self, item):
+        self._items[item.key] = item
 
-        :param store: the cache store, see CacheStore interface
-        :param capacity: the size capacity in units used by the store's store() method
-        :param threshold: a number greater than zero and less than one
-        :param policy: cache replacement policy. This is a function that maps a :py:class:`Cache.Item`
-                       to a numerical value. See :py:data:`POLICY_LRU`,
-                       :py:data:`POLICY_MRU`, :py:data:`POLICY_LFU`, :py:data:`POLICY_RR`
-        """
-        self._store = store
-        self._capacity = capacity
-        self._threshold = threshold
+    def access(self, item):
+        self._items.move_to_end(item.key)
+
+    def remove(self, item):
+        self._items.pop(item.key, None)
+
+    def evict(self):
+        if not self._items:
+            return None
+        return self._items.popitem(last=False)[1]
+
+    def clear(self):
+        self._items.clear()
+
+
+class MruEvictor(LruEvictor):
+    """
+    Evicts Most Recently Used items first. All operations are O(1).
+    """
+
+    def evict(self):
+        if not self._items:
+            return None
+        return self._items.popitem(last=True)[1]
+
+
+class LfuEvictor(Evictor):
+    """
+    Evicts Least Frequently Used items first, and among items of equal frequency the least recently used one.
+    Items are kept in per-frequency buckets, so that all operations are O(1), except that removing
+    the last item of the least frequency bucket requires a scan over the (usually few) distinct frequencies.
+    """
+
+    def __init__(self, max_size: Optional[float] = None):
+        super().__init__(max_size=max_size)
+        self._buckets = dict()
+        self._counts = dict()
+        self._min_count = 0
+
+    def add(self, item):
+        self._counts[item.key] = 1
+        self._buckets.setdefault(1, OrderedDict())[item.key] = item
+        self._min_count = 1
+
+    def access(self, item):
+        key = item.key
+        count = self._counts[key]
+        self._pop_from_bucket(key, count)
+        self._counts[key] = count + 1
+        self._buckets.setdefault(count + 1, OrderedDict())[key] = item
+        if self._min_count == count and count not in self._buckets:
+            self._min_count = count + 1
+
+    def remove(self, item):
+        count = self._counts.pop(item.key, None)
+        if count is not None:
+            self._pop_from_bucket(item.key, count)
+            if self._min_count == count and count not in self._buckets:
+                self._min_count = min(self._buckets) if self._buckets else 0
+
+    def evict(self):
+        if not self._counts:
+            return None
+        bucket = self._buckets[self._min_count]
+        key, item = bucket.popitem(last=False)
+        del self._counts[key]
+        if not bucket:
+            del self._buckets[self._min_count]
+            self._min_count = min(self._buckets) if self._buckets else 0
+        return item
+
+    def clear(self):
+        self._buckets.clear()
+        self._counts.clear()
+        self._min_count = 0
+
+    def _pop_from_bucket(self, key, count):
+        bucket = self._buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[count]
+
+
+class RandomEvictor(Evictor):
+    """
+    Evicts randomly chosen items. All operations are O(1).
+    """
+
+    def __init__(self, max_size: Optional[float] = None):
+        super().__init__(max_size=max_size)
+        self._items = []
+        self._indexes = dict()
+
+    def add(self, item):
+        self._indexes[item.key] = len(self._items)
+        self._items.append(item)
+
+    def access(self, item):
+        pass
+
+    def remove(self, item):
+        index = self._indexes.pop(item.key, None)
+        if index is not None:
+            self._remove_at(index)
+
+    def evict(self):
+        if not self._items:
+            return None
+        index = random.randrange(len(self._items))
+        item = self._items[index]
+        del self._indexes[item.key]
+        self._remove_at(index)
+        return item
+
+    def clear(self):
+        self._items.clear()
+        self._indexes.clear()
+
+    def _remove_at(self, index):
+        last_item = self._items.pop()
+        if index < len(self._items):
+            self._items[index] = last_item
+            self._indexes[last_item.key] = index
+
+
+class SortingEvictor(Evictor):
+    """
+    Evicts the item with the lowest value of a given key function first.
+    Selecting a victim is O(n). This evictor is used for custom, function-based replacement policies only.
+
+    :param policy: a function that maps a :py:class:`Cache.Item` to a numerical value.
+    :param max_size: the size the owning cache trims itself to
+    """
+
+    def __init__(self, policy: Callable[['Cache.Item'], Any], max_size: Optional[float] = None):
+        super().__init__(max_size=max_size)
+        self._policy = policy
+        self._items = dict()
+
+    def add(self, item):
+        self._items[item.key] = item
+
+    def access(self, item):
+        pass
+
+    def remove(self, item):
+        self._items.pop(item.key, None)
+
+    def evict(self):
+        if not self._items:
+            return None
+        item = min(self._items.values(), key=self._policy)
+        del self._items[item.key]
+        return item
+
+    def clear(self):
+        self._items.clear()
+
+
+class ArcEvictor(Evictor):
+    """
+    Evicts items according to the Adaptive Replacement Cache (ARC) policy by Megiddo and Modha.
+
+    Items seen once are kept in a recency list T1, items seen more than once in a frequency list T2.
+    Keys of items evicted from T1 and T2 are remembered in the ghost lists B1 and B2. A new item whose key
+    is found in a ghost list shifts the target size of T1 towards recency or frequency, respectively.
+    Therefore a scan over many items seen only once, e.g. a user panning across a large region,
+    can only flush T1, not the frequently used items in T2.
+
+    Sizes are accounted in units of the cache store rather than in numbers of items.
+    All operations are O(1).
+
+    :param max_size: the size the owning cache trims itself to.
+                     If not given, the ghost lists are bounded by the total size of the cached items.
+    """
+
+    def __init__(self, max_size: Optional[float] = None):
+        super().__init__(max_size=max_size)
+        self._t1 = OrderedDict()
+        self._t2 = OrderedDict()
+        self._b1 = OrderedDict()
+        self._b2 = OrderedDict()
+        self._sizes = dict()
+        self._t1_size = 0
+        self._t2_size = 0
+        self._b1_size = 0
+        self._b2_size = 0
+        self._target_t1_size = 0
+
+    @property
+    def target_t1_size(self) -> float:
+        """ The current target size of the recency list T1. """
+        return self._target_t1_size
+
+    def add(self, item):
+        key = item.key
+        size = item.stored_size
+        self._sizes[key] = size
+        capacity = self._get_capacity()
+        if key in self._b1:
+            delta = max(self._b2_size / max(self._b1_size, 1), 1) * size
+            self._target_t1_size = min(self._target_t1_size + delta, capacity)
+            self._b1_size -= self._b1.pop(key)
+            self._add_t2(key, item)
+        elif key in self._b2:
+            delta = max(self._b1_size / max(self._b2_size, 1), 1) * size
+            self._target_t1_size = max(self._target_t1_size - delta, 0)
+            self._b2_size -= self._b2.pop(key)
+            self._add_t2(key, item)
+        else:
+            self._t1[key] = item
+            self._t1_size += size
+        self._trim_ghosts(capacity)
+
+    def access(self, item):
+        key = item.key
+        if key in self._t1:
+            del self._t1[key]
+            self._t1_size -= self._sizes[key]
+            self._add_t2(key, item)
+        else:
+            self._t2.move_to_end(key)
+
+    def remove(self, item):
+        key = item.key
+        size = self._sizes.pop(key, None)
+        if size is None:
+            return
+        if self._t1.pop(key, None) is not None:
+            self._t1_size -= size
+        elif self._t2.pop(key, None) is not None:
+            self._t2_size -= size
+
+    def evict(self):
+        if self._t1 and (self._t1_size > self._target_t1_size or not self._t2):
+            key, item = self._t1.popitem(last=False)
+            size = self._sizes.pop(key)
+            self._t1_size -= size
+            self._b1[key] = size
+            self._b1_size += size
+        elif self._t2:
+            key, item = self._t2.popitem(last=False)
+            size = self._sizes.pop(key)
+            self._t2_size -= size
+            self._b2[key] = size
+            self._b2_size += size
+        else:
+            return None
+        return item
+
+    def clear(self):
+        for d in (self._t1, self._t2, self._b1, self._b2, self._sizes):
+            d.clear()
+        self._t1_size = self._t2_size = self._b1_size = self._b2_size = 0
+        self._target_t1_size = 0
+
+    def _add_t2(self, key, item):
+        self._t2[key] = item
+        self._t2_size += self._sizes[key]
+
+    def _get_capacity(self) -> float:
+        if self.max_size is not None:
+            return self.max_size
+        return self._t1_size + self._t2_size
+
+    def _trim_ghosts(self, capacity):
+        while self._b1 and self._t1_size + self._b1_size > capacity:
+            self._b1_size -= self._b1.popitem(last=False)[1]
+        while self._b2 and self._t1_size + self._t2_size + self._b1_size + self._b2_size > 2 * capacity:
+            self._b2_size -= self._b2.popitem(last=False)[1]
+
+
+class FrequencySketch:
+    """
+    A count-min sketch that estimates how often keys have been seen recently, using 4-bit saturating counters.
+    All counters are halved after *sample_size* increments, so that the estimates follow changes in popularity.
+
+    :param width: the number of counters per row, rounded up to the next power of two
+    :param depth: the number of rows, i.e. independent hash functions
+    :param sample_size: the number of increments after which all counters are halved, defaults to 10 * width
+    """
+
+    _MAX_COUNT = 15
+    _SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93,
+              0xFF51AFD7ED558CCD, 0xC4CEB9FE1A85EC53, 0x85EBCA77C2B2AE63, 0x27D4EB2F165667C5)
+
+    def __init__(self, width: int = 1 << 14, depth: int = 4, sample_size: Optional[int] = None):
+        if depth > len(self._SEEDS):
+            raise ValueError(f'depth must not be greater than {len(self._SEEDS)}')
+        width = 1 << max(int(width) - 1, 1).bit_length()
+        self._mask = width - 1
+        self._offsets = [row * width for row in range(depth)]
+        self._seeds = self._SEEDS[:depth]
+        # Counters are accessed through the bytearray, which is much faster for single elements,
+        # and halved through a numpy view of it
+        self._counters = bytearray(depth * width)
+        self._counters_view = np.frombuffer(self._counters, dtype=np.uint8)
+        self._sample_size = sample_size or 10 * width
+        self._num_increments = 0
+
+    def increment(self, key) -> None:
+        """ Count one occurrence of *key*. """
+        counters = self._counters
+        for index in self._indexes(key):
+            if counters[index] < self._MAX_COUNT:
+                counters[index] += 1
+        self._num_increments += 1
+        if self._num_increments >= self._sample_size:
+            self._counters_view >>= 1
+            self._num_increments //= 2
+
+    def frequency(self, key) -> int:
+        """ Estimate how often *key* has been seen recently. """
+        counters = self._counters
+        return min(counters[index] for index in self._indexes(key))
+
+    def clear(self) -> None:
+        self._counters_view.fill(0)
+        self._num_increments = 0
+
+    def _indexes(self, key):
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        mask = self._mask
+        return [offset + ((((h ^ seed) * 0x9E3779B97F4A7C15) >> 32) & mask)
+                for offset, seed in zip(self._offsets, self._seeds)]
+
+
+class TinyLfuEvictor(Evictor):
+    """
+    Evicts items according to the Window TinyLFU (W-TinyLFU) policy by Einziger, Friedman and Manes.
+
+    New items enter a small LRU window. Items leaving the window are only admitted to the main area if a
+    :py:class:`FrequencySketch` estimates that they are used more often than the item they would replace.
+    The main area is a segmented LRU of a probation and a protected segment. Hence bursts of items used
+    only once are kept in the window and do not flush the popular items from the main area.
+
+    Sizes are accounted in units of the cache store rather than in numbers of items.
+
+    :param max_size: the size the owning cache trims itself to. If not given, all items stay in the window,
+                     which makes this evictor behave like :py:class:`LruEvictor`.
+    :param window_ratio: the ratio of *max_size* used for the window
+    :param protected_ratio: the ratio of the main area used for the protected segment
+    :param sketch_width: the number of counters per row of the frequency sketch
+    """
+
+    def __init__(self,
+                 max_size: Optional[float] = None,
+                 window_ratio: float = 0.01,
+                 protected_ratio: float = 0.8,
+                 sketch_width: int = 1 << 14):
+        super().__init__(max_size=max_size)
+        if max_size is None:
+            self._window_max_size = float('inf')
+            self._main_max_size = 0
+        else:
+            self._window_max_size = max_size * window_ratio
+            self._main_max_size = max_size - self._window_max_size
+        self._protected_max_size = self._main_max_size * protected_ratio
+        self._sketch = FrequencySketch(width=sketch_width)
+        self._window = OrderedDict()
+        self._probation = OrderedDict()
+        self._protected = OrderedDict()
+        self._sizes = dict()
+        self._window_size = 0
+        self._probation_size = 0
+        self._protected_size = 0
+
+    @property
+    def sketch(self) -> FrequencySketch:
+        return self._sketch
+
+    def add(self, item):
+        key = item.key
+        self._sketch.increment(key)
+        self._sizes[key] = item.stored_size
+        self._window[key] = item
+        self._window_size += item.stored_size
+
+    def access(self, item):
+        key = item.key
+        self._sketch.increment(key)
+        size = self._sizes[key]
+        if key in self._window:
+            self._window.move_to_end(key)
+        elif key in self._probation:
+            del self._probation[key]
+            self._probation_size -= size
+            self._protected[key] = item
+            self._protected_size += size
+            # Demote the least recently used protected items if the protected segment is full
+            while self._protected_size > self._protected_max_size and len(self._protected) > 1:
+                demoted_key, demoted_item = self._protected.popitem(last=False)
+                demoted_size = self._sizes[demoted_key]
+                self._protected_size -= demoted_size
+                self._probation[demoted_key] = demoted_item
+                self._probation_size += demoted_size
+        else:
+            self._protected.move_to_end(key)
+
+    def remove(self, item):
+        key = item.key
+        size = self._sizes.pop(key, None)
+        if size is None:
+            return
+        if self._window.pop(key, None) is not None:
+            self._window_size -= size
+        elif self._probation.pop(key, None) is not None:
+            self._probation_size -= size
+        elif self._protected.pop(key, None) is not None:
+            self._protected_size -= size
+
+    def evict(self):
+        while self._window_size > self._window_max_size and self._window:
+            candidate_key, candidate = self._window.popitem(last=False)
+            candidate_size = self._sizes[candidate_key]
+            self._window_size -= candidate_size
+            if self._probation_size + self._protected_size + candidate_size <= self._main_max_size:
+                self._add_probation(candidate_key, candidate)
+                continue
+            victim_key = self._peek_main_victim()
+            if victim_key is None:
+                self._add_probation(candidate_key, candidate)
+                continue
+            if self._sketch.frequency(candidate_key) > self._sketch.frequency(victim_key):
+                victim = self._pop_main(victim_key)
+                self._add_probation(candidate_key, candidate)
+                return victim
+            del self._sizes[candidate_key]
+            return candidate
+
+        victim_key = self._peek_main_victim()
+        if victim_key is not None:
+            return self._pop_main(victim_key)
+        if self._window:
+            key, item = self._window.popitem(last=False)
+            self._window_size -= self._sizes.pop(key)
+            return item
+        return None
+
+    def clear(self):
+        for d in (self._window, self._probation, self._protected, self._sizes):
+            d.clear()
+        self._window_size = self._probation_size = self._protected_size = 0
+        self._sketch.clear()
+
+    def _add_probation(self, key, item):
+        self._probation[key] = item
+        self._probation_size += self._sizes[key]
+
+    def _peek_main_victim(self):
+        if self._probation:
+            return next(iter(self._probation))
+        if self._protected:
+            return next(iter(self._protected))
+        return None
+
+    def _pop_main(self, key):
+        size = self._sizes.pop(key)
+        item = self._probation.pop(key, None)
+        if item is not None:
+            self._probation_size -= size
+        else:
+            item = self._protected.pop(key)
+            self._protected_size -= size
+        return item
+
+
+class GreedyDualSizeEvictor(Evictor):
+    """
+    Evicts items according to the GreedyDual-Size-Frequency policy by Cherkasova, so that
+    items which are cheap to recompute per unit of size are evicted first.
+
+    Every item has a priority ``H = L + frequency * cost / size``, where *cost* is the cost passed
+    to :py:meth:`Cache.put_value`, e.g. the compute time of a tile. The item with the lowest priority
+    is evicted first and its priority becomes the new inflation value *L*, so that items which
+    have not been accessed for a long time eventually age out, however expensive they are.
+
+    The priority queue is a heap with lazy deletion. Adding, accessing and evicting items is O(log n).
+
+    :param max_size: the size the owning cache trims itself to, not used
+    :param default_cost: the cost assumed for items that have been put into the cache without a cost
+    """
+
+    def __init__(self, max_size: Optional[float] = None, default_cost: float = 1.0):
+        super().__init__(max_size=max_size)
+        self._default_cost = default_cost
+        self._inflation = 0.
+        self._heap = []
+        # key -> (priority, sequence number, item) of the current heap entry
+        self._entries = dict()
+        self._frequencies = dict()
+        self._counter = itertools.count()
+
+    @property
+    def inflation(self) -> float:
+        """ The current inflation value L, i.e. the priority of the most recently evicted item. """
+        return self._inflation
+
+    def add(self, item):
+        self._frequencies[item.key] = 1
+        self._push(item)
+
+    def access(self, item):
+        self._frequencies[item.key] += 1
+        self._push(item)
+
+    def remove(self, item):
+        self._entries.pop(item.key, None)
+        self._frequencies.pop(item.key, None)
+
+    def evict(self):
+        heap = self._heap
+        while heap:
+            priority, seq, item = heapq.heappop(heap)
+            entry = self._entries.get(item.key)
+            if entry is not None and entry[1] == seq:
+                del self._entries[item.key]
+                del self._frequencies[item.key]
+                self._inflation = priority
+                return item
+        return None
+
+    def clear(self):
+        self._heap.clear()
+        self._entries.clear()
+        self._frequencies.clear()
+        self._inflation = 0.
+
+    def _push(self, item):
+        cost = item.cost if item.cost is not None else self._default_cost
+        priority = self._inflation + self._frequencies[item.key] * cost / max(item.stored_size, 1)
+        entry = priority, next(self._counter), item
+        self._entries[item.key] = entry
+        heapq.heappush(self._heap, entry)
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            # Drop stale entries
+            self._heap = list(self._entries.values())
+            heapq.heapify(self._heap)
+
+
+#: Discard items according to the Adaptive Replacement Cache policy
+POLICY_ARC = ArcEvictor
+#: Discard items according to the Window TinyLFU policy
+POLICY_TINYLFU = TinyLfuEvictor
+#: Discard items that are cheap to recompute per unit of size first
+POLICY_GDS = GreedyDualSizeEvictor
+
+#: Cache replacement policies by their names as used in configurations
+POLICY_NAMES = {
+    'LRU': POLICY_LRU,
+    'MRU': POLICY_MRU,
+    'LFU': POLICY_LFU,
+    'RR': POLICY_RR,
+    'ARC': POLICY_ARC,
+    'TinyLFU': POLICY_TINYLFU,
+    'GDS': POLICY_GDS,
+}
+
+
+def get_policy(name: str):
+    """
+    Get a cache replacement policy by name.
+
+    :param name: one of the keys of :py:data:`POLICY_NAMES`, case-insensitive
+    :return: the policy
+    :raise ValueError: if *name* is not a known policy name
+    """
+    for policy_name, policy in POLICY_NAMES.items():
+        if policy_name.lower() == str(name).lower():
+            return policy
+    raise ValueError(f'unknown cache replacement policy "{name}", must be one of {", ".join(POLICY_NAMES)}')
+
+
+_POLICY_EVICTOR_CLASSES = {
+    POLICY_LRU: LruEvictor,
+    POLICY_MRU: MruEvictor,
+    POLICY_LFU: LfuEvictor,
+    POLICY_RR: RandomEvictor,
+}
+
+
+def new_evictor(policy, max_size: Optional[float] = None) -> Evictor:
+    """
+    Create a new evictor for the given cache replacement *policy*.
+
+    :param policy: one of the ``POLICY_*`` values, a subclass of :py:class:`Evictor`,
+                   or any function that maps a :py:class:`Cache.Item` to a numerical value.
+    :param max_size: the size the owning cache trims itself to
+    :return: a new evictor instance
+    """
+    if isinstance(policy, type) and issubclass(policy, Evictor):
+        return policy(max_size=max_size)
+    evictor_class = _POLICY_EVICTOR_CLASSES.get(policy)
+    if evictor_class is not None:
+        return evictor_class(max_size=max_size)
+    return SortingEvictor(policy, max_size=max_size)
+
+
+class LatencyHistogram:
+    """
+    A thread-safe histogram of durations in seconds with logarithmically spaced buckets.
+    """
+
+    #: Upper bounds of the buckets in seconds. A last bucket collects all longer durations.
+    BUCKET_BOUNDS = (1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 1e-1, 3e-1, 1., 3., 10.)
+
+    def __init__(self):
+        self._lock = Lock()
+        self._bucket_counts = [0] * (len(self.BUCKET_BOUNDS) + 1)
+        self._count = 0
+        self._total = 0.
+        self._max = 0.
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @property
+    def total(self) -> float:
+        return self._total
+
+    def record(self, duration: float) -> None:
+        index = bisect.bisect_left(self.BUCKET_BOUNDS, duration)
+        with self._lock:
+            self._bucket_counts[index] += 1
+            self._count += 1
+            self._total += duration
+            if duration > self._max:
+                self._max = duration
+
+    def merge(self, other: 'LatencyHistogram') -> None:
+        """ Add the counts of *other* to this histogram. """
+        with other._lock:
+            bucket_counts = list(other._bucket_counts)
+            count, total, max_duration = other._count, other._total, other._max
+        with self._lock:
+            for i, bucket_count in enumerate(bucket_counts):
+                self._bucket_counts[i] += bucket_count
+            self._count += count
+            self._total += total
+            self._max = max(self._max, max_duration)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            bucket_counts = list(self._bucket_counts)
+            count, total, max_duration = self._count, self._total, self._max
+        bounds = list(self.BUCKET_BOUNDS) + [None]
+        return dict(count=count,
+                    total=total,
+                    mean=total / count if count else None,
+                    max=max_duration,
+                    buckets=[dict(le=bound, count=bucket_count)
+                             for bound, bucket_count in zip(bounds, bucket_counts)])
+
+
+class CacheStats:
+    """
+    Thread-safe counters and cache store latency histograms of a :py:class:`Cache`.
+
+    Counters are
+
+    * ``hits`` - values restored from the cache;
+    * ``store_loads`` - values not in the cache but loaded from its store by key;
+    * ``parent_hits`` - values not in the cache but found in the parent cache;
+    * ``misses`` - values found nowhere;
+    * ``puts``, ``bytes_put`` - values put into the cache and their stored size;
+    * ``rejected_puts`` - values not cached, because they are cheaper to recompute than the cache's minimum cost;
+    * ``removals`` - values explicitly removed;
+    * ``evictions``, ``bytes_evicted`` - values evicted and their stored size.
+
+    Note, sizes are given in units of the cache store, which are bytes for all stores but :py:class:`MemoryCacheStore`
+    holding objects that are not numpy arrays.
+    """
+
+    COUNTER_NAMES = ('hits', 'store_loads', 'parent_hits', 'misses', 'puts', 'bytes_put', 'rejected_puts',
+                     'removals', 'evictions', 'bytes_evicted')
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counters = dict.fromkeys(self.COUNTER_NAMES, 0)
+        self.store_latency = LatencyHistogram()
+        self.restore_latency = LatencyHistogram()
+        self.discard_latency = LatencyHistogram()
+
+    @property
+    def counters(self) -> dict:
+        """ A copy of the current counter values. """
+        with self._lock:
+            return dict(self._counters)
+
+    def increment(self, name: str, value=1) -> None:
+        with self._lock:
+            self._counters[name] += value
+
+    def merge(self, other: 'CacheStats') -> None:
+        """ Add the counters and histograms of *other* to this object. """
+        for name, value in other.counters.items():
+            self.increment(name, value)
+        self.store_latency.merge(other.store_latency)
+        self.restore_latency.merge(other.restore_latency)
+        self.discard_latency.merge(other.discard_latency)
+
+    def to_dict(self) -> dict:
+        counters = self.counters
+        num_requests = counters['hits'] + counters['store_loads'] + counters['parent_hits'] + counters['misses']
+        return dict(counters,
+                    hit_ratio=(counters['hits'] + counters['store_loads']) / num_requests if num_requests else None,
+                    store_latency=self.store_latency.to_dict(),
+                    restore_latency=self.restore_latency.to_dict(),
+                    discard_latency=self.discard_latency.to_dict())
+
+
+def get_policy_name(policy) -> str:
+    """
+    Get a name for the given cache replacement *policy*, which is its key in :py:data:`POLICY_NAMES`,
+    if any, otherwise the policy's ``__name__``.
+    """
+    for policy_name, named_policy in POLICY_NAMES.items():
+        if named_policy is policy:
+            return policy_name
+    return getattr(policy, '__name__', str(policy))
+
+
+class Cache:
+    """
+    An implementation of a cache.
+    See https://en.wikipedia.org/wiki/Cache_algorithms
+    """
+
+    class Item:
+        """
+        Cache-private class representing an item in the cache.
+        """
+
+        __slots__ = ('key', 'stored_value', 'stored_size', 'creation_time', 'access_time', 'access_count', 'cost')
+
+        def __init__(self):
+            self.key = None
+            self.stored_value = None
+            self.stored_size = 0
+            self.creation_time = 0
+            self.access_time = 0
+            self.access_count = 0
+            self.cost = None
+
+        @staticmethod
+        def load_from_key(store, key):
+            if not store.can_load_from_key(key):
+                return None
+            item = Cache.Item()
+            item._load_from_key(store, key)
+            return item
+
+        def store(self, store, key, value, cost=None):
+            self.key = key
+            self.cost = cost
+            self.access_count = 0
+            self._access()
+            self.creation_time = self.access_time
+            stored_value, stored_size = store.store_value(key, value)
+            self.stored_value = stored_value
+            self.stored_size = stored_size
+
+        def restore(self, store, key, stored_value):
+            self._access()
+            return store.restore_value(key, stored_value)
+
+        def discard(self, store, key):
+            store.discard_value(key, self.stored_value)
+            self.__init__()
+
+        def _load_from_key(self, store, key):
+            self.key = key
+            self.access_count = 0
+            self._access()
+            self.creation_time = self.access_time
+            stored_value, stored_size = store.load_from_key(key)
+            self.stored_value = stored_value
+            self.stored_size = stored_size
+
+        def _access(self):
+            self.access_time = next(_CLOCK)
+            self.access_count += 1
+
+    def __init__(self, store=MemoryCacheStore(), capacity=1000, threshold=0.75, policy=POLICY_LRU, parent_cache=None,
+                 min_cost=None, name=None, namespace_function=None):
+        """
+        Constructor.
+
+        :param store: the cache store, see CacheStore interface
+        :param capacity: the size capacity in units used by the store's store() method
+        :param threshold: a number greater than zero and less than one
+        :param policy: cache replacement policy. This is either one of :py:data:`POLICY_LRU`,
+                       :py:data:`POLICY_MRU`, :py:data:`POLICY_LFU`, :py:data:`POLICY_RR`,
+                       :py:data:`POLICY_ARC`, :py:data:`POLICY_TINYLFU`, :py:data:`POLICY_GDS`,
+                       a subclass of :py:class:`Evictor`,
+                       or a function that maps a :py:class:`Cache.Item` to a numerical value.
+        :param parent_cache: optional cache that receives the values evicted from this cache
+        :param min_cost: optional minimum cost of values passed to :py:meth:`put_value` to be cached
+        :param name: optional cache name used in statistics
+        :param namespace_function: optional function that maps a key to its namespace, e.g. a tile ID
+               to the ID of its image. All values of a namespace can be removed by :py:meth:`remove_namespace`.
+        """
+        self._name = name
+        self._store = store
+        self._capacity = capacity
+        self._threshold = threshold
         self._policy = policy
         self._parent_cache = parent_cache
+        self._min_cost = min_cost
         self._size = 0
         self._max_size = self._capacity * self._threshold
         self._item_dict = {}
-        self._item_list = []
+        self._namespace_function = namespace_function
+        self._namespaces = {}
+        self._evictor = new_evictor(policy, max_size=self._max_size)
+        self._stats = CacheStats()
         self._lock = RLock()
 
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def stats(self) -> CacheStats:
+        return self._stats
+
+    @property
+    def parent_cache(self):
+        return self._parent_cache
+
+    @property
+    def namespace_function(self):
+        return self._namespace_function
+
     @property
     def policy(self):
         return self._policy
@@ -292,6 +2168,10 @@ class Cache:
     def threshold(self):
         return self._threshold
 
+    @property
+    def min_cost(self):
+        return self._min_cost
+
     @property
     def size(self):
         return self._size
@@ -300,114 +2180,711 @@ class Cache:
     def max_size(self):
         return self._max_size
 
+    @property
+    def num_items(self):
+        return len(self._item_dict)
+
+    def get_stats(self) -> dict:
+        """ Get the cache's occupancy and statistics as JSON-serializable dictionary. """
+        return dict(name=self._name,
+                    policy=get_policy_name(self._policy),
+                    capacity=self._capacity,
+                    max_size=self._max_size,
+                    size=self._size,
+                    num_items=self.num_items,
+                    **self._stats.to_dict())
+
     def get_value(self, key):
-        self._lock.acquire()
-        item = self._item_dict.get(key)
+        with self._lock:
+            item = self._item_dict.get(key)
+            stored_value = None
+            if item is not None:
+                self._evictor.access(item)
+                # Item.discard() resets the item, so restore from the stored value of the time of the lookup
+                stored_value = item.stored_value
         value = None
-        restored = False
-        if item:
-            value = item.restore(self._store, key)
-            restored = True
-            if _DEBUG_CACHE:
-                _debug_print('restored value for key "%s" from cache' % key)
-        elif self._parent_cache:
-            item = self._parent_cache.get_value(key)
-            if item:
-                value = item.restore(self._parent_cache.store, key)
-                restored = True
+        if item is not None:
+            # Restore outside the lock. If the item is evicted concurrently, we get None and treat it as a miss.
+            value = self._restore_item(item, key, stored_value)
+            if value is not None:
+                self._stats.increment('hits')
+                if _DEBUG_CACHE:
+                    _debug_print('restored value for key "%s" from cache' % key)
+        if value is None and self._parent_cache:
+            value = self._parent_cache.get_value(key)
+            if value is not None:
+                self._stats.increment('parent_hits')
                 if _DEBUG_CACHE:
                     _debug_print('restored value for key "%s" from parent cache' % key)
-        if not restored:
+                # Promote the value with its cost. The parent keeps its copy, so that demoting it again is cheap.
+                self._put_value(key, value, self._parent_cache.get_cost(key))
+        if value is None and item is None:
             item = Cache.Item.load_from_key(self._store, key)
-            if item:
-                self._add_item(item)
-                value = item.restore(self._store, key)
-                if _DEBUG_CACHE:
-                    _debug_print('restored value for key "%s" from cache' % key)
-        self._lock.release()
+            if item is not None:
+                with self._lock:
+                    if key in self._item_dict:
+                        # another thread was faster
+                        item = self._item_dict[key]
+                        evicted_items = None
+                    else:
+                        evicted_items = self._add_item(item)
+                    self._evictor.access(item)
+                    stored_value = item.stored_value
+                self._discard_items(evicted_items)
+                value = self._restore_item(item, key, stored_value)
+                if value is not None:
+                    self._stats.increment('store_loads')
+                    if _DEBUG_CACHE:
+                        _debug_print('restored value for key "%s" from cache' % key)
+        if value is None:
+            self._stats.increment('misses')
         return value
 
-    def put_value(self, key, value):
-        self._lock.acquire()
+    def put_value(self, key, value, cost=None):
+        """
+        Put *value* into the cache.
+
+        :param key: the key
+        :param value: the value
+        :param cost: optional cost of recomputing *value*, e.g. the time in seconds it took to compute it.
+               Values whose cost is less than :py:attr:`min_cost` are not cached.
+        """
+        if cost is not None and self._min_cost is not None and cost < self._min_cost:
+            # Cheaper to recompute than to cache
+            self._stats.increment('rejected_puts')
+            self.remove_value(key)
+            return
         if self._parent_cache:
             # remove value from parent cache, because this cache will now take over
             self._parent_cache.remove_value(key)
-        item = self._item_dict.get(key)
-        if item:
-            self._remove_item(item)
-            item.discard(self._store, key)
+        self._put_value(key, value, cost)
+
+    def has_value(self, key) -> bool:
+        """ Test whether this cache holds a value for *key*, ignoring the parent cache and the store's keys. """
+        return key in self._item_dict
+
+    def get_cost(self, key) -> Optional[float]:
+        """ Get the cost the value for *key* has been put into this cache with, or None. """
+        with self._lock:
+            item = self._item_dict.get(key)
+            return item.cost if item is not None else None
+
+    def replace_value(self, key, value) -> bool:
+        """
+        Replace the value for *key* by *value*, if this cache holds a value for *key*.
+        Unlike :py:meth:`put_value`, the value keeps the cost it has been put with
+        and the parent cache is left untouched.
+
+        :param key: the key
+        :param value: the new value
+        :return: True, if the value has been replaced
+        """
+        with self._lock:
+            old_item = self._item_dict.get(key)
+            if old_item is None:
+                return False
+            self._remove_item(old_item)
+            cost = old_item.cost
+        self._discard_item(old_item, key)
+        self._add_value(key, value, cost)
+        return True
+
+    def _put_value(self, key, value, cost):
+        with self._lock:
+            old_item = self._item_dict.get(key)
+            if old_item is not None:
+                self._remove_item(old_item)
+        if old_item is not None:
+            self._discard_item(old_item, key)
             if _DEBUG_CACHE:
                 _debug_print('discarded value for key "%s" from cache' % key)
-        else:
+        self._add_value(key, value, cost)
+
+    def _add_value(self, key, value, cost):
+        while True:
             item = Cache.Item()
-        item.store(self._store, key, value)
-        if _DEBUG_CACHE:
-            _debug_print('stored value for key "%s" in cache' % key)
-        self._add_item(item)
-        self._lock.release()
+            t0 = time.perf_counter()
+            item.store(self._store, key, value, cost=cost)
+            self._stats.store_latency.record(time.perf_counter() - t0)
+            self._stats.increment('puts')
+            self._stats.increment('bytes_put', item.stored_size)
+            if _DEBUG_CACHE:
+                _debug_print('stored value for key "%s" in cache' % key)
+            with self._lock:
+                other_item = self._item_dict.get(key)
+                if other_item is None:
+                    evicted_items = self._add_item(item)
+                    break
+                # A concurrent put_value() for the same key was faster. Its stored value
+                # has been superseded by ours, so it is removed and discarded.
+                self._remove_item(other_item)
+            # Stores that keep values by key, e.g. files, may discard ours too, so we store it again
+            self._discard_item(other_item, key)
+            self._discard_item(item, key)
+        self._discard_items(evicted_items)
 
     def remove_value(self, key):
-        self._lock.acquire()
         if self._parent_cache:
             self._parent_cache.remove_value(key)
-        item = self._item_dict.get(key)
-        if item:
-            self._remove_item(item)
-            item.discard(self._store, key)
+        with self._lock:
+            item = self._item_dict.get(key)
+            if item is not None:
+                self._remove_item(item)
+        if item is not None:
+            self._stats.increment('removals')
+            self._discard_item(item, key)
             if _DEBUG_CACHE:
-                _debug_print('Cache: discarded value for key "%s" from parent cache' % key)
-        self._lock.release()
+                _debug_print('discarded value for key "%s" from cache' % key)
+
+    def remove_namespace(self, namespace, remove_from_parent=True) -> int:
+        """
+        Remove all values whose keys are in the given *namespace*.
+        Takes time proportional to the number of values actually removed, not to the number of possible keys.
+
+        :param namespace: the namespace, as returned by the cache's *namespace_function*
+        :param remove_from_parent: whether to remove the values from the parent cache too
+        :return: the number of values removed from this cache
+        :raise ValueError: if this cache has no *namespace_function*
+        """
+        if self._namespace_function is None:
+            raise ValueError('cache has no namespace function')
+        if self._parent_cache is not None and remove_from_parent:
+            self._parent_cache.remove_namespace(namespace)
+        with self._lock:
+            items = list(self._namespaces.get(namespace, {}).values())
+            for item in items:
+                self._remove_item(item)
+        for item in items:
+            self._stats.increment('removals')
+            self._discard_item(item, item.key)
+        return len(items)
+
+    def trim(self, extra_size=0):
+        """
+        Evict items until the cache size plus *extra_size* no longer exceeds :py:attr:`max_size`.
+
+        :param extra_size: size of a value that is about to be added
+        """
+        if _DEBUG_CACHE:
+            _debug_print('trimming...')
+        with self._lock:
+            evicted_items = self._evict_items(extra_size)
+        self._discard_items(evicted_items)
+
+    def clear(self, clear_parent=True):
+        if self._parent_cache and clear_parent:
+            self._parent_cache.clear(clear_parent)
+        with self._lock:
+            items = list(self._item_dict.values())
+            self._item_dict.clear()
+            self._namespaces.clear()
+            self._evictor.clear()
+            self._size = 0
+        if self._parent_cache and not clear_parent:
+            self._discard_items(items)
+        else:
+            for item in items:
+                item.discard(self._store, item.key)
+
+    def recover(self):
+        """
+        Recover the values already held by the cache store, e.g. values stored by a previous server run,
+        see :py:meth:`CacheStore.scan_values`. Recovered values are passed to the replacement policy
+        and are evicted if the cache capacity is exceeded.
+
+        This method may take a while and may be called from a background thread.
+        """
+        for key, stored_value, stored_size in self._store.scan_values():
+            self._recover_item(key, stored_value, stored_size)
+
+    def write_snapshot(self, path: str, fraction: float = 1.0, tag_function: Callable[[Any], Any] = None) -> int:
+        """
+        Write the hottest items of this cache to a snapshot file, so that they can be read by
+        :py:meth:`read_snapshot` after a restart. Items are ranked by their access count, then by their
+        last access. Only values supported by :py:meth:`CacheStore.snapshot_value` are written.
+
+        :param path: the snapshot file path. An existing file is replaced.
+        :param fraction: the fraction of items to be written, a number between 0 and 1
+        :param tag_function: optional function that maps a key to a JSON-serializable tag, e.g. a fingerprint
+               of the data the value has been computed from. Items whose tag is None are not written.
+        :return: the number of items written
+        """
+        return _write_snapshot(path, self._store, self._get_items(), fraction, tag_function)
 
-    def _add_item(self, item):
+    def read_snapshot(self, path: str, tag_filter: Callable[[Any, Any], bool] = None) -> int:
+        """
+        Read the items of a snapshot file written by :py:meth:`write_snapshot`. The items keep their access counts
+        and costs. Their values are memory-mapped and are only read from disk when they are used.
+        Items whose keys are already in this cache are skipped.
+
+        :param path: the snapshot file path
+        :param tag_filter: optional function that receives a key and its tag and returns False,
+               if the item must be skipped, e.g. because its fingerprint no longer matches.
+        :return: the number of items read
+        :raise OSError: if the file cannot be read
+        :raise ValueError: if the file is not a snapshot file
+        """
+        num_items = 0
+        for key, stored_value, stored_size, access_count, cost in _read_snapshot(path, self._store, tag_filter):
+            if self._recover_item(key, stored_value, stored_size, access_count=access_count, cost=cost):
+                num_items += 1
+        return num_items
+
+    def _get_items(self) -> List['Cache.Item']:
+        with self._lock:
+            return list(self._item_dict.values())
+
+    def _recover_item(self, key, stored_value, stored_size, access_count=None, cost=None) -> bool:
+        item = Cache.Item()
+        item.key = key
+        item.stored_value = stored_value
+        item.stored_size = stored_size
+        item.cost = cost
+        item._access()
+        item.creation_time = item.access_time
+        if access_count is not None:
+            item.access_count = access_count
+        with self._lock:
+            if key in self._item_dict:
+                return False
+            evicted_items = self._add_item(item)
+        self._discard_items(evicted_items)
+        return True
+
+    def _add_item(self, item) -> List['Cache.Item']:
+        """ Add *item* and return the items evicted to make room for it. Must be called with the lock held. """
+        evicted_items = self._evict_items(item.stored_size)
         self._item_dict[item.key] = item
-        self._item_list.append(item)
-        if self._size + item.stored_size > self._max_size:
-            self.trim(item.stored_size)
+        if self._namespace_function is not None:
+            self._namespaces.setdefault(self._namespace_function(item.key), {})[item.key] = item
+        self._evictor.add(item)
         self._size += item.stored_size
+        return evicted_items
 
     def _remove_item(self, item):
+        """ Remove *item* from the bookkeeping. Must be called with the lock held. """
         self._item_dict.pop(item.key)
-        self._item_list.remove(item)
+        self._remove_item_from_namespace(item)
+        self._evictor.remove(item)
         self._size -= item.stored_size
 
-    def trim(self, extra_size=0):
-        if _DEBUG_CACHE:
-            _debug_print('trimming...')
-        self._lock.acquire()
-        self._item_list.sort(key=self._policy)
-        keys = []
-        size = self._size
-        max_size = self._max_size
-        for item in self._item_list:
-            if size + extra_size > max_size:
-                keys.append(item.key)
-                size -= item.stored_size
-        self._lock.release()
-        # release lock to give another thread a chance then require lock again
-        self._lock.acquire()
-        for key in keys:
-            if self._parent_cache:
+    def _remove_item_from_namespace(self, item):
+        if self._namespace_function is None:
+            return
+        namespace = self._namespace_function(item.key)
+        namespace_items = self._namespaces.get(namespace)
+        if namespace_items is not None:
+            namespace_items.pop(item.key, None)
+            if not namespace_items:
+                del self._namespaces[namespace]
+
+    def _evict_items(self, extra_size) -> List['Cache.Item']:
+        """ Evict items from the bookkeeping and return them. Must be called with the lock held. """
+        evicted_items = []
+        while self._size + extra_size > self._max_size:
+            item = self._evictor.evict()
+            if item is None:
+                break
+            self._item_dict.pop(item.key)
+            self._remove_item_from_namespace(item)
+            self._size -= item.stored_size
+            evicted_items.append(item)
+        return evicted_items
+
+    def _discard_items(self, items: Optional[List['Cache.Item']]):
+        """ Discard the values of evicted *items* from the store. Must be called without holding the lock. """
+        if not items:
+            return
+        for item in items:
+            key = item.key
+            self._stats.increment('evictions')
+            self._stats.increment('bytes_evicted', item.stored_size)
+            if self._parent_cache and not self._parent_cache.has_value(key):
                 # Before discarding item fully, put its value into the parent cache
-                value = self.get_value(key)
-                self.remove_value(key)
-                if value:
-                    self._parent_cache.put_value(key, value)
+                value = self._restore_item(item, key, item.stored_value)
+                cost = item.cost
+                self._discard_item(item, key)
+                if value is not None:
+                    self._parent_cache.put_value(key, value, cost=cost)
             else:
-                self.remove_value(key)
-        self._lock.release()
+                self._discard_item(item, key)
+            if _DEBUG_CACHE:
+                _debug_print('evicted value for key "%s" from cache' % key)
+
+    def _restore_item(self, item, key, stored_value):
+        if stored_value is None:
+            # the item has been discarded concurrently
+            return None
+        t0 = time.perf_counter()
+        try:
+            return item.restore(self._store, key, stored_value)
+        except OSError:
+            # the stored value has been discarded concurrently
+            return None
+        finally:
+            self._stats.restore_latency.record(time.perf_counter() - t0)
+
+    def _discard_item(self, item, key):
+        t0 = time.perf_counter()
+        item.discard(self._store, key)
+        self._stats.discard_latency.record(time.perf_counter() - t0)
+
+
+class ShardedCache:
+    """
+    A cache that distributes its keys over a number of independent :py:class:`Cache` shards.
+    Every shard has its own lock, size budget and replacement policy, so that concurrent
+    threads accessing different keys rarely contend for the same lock.
+
+    The constructor parameters are the same as for :py:class:`Cache`. The *capacity* is
+    evenly split among all shards.
+
+    :param num_shards: the number of shards
+    """
+
+    def __init__(self, store=MemoryCacheStore(), capacity=1000, threshold=0.75, policy=POLICY_LRU, parent_cache=None,
+                 min_cost=None, name=None, namespace_function=None, num_shards=16):
+        if num_shards < 1:
+            raise ValueError('num_shards must be a positive integer')
+        self._name = name
+        self._store = store
+        self._capacity = capacity
+        self._threshold = threshold
+        self._policy = policy
+        self._min_cost = min_cost
+        self._parent_cache = parent_cache
+        self._namespace_function = namespace_function
+        self._shards = [Cache(store=store,
+                              capacity=capacity / num_shards,
+                              threshold=threshold,
+                              policy=policy,
+                              parent_cache=parent_cache,
+                              min_cost=min_cost,
+                              namespace_function=namespace_function) for _ in range(num_shards)]
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def parent_cache(self):
+        return self._parent_cache
+
+    @property
+    def namespace_function(self):
+        return self._namespace_function
+
+    @property
+    def policy(self):
+        return self._policy
+
+    @property
+    def store(self):
+        return self._store
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def threshold(self):
+        return self._threshold
+
+    @property
+    def min_cost(self):
+        return self._min_cost
+
+    @property
+    def size(self):
+        return sum(shard.size for shard in self._shards)
+
+    @property
+    def max_size(self):
+        return sum(shard.max_size for shard in self._shards)
+
+    @property
+    def shards(self) -> List[Cache]:
+        return list(self._shards)
+
+    def get_stats(self) -> dict:
+        """ Get the cache's occupancy and statistics, summed over all shards, as JSON-serializable dictionary. """
+        stats = CacheStats()
+        for shard in self._shards:
+            stats.merge(shard.stats)
+        return dict(name=self._name,
+                    policy=get_policy_name(self._policy),
+                    capacity=self._capacity,
+                    max_size=self.max_size,
+                    size=self.size,
+                    num_items=sum(shard.num_items for shard in self._shards),
+                    num_shards=len(self._shards),
+                    **stats.to_dict())
+
+    def get_value(self, key):
+        return self._get_shard(key).get_value(key)
+
+    def put_value(self, key, value, cost=None):
+        self._get_shard(key).put_value(key, value, cost=cost)
+
+    def has_value(self, key) -> bool:
+        return self._get_shard(key).has_value(key)
+
+    def get_cost(self, key) -> Optional[float]:
+        return self._get_shard(key).get_cost(key)
+
+    def replace_value(self, key, value) -> bool:
+        return self._get_shard(key).replace_value(key, value)
+
+    def remove_value(self, key):
+        self._get_shard(key).remove_value(key)
+
+    def remove_namespace(self, namespace, remove_from_parent=True) -> int:
+        """ See :py:meth:`Cache.remove_namespace`. """
+        if self._parent_cache is not None and remove_from_parent:
+            self._parent_cache.remove_namespace(namespace)
+        return sum(shard.remove_namespace(namespace, remove_from_parent=False) for shard in self._shards)
+
+    def trim(self, extra_size=0):
+        for shard in self._shards:
+            shard.trim(extra_size / len(self._shards))
 
     def clear(self, clear_parent=True):
-        self._lock.acquire()
-        if self._parent_cache and clear_parent:
-            self._parent_cache.clear(clear_parent)
-        keys = list(self._item_dict.keys())
-        self._lock.release()
-        for key in keys:
-            if self._parent_cache and not clear_parent:
-                value = self.get_value(key)
-                if value:
-                    self._parent_cache.put_value(key, value)
-            self.remove_value(key)
+        for shard in self._shards:
+            shard.clear(clear_parent)
+
+    def recover(self):
+        """ See :py:meth:`Cache.recover`. """
+        for key, stored_value, stored_size in self._store.scan_values():
+            self._get_shard(key)._recover_item(key, stored_value, stored_size)
+
+    def write_snapshot(self, path: str, fraction: float = 1.0, tag_function: Callable[[Any], Any] = None) -> int:
+        """ See :py:meth:`Cache.write_snapshot`. Items are ranked across all shards. """
+        items = [item for shard in self._shards for item in shard._get_items()]
+        return _write_snapshot(path, self._store, items, fraction, tag_function)
+
+    def read_snapshot(self, path: str, tag_filter: Callable[[Any, Any], bool] = None) -> int:
+        """ See :py:meth:`Cache.read_snapshot`. """
+        num_items = 0
+        for key, stored_value, stored_size, access_count, cost in _read_snapshot(path, self._store, tag_filter):
+            if self._get_shard(key)._recover_item(key, stored_value, stored_size,
+                                                  access_count=access_count, cost=cost):
+                num_items += 1
+        return num_items
+
+    def _get_shard(self, key) -> Cache:
+        return self._shards[hash(key) % len(self._shards)]
+
+
+class SingleFlight:
+    """
+    Suppresses duplicate concurrent calls. While a call for a given key is in flight,
+    other callers for the same key wait for it to finish and share its result (or exception)
+    instead of performing the same work again.
+    """
+
+    class _Call:
+        __slots__ = ('event', 'result', 'error')
+
+        def __init__(self):
+            self.event = Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = dict()
+        self._lock = Lock()
+        self._num_calls = 0
+        self._num_shared = 0
+
+    @property
+    def num_calls(self) -> int:
+        """ Number of calls actually performed. """
+        return self._num_calls
+
+    @property
+    def num_shared(self) -> int:
+        """ Number of callers that shared the result of a call in flight, i.e. the number of calls saved. """
+        return self._num_shared
+
+    @property
+    def num_in_flight(self) -> int:
+        """ Number of calls currently in flight. """
+        return len(self._calls)
+
+    def do(self, key, function: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Call *function* with the given arguments, unless a call for *key* is already in flight.
+        In this case wait for that call and return its result.
+
+        :param key: the key that identifies the call
+        :param function: the function to be called
+        :return: the function's result
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self._num_shared += 1
+                leader = False
+            else:
+                call = SingleFlight._Call()
+                self._calls[key] = call
+                self._num_calls += 1
+                leader = True
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+            return call.result
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+class LruObjectCache:
+    """
+    A thread-safe cache for a limited number of objects, e.g. image pyramids, that are expensive to create.
+    Objects are created single-flight by :py:meth:`get_or_create`: concurrent callers requesting the same
+    missing key wait for a single creation. If the capacity is exceeded, the least recently used objects
+    are evicted and passed to the *dispose* function.
+
+    :param capacity: the maximum number of objects
+    :param dispose: optional function that is called with every evicted object
+    :param name: optional name used in statistics
+    """
+
+    def __init__(self, capacity: int, dispose: Callable[[Any], None] = None, name: str = None):
+        if capacity <= 0:
+            raise ValueError('capacity must be positive')
+        self._capacity = capacity
+        self._dispose = dispose
+        self._name = name
+        self._objects = OrderedDict()
+        self._flight = SingleFlight()
+        self._lock = Lock()
+        self._stats = CacheStats()
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    @property
+    def name(self) -> Optional[str]:
+        return self._name
+
+    def __len__(self) -> int:
+        return len(self._objects)
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._objects
+
+    def get(self, key, default=None):
+        """
+        Get the object for *key* and mark it as most recently used.
+
+        :param key: the key
+        :param default: the value returned if there is no object for *key*
+        :return: the object or *default*
+        """
+        with self._lock:
+            obj = self._objects.get(key)
+            if obj is None:
+                return default
+            self._objects.move_to_end(key)
+        self._stats.increment('hits')
+        return obj
+
+    def get_or_create(self, key, factory: Callable[[], Any]):
+        """
+        Get the object for *key*. If there is none, create it by calling *factory*,
+        unless another thread is already creating it, in which case its result is shared.
+
+        :param key: the key
+        :param factory: a function without arguments that creates the object
+        :return: the object
+        """
+        obj = self.get(key)
+        if obj is not None:
+            return obj
+        return self._flight.do(key, self._create, key, factory)
+
+    def remove(self, key) -> bool:
+        """
+        Remove and dispose the object for *key*.
+
+        :param key: the key
+        :return: True, if there was such an object
+        """
+        with self._lock:
+            obj = self._objects.pop(key, None)
+        if obj is None:
+            return False
+        self._stats.increment('removals')
+        self._dispose_object(obj)
+        return True
+
+    def clear(self, dispose: bool = True):
+        """
+        Remove all objects.
+
+        :param dispose: whether to pass the removed objects to the *dispose* function
+        """
+        with self._lock:
+            objects = list(self._objects.values())
+            self._objects.clear()
+        if dispose:
+            for obj in objects:
+                self._dispose_object(obj)
+
+    def get_stats(self) -> dict:
+        """
+        Get the statistics of this cache.
+
+        :return: a JSON-serializable dictionary
+        """
+        stats = self._stats.to_dict()
+        return dict(name=self._name,
+                    capacity=self._capacity,
+                    num_items=len(self._objects),
+                    hits=stats['hits'],
+                    misses=stats['misses'],
+                    removals=stats['removals'],
+                    evictions=stats['evictions'],
+                    hit_ratio=stats['hit_ratio'])
+
+    def _create(self, key, factory: Callable[[], Any]):
+        with self._lock:
+            obj = self._objects.get(key)
+        if obj is not None:
+            # Created by a call that just left the flight
+            self._stats.increment('hits')
+            return obj
+        self._stats.increment('misses')
+        obj = factory()
+        evicted_objects = []
+        with self._lock:
+            self._objects[key] = obj
+            self._objects.move_to_end(key)
+            while len(self._objects) > self._capacity:
+                _, evicted_object = self._objects.popitem(last=False)
+                evicted_objects.append(evicted_object)
+        for evicted_object in evicted_objects:
+            self._stats.increment('evictions')
+            self._dispose_object(evicted_object)
+        return obj
+
+    def _dispose_object(self, obj):
+        if self._dispose is not None:
+            self._dispose(obj)
 
 
 def _debug_print(msg):
@@ -20,8 +20,11 @@
 # SOFTWARE.
 
 import glob
+import hashlib
+import json
 import logging
 import os
+import threading
 import time
 from typing import Any, Dict, List, Optional
 
@@ -33,11 +36,15 @@ import xarray as xr
 import zarr
 
 from . import __version__
-from .cache import MemoryCacheStore, Cache, FileCacheStore
+from .cache import MemoryCacheStore, CompressedMemoryCacheStore, FileCacheStore, NpyFileCacheStore, PackCacheStore, \
+    ContentAddressedCacheStore, ShardedCache, LruObjectCache, get_policy
 from .defaults import DEFAULT_CMAP_CBAR, DEFAULT_CMAP_VMIN, \
     DEFAULT_CMAP_VMAX, TRACE_PERF, MEM_TILE_CACHE_CAPACITY, FILE_TILE_CACHE_CAPACITY, FILE_TILE_CACHE_PATH, \
-    FILE_TILE_CACHE_ENABLED, API_PREFIX, DEFAULT_NAME
+    FILE_TILE_CACHE_ENABLED, API_PREFIX, DEFAULT_NAME, TILE_CACHE_NUM_SHARDS, TILE_CACHE_SNAPSHOT_FRACTION, \
+    PYRAMID_CACHE_CAPACITY, DEFAULT_TILE_MAX_AGE, RGB_TILE_CACHE_CAPACITY, DEFAULT_PALETTE_TILES, \
+    ADAPTIVE_FAST_COMPRESS_LEVEL, ADAPTIVE_STRONG_COMPRESS_LEVEL, TILE_COVERAGE_CACHE_CAPACITY
 from .errors import ServiceConfigError, ServiceError, ServiceBadRequestError, ServiceResourceNotFoundError
+from .im import get_tile_image_id, TileEncoding, AdaptiveTileEncoding
 from .logtime import log_time
 from .reqparams import RequestParams
 
@@ -46,6 +53,18 @@ ALL_FEATURES = "all"
 
 _LOG = logging.getLogger('xcube')
 
+# Maps the entries of the "TileEncodings" configuration to PIL encoder options
+# given as (option name, type, minimum, maximum)
+_TILE_ENCODING_OPTIONS = dict(
+    PNG=dict(CompressLevel=('compress_level', int, 0, 9),
+             Adaptive=('adaptive', bool, None, None),
+             FastCompressLevel=('fast_compress_level', int, 0, 9)),
+    WEBP=dict(Lossless=('lossless', bool, None, None),
+              Quality=('quality', int, 0, 100),
+              Method=('method', int, 0, 6)),
+    JPEG=dict(Quality=('quality', int, 1, 95)),
+)
+
 Config = Dict[str, Any]
 
 
@@ -61,17 +80,14 @@ class ServiceContext:
         self._config = config or dict()
         self.dataset_cache = dict()  # contains tuples of form (ds, ds_descriptor, tile_grid_cache)
         # TODO by forman: move pyramid_cache, mem_tile_cache, rgb_tile_cache into dataset_cache values
-        self.pyramid_cache = dict()
-        self.mem_tile_cache = Cache(MemoryCacheStore(),
-                                    capacity=MEM_TILE_CACHE_CAPACITY,
-                                    threshold=0.75)
-        if FILE_TILE_CACHE_ENABLED:
-            tile_cache_dir = os.path.join(FILE_TILE_CACHE_PATH, 'v%s' % __version__, 'tiles')
-            self.rgb_tile_cache = Cache(FileCacheStore(tile_cache_dir, ".png"),
-                                        capacity=FILE_TILE_CACHE_CAPACITY,
-                                        threshold=0.75)
-        else:
-            self.rgb_tile_cache = None
+        self.pyramid_cache = self._new_pyramid_cache()
+        self.tile_coverage_cache = LruObjectCache(TILE_COVERAGE_CACHE_CAPACITY, name='tile_coverage_cache')
+        self.zarr_store_caches = dict()
+        self.tile_image_dataset_names = dict()
+        self._dataset_generations = dict()
+        self._dataset_fingerprints = dict()
+        self.mem_tile_cache = self._new_mem_tile_cache()
+        self.rgb_tile_cache = self._new_rgb_tile_cache()
         self._feature_collection_cache = dict()
 
     @property
@@ -84,18 +100,450 @@ class ServiceContext:
             old_dataset_descriptors = self._config.get('Datasets')
             new_dataset_descriptors = config.get('Datasets')
             if not new_dataset_descriptors:
-                for ds, _, _ in self.dataset_cache.values():
-                    ds.close()
-                self.dataset_cache.clear()
+                for ds_name in list(self.dataset_cache.keys()):
+                    self._close_dataset(ds_name)
             if new_dataset_descriptors and old_dataset_descriptors:
                 ds_names = list(self.dataset_cache.keys())
                 for ds_name in ds_names:
                     dataset_descriptor = self.find_dataset_descriptor(new_dataset_descriptors, ds_name)
                     if dataset_descriptor is None:
-                        ds, _, _ = self.dataset_cache[ds_name]
-                        ds.close()
-                        del self.dataset_cache[ds_name]
+                        self._close_dataset(ds_name)
+        tile_caches_changed = self._config.get('TileCaches') != config.get('TileCaches')
         self._config = config
+        if tile_caches_changed:
+            # The new tile caches may use the same directories as the old ones
+            self.close_tile_caches()
+            # The pyramids refer to the old tile caches, so there is nothing to dispose
+            self.pyramid_cache.clear(dispose=False)
+            self.pyramid_cache = self._new_pyramid_cache()
+            self.mem_tile_cache = self._new_mem_tile_cache()
+            self.rgb_tile_cache = self._new_rgb_tile_cache()
+
+    def _new_pyramid_cache(self) -> LruObjectCache:
+        """
+        Create the cache for image pyramids. Its capacity is given by the "TileCaches/Pyramids/Capacity"
+        configuration entry. Evicted pyramids are disposed, which removes their tiles from the tile caches.
+        """
+        pyramids_config = (self._config.get('TileCaches') or {}).get('Pyramids') or {}
+        capacity = pyramids_config.get('Capacity', PYRAMID_CACHE_CAPACITY)
+        if not isinstance(capacity, int) or capacity <= 0:
+            raise ServiceConfigError('Invalid "TileCaches/Pyramids/Capacity", must be a positive integer')
+        return LruObjectCache(capacity, dispose=self._dispose_pyramid, name='pyramid_cache')
+
+    def _dispose_pyramid(self, pyramid):
+        pyramid.dispose()
+        # The tiles of the pyramid's level images are gone, so are the dataset names recorded for them.
+        # Their source images are shared with other pyramids and have not been disposed.
+        for z_index in range(pyramid.num_levels):
+            self.tile_image_dataset_names.pop(pyramid.get_level_image(z_index).id, None)
+
+    def _new_mem_tile_cache(self) -> ShardedCache:
+        """
+        Create the in-memory cache for array tiles as configured by the "TileCaches/ArrayTiles" configuration entry.
+        """
+        array_tiles_config = (self._config.get('TileCaches') or {}).get('ArrayTiles') or {}
+        return self._new_tile_cache(array_tiles_config, 'mem_tile_cache',
+                                    default_store='compressed',
+                                    default_tier_store='npy',
+                                    default_capacity=MEM_TILE_CACHE_CAPACITY)
+
+    def _new_rgb_tile_cache(self) -> ShardedCache:
+        """
+        Create the cache for encoded RGB tiles as configured by the "TileCaches/RgbTiles" configuration entry.
+        If there is no such entry, encoded tiles are kept in memory, with the file tile cache as
+        parent tier, if enabled.
+        """
+        rgb_tiles_config = (self._config.get('TileCaches') or {}).get('RgbTiles')
+        if rgb_tiles_config is None:
+            rgb_tiles_config = dict(Store='memory', Capacity=RGB_TILE_CACHE_CAPACITY)
+            if FILE_TILE_CACHE_ENABLED:
+                rgb_tiles_config.update(Tiers=[dict(Store='file', Capacity=FILE_TILE_CACHE_CAPACITY)])
+        elif rgb_tiles_config.get('Store') == 'memory' and 'Capacity' not in rgb_tiles_config:
+            rgb_tiles_config = dict(rgb_tiles_config, Capacity=RGB_TILE_CACHE_CAPACITY)
+        return self._new_tile_cache(rgb_tiles_config, 'rgb_tile_cache',
+                                    default_store='file',
+                                    default_tier_store='file',
+                                    default_capacity=FILE_TILE_CACHE_CAPACITY,
+                                    content_addressed=True)
+
+    def _new_tile_cache(self,
+                        cache_config: Dict[str, Any],
+                        name: str,
+                        default_store: str,
+                        default_tier_store: str,
+                        default_capacity: int,
+                        content_addressed: bool = False) -> ShardedCache:
+        """
+        Create a tile cache and the tiers given by the "Tiers" list of *cache_config*.
+        Every tier is the parent cache of the previous one, which receives the values evicted from it.
+        If *content_addressed* is True, the stores of all tiers store identical encoded tiles only once.
+        """
+        tier_configs = cache_config.get('Tiers') or []
+        parent_cache = None
+        for i in reversed(range(len(tier_configs))):
+            parent_cache = self._new_tile_cache_tier(tier_configs[i], f'{name}/tier-{i + 1}',
+                                                     default_tier_store, default_capacity, parent_cache,
+                                                     content_addressed)
+        return self._new_tile_cache_tier(cache_config, name, default_store, default_capacity, parent_cache,
+                                         content_addressed)
+
+    def _new_tile_cache_tier(self,
+                             tier_config: Dict[str, Any],
+                             name: str,
+                             default_store: str,
+                             default_capacity: int,
+                             parent_cache: Optional[ShardedCache],
+                             content_addressed: bool) -> ShardedCache:
+        store_name = tier_config.get('Store', default_store)
+        if store_name == 'compressed':
+            store = CompressedMemoryCacheStore()
+        elif store_name == 'memory':
+            store = MemoryCacheStore()
+        elif store_name in ('file', 'pack', 'npy'):
+            cache_path = tier_config.get('Path')
+            if cache_path is None:
+                cache_path = FILE_TILE_CACHE_PATH
+            elif not os.path.isabs(cache_path):
+                cache_path = os.path.join(self.base_dir, cache_path)
+            cache_path = os.path.join(cache_path, 'v%s' % __version__)
+            if store_name == 'file':
+                store = FileCacheStore(os.path.join(cache_path, 'tiles'), ".png", sharded=True, write_behind=True)
+            elif store_name == 'pack':
+                store = PackCacheStore(os.path.join(cache_path, 'packs'))
+            else:
+                store = NpyFileCacheStore(os.path.join(cache_path, 'arrays'), sharded=True, write_behind=True)
+        else:
+            raise ServiceConfigError(f'Invalid store "{store_name}" for tile cache "{name}", '
+                                     f'must be one of "compressed", "memory", "file", "pack", "npy"')
+        if content_addressed:
+            store = ContentAddressedCacheStore(store, persistent=store_name in ('file', 'pack'))
+        policy_name = tier_config.get('Policy', 'LRU')
+        try:
+            policy = get_policy(policy_name)
+        except ValueError as e:
+            raise ServiceConfigError(f'Invalid policy for tile cache "{name}": {e}') from e
+        tile_cache = ShardedCache(store,
+                                  capacity=tier_config.get('Capacity', default_capacity),
+                                  threshold=0.75,
+                                  policy=policy,
+                                  parent_cache=parent_cache,
+                                  min_cost=tier_config.get('MinCost'),
+                                  name=name,
+                                  namespace_function=get_tile_image_id,
+                                  num_shards=TILE_CACHE_NUM_SHARDS)
+        if store_name in ('file', 'pack', 'npy'):
+            # Recover tiles written by a previous server run without delaying startup
+            threading.Thread(target=tile_cache.recover,
+                             name='xcube-tile-cache-recovery',
+                             daemon=True).start()
+        return tile_cache
+
+    def flush_tile_caches(self):
+        """
+        Block until the values queued by the write-behind file stores of all tile cache tiers have been written.
+        """
+        for store in self._get_tile_cache_stores():
+            if isinstance(store, FileCacheStore):
+                store.flush()
+
+    def close_tile_caches(self):
+        """
+        Flush the tile caches, see :py:meth:`flush_tile_caches`, and close the pack stores of all tile cache tiers,
+        which waits for their running compactions. Values queued for writing would otherwise be lost,
+        and pack stores opened later for the same directories would compete with the old ones.
+        """
+        self.flush_tile_caches()
+        for store in self._get_tile_cache_stores():
+            if isinstance(store, PackCacheStore):
+                store.close()
+
+    def _get_tile_cache_stores(self):
+        for tile_cache in (self.mem_tile_cache, self.rgb_tile_cache):
+            # Include all tiers
+            while tile_cache is not None:
+                store = tile_cache.store
+                if isinstance(store, ContentAddressedCacheStore):
+                    store = store.store
+                yield store
+                tile_cache = tile_cache.parent_cache
+
+    def get_dataset_generation(self, ds_name: str) -> int:
+        """
+        Get the generation of the dataset given by *ds_name*. It is incremented whenever the dataset is closed,
+        so that it will be reloaded when used next time. Tile identifiers include the generation, hence all tiles
+        computed from previous generations are invalidated at once: they are no longer requested and are evicted
+        from the tile caches as they age.
+
+        :param ds_name: the dataset name
+        :return: the dataset generation, zero for datasets never closed
+        """
+        return self._dataset_generations.get(ds_name, 0)
+
+    def _close_dataset(self, ds_name: str):
+        ds, _, _ = self.dataset_cache.pop(ds_name)
+        ds.close()
+        self._dataset_fingerprints.pop(ds_name, None)
+        self._dataset_generations[ds_name] = self.get_dataset_generation(ds_name) + 1
+        for image_id, image_ds_name in list(self.tile_image_dataset_names.items()):
+            if image_ds_name == ds_name:
+                self.tile_image_dataset_names.pop(image_id, None)
+
+    def set_tile_image_dataset_name(self, image_id: str, ds_name: str):
+        """
+        Record that the tiles of the tiled image given by *image_id* are computed from dataset *ds_name*.
+        """
+        self.tile_image_dataset_names[image_id] = ds_name
+
+    def get_tile_dataset_name(self, tile_id: str) -> Optional[str]:
+        """
+        Get the name of the dataset from which the tile given by *tile_id* has been computed.
+
+        :param tile_id: a tile identifier as returned by ``TiledImage.get_tile_id()``
+        :return: the dataset name or None, if unknown
+        """
+        return self.tile_image_dataset_names.get(get_tile_image_id(tile_id))
+
+    def get_dataset_fingerprint(self, ds_name: str) -> Optional[str]:
+        """
+        Get a fingerprint of the dataset given by *ds_name*. It changes, if the dataset's configuration changes,
+        or, for local and computed datasets, if the modification times or sizes of its file or of the
+        top-level entries of its directory change.
+
+        :param ds_name: the dataset name
+        :return: the fingerprint or None, if the dataset is not configured or its files cannot be accessed
+        """
+        dataset_descriptor = self.find_dataset_descriptor(self._config.get('Datasets') or [], ds_name)
+        if dataset_descriptor is None:
+            return None
+        md5 = hashlib.md5(json.dumps(dataset_descriptor, sort_keys=True, default=str).encode('utf-8'))
+        fs_type = dataset_descriptor.get('FileSystem', 'local')
+        path = dataset_descriptor.get('Path')
+        if fs_type in ('local', 'computed') and path:
+            if not os.path.isabs(path):
+                path = os.path.join(self.base_dir, path)
+            try:
+                stat = os.stat(path)
+                md5.update(f'{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8'))
+                if os.path.isdir(path):
+                    for entry in sorted(os.scandir(path), key=lambda e: e.name):
+                        stat = entry.stat()
+                        md5.update(f'{entry.name}:{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8'))
+            except OSError:
+                return None
+        if fs_type == 'computed':
+            # Computed datasets also change, if the datasets they reference change
+            for arg_value in dataset_descriptor.get('Args', []):
+                if isinstance(arg_value, str) and len(arg_value) > 2 \
+                        and arg_value.startswith('@') and arg_value.endswith('@'):
+                    ref_fingerprint = self.get_dataset_fingerprint(arg_value[1:-1])
+                    if ref_fingerprint is None:
+                        return None
+                    md5.update(ref_fingerprint.encode('utf-8'))
+        return md5.hexdigest()
+
+    def get_opened_dataset_fingerprint(self, ds_name: str) -> Optional[str]:
+        """
+        Get the fingerprint of the dataset given by *ds_name* as it was when the dataset was opened,
+        see :py:meth:`get_dataset_fingerprint`. Unlike the latter, it does not change while the opened dataset
+        is in use, so it can be used to validate responses computed from the opened dataset.
+        The dataset is opened, if not already done.
+
+        :param ds_name: the dataset name
+        :return: the fingerprint or None, if it could not be computed
+        """
+        self.get_dataset(ds_name)
+        return self._dataset_fingerprints.get(ds_name)
+
+    def get_dataset_version(self, ds_name: str) -> Optional[str]:
+        """
+        Get a short token that identifies the version of the opened dataset given by *ds_name*.
+        It is derived from :py:meth:`get_opened_dataset_fingerprint` and used in tile URLs, so that a
+        dataset change results in new tile URLs.
+
+        :param ds_name: the dataset name
+        :return: the version token or None, if the dataset's fingerprint is unknown
+        """
+        fingerprint = self.get_opened_dataset_fingerprint(ds_name)
+        return fingerprint[0:16] if fingerprint is not None else None
+
+    def get_tile_max_age(self, ds_name: str = None) -> int:
+        """
+        Get the time in seconds clients may use tiles of the dataset given by *ds_name* without revalidating them.
+        It is given by the "TileMaxAge" entry of the dataset descriptor or of the configuration.
+
+        :param ds_name: the dataset name or None for tiles not computed from a dataset
+        :return: the maximum age in seconds
+        """
+        max_age = self._config.get('TileMaxAge', DEFAULT_TILE_MAX_AGE)
+        if ds_name is not None:
+            dataset_descriptor = self.find_dataset_descriptor(self._config.get('Datasets') or [], ds_name)
+            if dataset_descriptor is not None:
+                max_age = dataset_descriptor.get('TileMaxAge', max_age)
+        if not isinstance(max_age, int) or max_age < 0:
+            raise ServiceConfigError('Invalid "TileMaxAge", must be a non-negative integer')
+        return max_age
+
+    def get_tile_encoding(self, ds_name: Optional[str], extension: str) -> Optional[TileEncoding]:
+        """
+        Get the encoding of tiles of the dataset given by *ds_name* requested with the file name *extension*.
+        The encoder options are given by the "TileEncodings" entry of the configuration, whose entries
+        may be overridden by the "TileEncodings" entry of the dataset descriptor, e.g.::
+
+            TileEncodings:
+              PNG:
+                CompressLevel: 6
+                Adaptive: false
+                FastCompressLevel: 1
+              WebP:
+                Lossless: false
+                Quality: 80
+              JPEG:
+                Quality: 85
+
+        If "Adaptive" is true, PNG tiles are encoded with "FastCompressLevel" while the server is busy,
+        and re-encoded with "CompressLevel" later, see :py:class:`AdaptiveTileEncoding`.
+
+        :param ds_name: the dataset name or None for tiles not computed from a dataset
+        :param extension: the tile file name extension, e.g. "png", "webp", or "jpg"
+        :return: the tile encoding or None, if the extension is not supported
+        """
+        encoding = TileEncoding.from_extension(extension)
+        if encoding is None:
+            return None
+        format_configs = [self._config.get('TileEncodings')]
+        if ds_name is not None:
+            dataset_descriptor = self.find_dataset_descriptor(self._config.get('Datasets') or [], ds_name)
+            if dataset_descriptor is not None:
+                format_configs.append(dataset_descriptor.get('TileEncodings'))
+        option_specs = _TILE_ENCODING_OPTIONS[encoding.format]
+        options = dict()
+        for format_config in format_configs:
+            if not format_config:
+                continue
+            if not isinstance(format_config, dict):
+                raise ServiceConfigError('Invalid "TileEncodings", must be a mapping')
+            format_config = {k.upper(): v for k, v in format_config.items()}.get(encoding.format) or {}
+            for key, value in format_config.items():
+                if key not in option_specs:
+                    raise ServiceConfigError(f'Invalid "TileEncodings" entry "{key}" for {encoding.format}')
+                name, option_type, min_value, max_value = option_specs[key]
+                if type(value) is not option_type \
+                        or (min_value is not None and not (min_value <= value <= max_value)):
+                    raise ServiceConfigError(f'Invalid value for "TileEncodings" entry "{key}" '
+                                             f'for {encoding.format}: {value!r}')
+                options[name] = value
+        fast_compress_level = options.pop('fast_compress_level', ADAPTIVE_FAST_COMPRESS_LEVEL)
+        if options.pop('adaptive', False):
+            options.setdefault('compress_level', ADAPTIVE_STRONG_COMPRESS_LEVEL)
+            return AdaptiveTileEncoding(encoding.format, fast_options=dict(compress_level=fast_compress_level),
+                                        **options)
+        return TileEncoding(encoding.format, **options)
+
+    def get_palette_tiles(self) -> bool:
+        """
+        Get whether color-mapped PNG tiles are encoded as 8-bit palette images instead of RGBA images.
+        It is given by the "PaletteTiles" entry of the configuration.
+
+        :return: True, if palette images are used
+        """
+        palette_tiles = self._config.get('PaletteTiles', DEFAULT_PALETTE_TILES)
+        if not isinstance(palette_tiles, bool):
+            raise ServiceConfigError('Invalid "PaletteTiles", must be a boolean')
+        return palette_tiles
+
+    def write_tile_cache_snapshots(self):
+        """
+        Write the hottest tiles of the in-memory tile caches to the snapshot files given by the
+        "TileCaches/ArrayTiles/Snapshot" and "TileCaches/RgbTiles/Snapshot" configuration entries.
+        Tiles are tagged with the fingerprint of the dataset they have been computed from as it was when the
+        dataset was opened, see :py:meth:`get_opened_dataset_fingerprint`. Tiles of datasets not opened are skipped.
+        Errors are logged.
+        """
+
+        def get_tag(tile_id: str):
+            ds_name = self.get_tile_dataset_name(tile_id)
+            if ds_name is None:
+                return None
+            fingerprint = self._dataset_fingerprints.get(ds_name)
+            return [ds_name, fingerprint] if fingerprint is not None else None
+
+        for tile_cache, snapshot_path, snapshot_fraction in self._get_tile_cache_snapshots():
+            try:
+                with log_time(f'wrote snapshot of tile cache {tile_cache.name!r} to {snapshot_path!r}'):
+                    num_tiles = tile_cache.write_snapshot(snapshot_path,
+                                                          fraction=snapshot_fraction,
+                                                          tag_function=get_tag)
+                _LOG.info(f'{num_tiles} tile(s) written to snapshot {snapshot_path!r}')
+            except (OSError, ValueError, TypeError) as e:
+                _LOG.error(f'failed to write snapshot of tile cache {tile_cache.name!r}: {e}')
+
+    def read_tile_cache_snapshots(self):
+        """
+        Read the tile cache snapshots written by :py:meth:`write_tile_cache_snapshots`, e.g. by a previous
+        server run. Tiles are memory-mapped and only read from disk when they are used.
+        Tiles whose dataset fingerprint no longer matches are skipped. Errors are logged.
+        """
+        fingerprints = dict()
+
+        def is_valid(tile_id: str, tag) -> bool:
+            if not isinstance(tag, list) or len(tag) != 2:
+                return False
+            ds_name, fingerprint = tag
+            if ds_name not in fingerprints:
+                fingerprints[ds_name] = self.get_dataset_fingerprint(ds_name)
+            if fingerprint is None or fingerprint != fingerprints[ds_name]:
+                return False
+            self.set_tile_image_dataset_name(get_tile_image_id(tile_id), ds_name)
+            return True
+
+        for tile_cache, snapshot_path, _ in self._get_tile_cache_snapshots():
+            if not os.path.exists(snapshot_path):
+                continue
+            try:
+                num_tiles = tile_cache.read_snapshot(snapshot_path, tag_filter=is_valid)
+                _LOG.info(f'{num_tiles} tile(s) of tile cache {tile_cache.name!r} '
+                          f'restored from snapshot {snapshot_path!r}')
+            except (OSError, ValueError) as e:
+                _LOG.error(f'failed to read snapshot of tile cache {tile_cache.name!r}: {e}')
+
+    def _get_tile_cache_snapshots(self):
+        tile_caches_config = self._config.get('TileCaches') or {}
+        for config_name, tile_cache in (('ArrayTiles', self.mem_tile_cache), ('RgbTiles', self.rgb_tile_cache)):
+            snapshot_config = (tile_caches_config.get(config_name) or {}).get('Snapshot')
+            if not snapshot_config:
+                continue
+            snapshot_path = snapshot_config.get('Path')
+            if not snapshot_path:
+                raise ServiceConfigError(f'Missing "Path" entry in "TileCaches/{config_name}/Snapshot"')
+            if not os.path.isabs(snapshot_path):
+                snapshot_path = os.path.join(self.base_dir, snapshot_path)
+            yield tile_cache, snapshot_path, snapshot_config.get('Fraction', TILE_CACHE_SNAPSHOT_FRACTION)
+
+    def get_cache_stats(self) -> List[Dict[str, Any]]:
+        """
+        Get the occupancy and statistics of all caches.
+
+        :return: a list of JSON-serializable dictionaries, one per cache
+        """
+        cache_stats = []
+        for tile_cache in (self.mem_tile_cache, self.rgb_tile_cache):
+            # Include all tiers
+            while tile_cache is not None:
+                cache_stats.append(tile_cache.get_stats())
+                tile_cache = tile_cache.parent_cache
+        cache_stats.append(self.pyramid_cache.get_stats())
+        cache_stats.append(self.tile_coverage_cache.get_stats())
+        for ds_name, store_cache in list(self.zarr_store_caches.items()):
+            if ds_name not in self.dataset_cache:
+                continue
+            hits, misses = store_cache.hits, store_cache.misses
+            cache_stats.append(dict(name=f'zarr_store_cache/{ds_name}',
+                                    max_size=getattr(store_cache, '_max_size', None),
+                                    size=getattr(store_cache, '_current_size', None),
+                                    hits=hits,
+                                    misses=misses,
+                                    hit_ratio=hits / (hits + misses) if hits + misses else None))
+        return cache_stats
 
     def get_service_url(self, base_url, *path: str):
         return base_url + '/' + self._name + API_PREFIX + '/' + '/'.join(path)
@@ -155,6 +603,9 @@ class ServiceContext:
 
             t1 = time.clock()
 
+            # Taken before opening, so that it never describes newer data than the one opened
+            fingerprint = self.get_dataset_fingerprint(ds_name)
+
             fs_type = dataset_descriptor.get('FileSystem', 'local')
             if fs_type == 'obs':
                 data_format = dataset_descriptor.get('Format', 'zarr')
@@ -168,8 +619,12 @@ class ServiceContext:
                 s3 = s3fs.S3FileSystem(anon=True, client_kwargs=client_kwargs)
                 store = s3fs.S3Map(root=path, s3=s3, check=False)
                 cached_store = zarr.LRUStoreCache(store, max_size=2 ** 28)
+                self.zarr_store_caches[ds_name] = cached_store
                 with log_time(f"opened remote dataset {path}"):
                     ds = xr.open_zarr(cached_store)
+                if fingerprint is not None:
+                    # Remote datasets have no file modification times, use their zarr metadata instead
+                    fingerprint = _update_fingerprint_from_zarr_metadata(fingerprint, cached_store)
             elif fs_type == 'local':
                 if not os.path.isabs(path):
                     path = os.path.join(self.base_dir, path)
@@ -234,6 +689,7 @@ class ServiceContext:
 
             tile_grid_cache = dict()
             self.dataset_cache[ds_name] = ds, dataset_descriptor, tile_grid_cache
+            self._dataset_fingerprints[ds_name] = fingerprint
 
             t2 = time.clock()
 
@@ -353,3 +809,15 @@ class ServiceContext:
                                 ds_name: str) -> Optional[Dict[str, Any]]:
         # TODO: optimize by dict/key lookup
         return next((dsd for dsd in dataset_descriptors if dsd['Identifier'] == ds_name), None)
+
+
+def _update_fingerprint_from_zarr_metadata(fingerprint: str, store) -> str:
+    md5 = hashlib.md5(fingerprint.encode('utf-8'))
+    # Consolidated metadata covers all arrays, otherwise use the group's attributes only
+    for key in ('.zmetadata', '.zattrs'):
+        try:
+            md5.update(store[key])
+            break
+        except KeyError:
+            pass
+    return md5.hexdigest()
@@ -0,0 +1,24 @@
+from typing import Dict
+
+from ..context import ServiceContext
+from ..im import get_tile_flight, get_uniform_tiles, get_adaptive_encoder
+
+
+def get_caches(ctx: ServiceContext) -> Dict:
+    tile_flight = get_tile_flight()
+    uniform_tiles = get_uniform_tiles()
+    adaptive_encoder = get_adaptive_encoder()
+    return dict(caches=ctx.get_cache_stats(),
+                tileComputations=dict(numCalls=tile_flight.num_calls,
+                                      numShared=tile_flight.num_shared,
+                                      numInFlight=tile_flight.num_in_flight),
+                uniformTiles=dict(numEmpty=uniform_tiles.num_empty,
+                                  numSolid=uniform_tiles.num_solid,
+                                  numComputed=uniform_tiles.num_computed),
+                adaptiveEncoding=dict(numPending=adaptive_encoder.num_pending,
+                                      numDeferred=adaptive_encoder.num_deferred,
+                                      encodeLatency=adaptive_encoder.encode_latency,
+                                      numFast=adaptive_encoder.num_fast,
+                                      numStrong=adaptive_encoder.num_strong,
+                                      numReencoded=adaptive_encoder.num_reencoded,
+                                      numDropped=adaptive_encoder.num_dropped))
@@ -1,5 +1,8 @@
+import hashlib
+import logging
+import threading
 import time
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
 import matplotlib
 import matplotlib.cm as cm
@@ -10,86 +13,82 @@ import xarray as xr
 import io
 import matplotlib.figure
 
-from ..im import ImagePyramid, TransformArrayImage, ColorMappedRgbaImage, TileGrid
+from .. import __version__
+from ..im import ImagePyramid, TransformArrayImage, ColorMappedRgbaImage, TileGrid, TileCoverage, TileEncoding, \
+    get_uniform_tiles
 from ..ne2 import NaturalEarth2Image
 from ..utils import compute_tile_grid
 from ..context import ServiceContext
-from ..defaults import TRACE_PERF, DEFAULT_CMAP_WIDTH, DEFAULT_CMAP_HEIGHT
+from ..defaults import TRACE_PERF, DEFAULT_CMAP_WIDTH, DEFAULT_CMAP_HEIGHT, TILE_COVERAGE_MAX_PENDING
 from ..errors import ServiceBadRequestError, ServiceError, ServiceResourceNotFoundError
 from ..reqparams import RequestParams
 
 
+_LOG = logging.getLogger('xcube')
+
+_TILE_COVERAGE_LOCK = threading.Lock()
+_TILE_COVERAGE_PENDING = set()
+
+
 def get_dataset_tile(ctx: ServiceContext,
                      ds_name: str,
                      var_name: str,
                      x: str, y: str, z: str,
-                     params: RequestParams):
+                     params: RequestParams,
+                     tile_format: str = 'png'):
     x = params.to_int('x', x)
     y = params.to_int('y', y)
     z = params.to_int('z', z)
+    encoding = get_tile_encoding(ctx, ds_name, tile_format)
+
+    var, var_indexers, (cmap_cbar, cmap_vmin, cmap_vmax), array_id, image_id = \
+        _get_dataset_tile_image_ids(ctx, ds_name, var_name, params, encoding)
+
+    no_data_value = var.attrs.get('_FillValue')
+    valid_range = var.attrs.get('valid_range')
+    if valid_range is None:
+        valid_min = var.attrs.get('valid_min')
+        valid_max = var.attrs.get('valid_max')
+        if valid_min is not None and valid_max is not None:
+            valid_range = [valid_min, valid_max]
+
+    # Make sure we work with 2D image arrays only
+    if var.ndim == 2:
+        assert len(var_indexers) == 0
+        array = var
+    elif var.ndim > 2:
+        assert len(var_indexers) == var.ndim - 2
+        array = var.sel(method='nearest', **var_indexers)
+    else:
+        raise ServiceBadRequestError(f'Variable "{var_name}" of dataset "{var_name}" '
+                                     'must be an N-D Dataset with N >= 2, '
+                                     f'but "{var_name}" is only {var.ndim}-D')
 
-    dataset, var = ctx.get_dataset_and_variable(ds_name, var_name)
-
-    dim_names = list(var.dims)
-    if 'lon' not in dim_names or 'lat' not in dim_names:
-        raise ServiceBadRequestError(f'Variable "{var_name}" of dataset "{ds_name}" is not geo-spatial')
-
-    dim_names.remove('lon')
-    dim_names.remove('lat')
-
-    var_indexers = ctx.get_var_indexers(ds_name, var_name, var, dim_names, params)
-
-    cmap_cbar = params.get_query_argument('cbar', default=None)
-    cmap_vmin = params.get_query_argument_float('vmin', default=None)
-    cmap_vmax = params.get_query_argument_float('vmax', default=None)
-    if cmap_cbar is None or cmap_vmin is None or cmap_vmax is None:
-        default_cmap_cbar, default_cmap_vmin, default_cmap_vmax = ctx.get_color_mapping(ds_name, var_name)
-        cmap_cbar = cmap_cbar or default_cmap_cbar
-        cmap_vmin = cmap_vmin or default_cmap_vmin
-        cmap_vmax = cmap_vmax or default_cmap_vmax
-
-    # TODO: use MD5 hashes as IDs instead
+    tile_grid = get_tile_grid(ctx, ds_name, var_name, var)
 
-    var_index_id = '-'.join(f'-{dim_name}={dim_value}' for dim_name, dim_value in var_indexers.items())
-    array_id = '%s-%s-%s' % (ds_name, var_name, var_index_id)
-    image_id = '%s-%s-%s-%s' % (array_id, cmap_cbar, cmap_vmin, cmap_vmax)
+    coverage = get_tile_coverage(ctx, array_id, array, tile_grid,
+                                 no_data_value=no_data_value, valid_range=valid_range)
+    if coverage is not None and not coverage.has_data(x, y, z):
+        # Tile has no valid data, so we neither need to read it nor to create its pyramid
+        return get_uniform_tiles().get_tile(tile_grid.tile_size, 'RGBA', (0, 0, 0, 0), encoding, is_empty=True)
 
-    if image_id in ctx.pyramid_cache:
-        pyramid = ctx.pyramid_cache[image_id]
-    else:
-        no_data_value = var.attrs.get('_FillValue')
-        valid_range = var.attrs.get('valid_range')
-        if valid_range is None:
-            valid_min = var.attrs.get('valid_min')
-            valid_max = var.attrs.get('valid_max')
-            if valid_min is not None and valid_max is not None:
-                valid_range = [valid_min, valid_max]
-
-        # Make sure we work with 2D image arrays only
-        if var.ndim == 2:
-            assert len(var_indexers) == 0
-            array = var
-        elif var.ndim > 2:
-            assert len(var_indexers) == var.ndim - 2
-            array = var.sel(method='nearest', **var_indexers)
-        else:
-            raise ServiceBadRequestError(f'Variable "{var_name}" of dataset "{var_name}" '
-                                         'must be an N-D Dataset with N >= 2, '
-                                         f'but "{var_name}" is only {var.ndim}-D')
-
-        cmap_vmin = np.nanmin(array.values) if np.isnan(cmap_vmin) else cmap_vmin
-        cmap_vmax = np.nanmax(array.values) if np.isnan(cmap_vmax) else cmap_vmax
+    def create_pyramid() -> ImagePyramid:
+        value_min = np.nanmin(array.values) if np.isnan(cmap_vmin) else cmap_vmin
+        value_max = np.nanmax(array.values) if np.isnan(cmap_vmax) else cmap_vmax
 
         def array_image_id_factory(level):
             return 'arr-%s/%s' % (array_id, level)
 
-        tile_grid = get_tile_grid(ctx, ds_name, var_name, var)
+        def tile_image_id(image_id_prefix, level):
+            level_image_id = '%s/%d' % (image_id_prefix, level)
+            ctx.set_tile_image_dataset_name(level_image_id, ds_name)
+            return level_image_id
 
         pyramid = ImagePyramid.create_from_array(array, tile_grid,
                                                  level_image_id_factory=array_image_id_factory)
         pyramid = pyramid.apply(lambda image, level:
                                 TransformArrayImage(image,
-                                                    image_id='tra-%s/%d' % (array_id, level),
+                                                    image_id=tile_image_id('tra-' + array_id, level),
                                                     flip_y=tile_grid.geo_extent.inv_y,
                                                     force_masked=True,
                                                     no_data_value=no_data_value,
@@ -97,18 +96,21 @@ def get_dataset_tile(ctx: ServiceContext,
                                                     tile_cache=ctx.mem_tile_cache))
         pyramid = pyramid.apply(lambda image, level:
                                 ColorMappedRgbaImage(image,
-                                                     image_id='rgb-%s/%d' % (image_id, level),
-                                                     value_range=(cmap_vmin, cmap_vmax),
+                                                     image_id=tile_image_id('rgb-' + image_id, level),
+                                                     value_range=(value_min, value_max),
                                                      cmap_name=cmap_cbar,
                                                      encode=True,
-                                                     format='PNG',
-                                                     tile_cache=ctx.rgb_tile_cache))
-        ctx.pyramid_cache[image_id] = pyramid
+                                                     encoding=encoding,
+                                                     tile_cache=ctx.rgb_tile_cache,
+                                                     indexed=ctx.get_palette_tiles()))
         if TRACE_PERF:
             print('Created pyramid "%s":' % image_id)
             print('  tile_size:', pyramid.tile_size)
             print('  num_level_zero_tiles:', pyramid.num_level_zero_tiles)
             print('  num_levels:', pyramid.num_levels)
+        return pyramid
+
+    pyramid = ctx.pyramid_cache.get_or_create(image_id, create_pyramid)
 
     if TRACE_PERF:
         print('PERF: >>> Tile:', image_id, z, y, x)
@@ -120,9 +122,94 @@ def get_dataset_tile(ctx: ServiceContext,
     if TRACE_PERF:
         print('PERF: <<< Tile:', image_id, z, y, x, 'took', t2 - t1, 'seconds')
 
+    if isinstance(tile, memoryview):
+        # Tiles restored from a pack cache store are views into memory-mapped pack files,
+        # but Tornado only writes bytes
+        tile = tile.tobytes()
+
     return tile
 
 
+def get_dataset_tile_etag(ctx: ServiceContext,
+                          ds_name: str,
+                          var_name: str,
+                          x: str, y: str, z: str,
+                          params: RequestParams,
+                          tile_format: str = 'png') -> Optional[str]:
+    """
+    Get an entity tag (ETag) for the tile that :py:func:`get_dataset_tile` returns for the same arguments,
+    without computing the tile. It is derived from the fingerprint of the opened dataset and the tile's identifier.
+
+    :return: the quoted entity tag or None, if the dataset's fingerprint is unknown.
+             The tag is weak, if the tile encoding is not deterministic.
+    """
+    x = params.to_int('x', x)
+    y = params.to_int('y', y)
+    z = params.to_int('z', z)
+    fingerprint = ctx.get_opened_dataset_fingerprint(ds_name)
+    if fingerprint is None:
+        return None
+    encoding = get_tile_encoding(ctx, ds_name, tile_format)
+    _, _, _, _, image_id = _get_dataset_tile_image_ids(ctx, ds_name, var_name, params, encoding)
+    etag = '"%s"' % _hash_id('%s-%s-%s/%d/%d/%d' % (__version__, fingerprint, image_id, z, y, x))
+    # Tiles may be re-encoded, so their bytes are not guaranteed to stay the same
+    return etag if encoding.deterministic else 'W/' + etag
+
+
+def get_tile_encoding(ctx: ServiceContext, ds_name: Optional[str], tile_format: str) -> TileEncoding:
+    """
+    Get the encoding of tiles requested with the file name extension *tile_format*.
+
+    :param ctx: service context
+    :param ds_name: the dataset name or None for tiles not computed from a dataset
+    :param tile_format: tile file name extension, e.g. "png", "webp", or "jpg"
+    :return: the tile encoding
+    :raise ServiceBadRequestError: if the tile format is not supported
+    """
+    encoding = ctx.get_tile_encoding(ds_name, tile_format)
+    if encoding is None:
+        raise ServiceBadRequestError(f'Unsupported tile format "{tile_format}"')
+    return encoding
+
+
+def _get_dataset_tile_image_ids(ctx: ServiceContext,
+                                ds_name: str,
+                                var_name: str,
+                                params: RequestParams,
+                                encoding: TileEncoding):
+    dataset, var = ctx.get_dataset_and_variable(ds_name, var_name)
+
+    dim_names = list(var.dims)
+    if 'lon' not in dim_names or 'lat' not in dim_names:
+        raise ServiceBadRequestError(f'Variable "{var_name}" of dataset "{ds_name}" is not geo-spatial')
+
+    dim_names.remove('lon')
+    dim_names.remove('lat')
+
+    var_indexers = ctx.get_var_indexers(ds_name, var_name, var, dim_names, params)
+
+    cmap_cbar = params.get_query_argument('cbar', default=None)
+    cmap_vmin = params.get_query_argument_float('vmin', default=None)
+    cmap_vmax = params.get_query_argument_float('vmax', default=None)
+    if cmap_cbar is None or cmap_vmin is None or cmap_vmax is None:
+        default_cmap_cbar, default_cmap_vmin, default_cmap_vmax = ctx.get_color_mapping(ds_name, var_name)
+        cmap_cbar = cmap_cbar or default_cmap_cbar
+        cmap_vmin = cmap_vmin or default_cmap_vmin
+        cmap_vmax = cmap_vmax or default_cmap_vmax
+
+    var_index_id = '-'.join(f'-{dim_name}={dim_value}' for dim_name, dim_value in var_indexers.items())
+    ds_generation = ctx.get_dataset_generation(ds_name)
+    ds_id = ds_name if ds_generation == 0 else '%s@%d' % (ds_name, ds_generation)
+    # Use fixed-length hashes as IDs, tile IDs are used as cache keys and file names
+    array_id = _hash_id('%s-%s-%s' % (ds_id, var_name, var_index_id))
+    # Tiles of different encodings have different bytes, so they need their own cache keys and entity tags
+    encoding_id = encoding.id
+    if encoding.format == 'PNG' and ctx.get_palette_tiles():
+        encoding_id += '-p'
+    image_id = _hash_id('%s-%s-%s-%s-%s' % (array_id, cmap_cbar, cmap_vmin, cmap_vmax, encoding_id))
+    return var, var_indexers, (cmap_cbar, cmap_vmin, cmap_vmax), array_id, image_id
+
+
 def get_legend(ctx: ServiceContext,
                ds_name: str,
                var_name: str,
@@ -182,6 +269,10 @@ def get_dataset_tile_grid(ctx: ServiceContext,
 
 # noinspection PyMethodMayBeStatic
 def get_dataset_tile_url(ctx: ServiceContext, ds_name: str, var_name: str, base_url: str):
+    # Versioned tile URLs change with the dataset, so their tiles can be cached forever
+    ds_version = ctx.get_dataset_version(ds_name)
+    if ds_version is not None:
+        return ctx.get_service_url(base_url, 'tile', ds_name, var_name, ds_version, '{z}/{x}/{y}.png')
     return ctx.get_service_url(base_url, 'tile', ds_name, var_name, '{z}/{x}/{y}.png')
 
 
@@ -201,6 +292,19 @@ def get_ne2_tile(ctx: ServiceContext, x: str, y: str, z: str, params: RequestPar
     return NaturalEarth2Image.get_pyramid().get_tile(x, y, z)
 
 
+# noinspection PyUnusedLocal
+def get_ne2_tile_etag(ctx: ServiceContext, x: str, y: str, z: str, params: RequestParams) -> str:
+    """
+    Get a strong entity tag (ETag) for the tile that :py:func:`get_ne2_tile` returns for the same arguments.
+
+    :return: the quoted entity tag
+    """
+    x = params.to_int('x', x)
+    y = params.to_int('y', y)
+    z = params.to_int('z', z)
+    return '"%s"' % _hash_id('%s-ne2/%d/%d/%d' % (__version__, z, y, x))
+
+
 def get_ne2_tile_grid(ctx: ServiceContext, format_name: str, base_url: str):
     if format_name == 'ol4':
         return get_tile_source_options(NaturalEarth2Image.get_pyramid().tile_grid,
@@ -223,6 +327,64 @@ def get_or_compute_tile_grid(ctx: ServiceContext, ds_name: str, var: xr.DataArra
     return tile_grid
 
 
+def get_tile_coverage(ctx: ServiceContext,
+                      array_id: str,
+                      array: xr.DataArray,
+                      tile_grid: TileGrid,
+                      no_data_value=None,
+                      valid_range=None) -> Optional[TileCoverage]:
+    """
+    Get the coverage of the pyramid tiles of a 2D variable slice with valid data.
+    Computing the coverage reads the entire slice, therefore it is not done on the request path.
+    Instead, if the coverage is not yet known, its computation is started in the background and None is
+    returned, so that tiles are served as usual until the coverage is ready. At most
+    ``TILE_COVERAGE_MAX_PENDING`` coverages are computed at a time, others are started by later requests.
+    Coverages are kept in the bounded ``ctx.tile_coverage_cache``.
+
+    :param ctx: the service context
+    :param array_id: unique identifier of the 2D variable slice
+    :param array: the 2D variable slice
+    :param tile_grid: the tile grid
+    :param no_data_value: optional no-data value
+    :param valid_range: optional valid range, only used if there is no *no_data_value*
+    :return: the tile coverage or None, if not yet known
+    """
+    tile_coverage_cache = ctx.tile_coverage_cache
+    tile_coverage = tile_coverage_cache.get(array_id)
+    if tile_coverage is not None:
+        return tile_coverage
+
+    with _TILE_COVERAGE_LOCK:
+        if array_id in _TILE_COVERAGE_PENDING or len(_TILE_COVERAGE_PENDING) >= TILE_COVERAGE_MAX_PENDING:
+            return None
+        _TILE_COVERAGE_PENDING.add(array_id)
+
+    def compute_tile_coverage():
+        # Same pixels are invalid as masked by TransformArrayImage and ColorMappedRgbaImage
+        valid_mask = array.notnull()
+        if no_data_value is not None:
+            valid_mask &= array != no_data_value
+        elif valid_range is not None:
+            valid_min, valid_max = valid_range
+            if valid_min is not None:
+                valid_mask &= array >= valid_min
+            if valid_max is not None:
+                valid_mask &= array <= valid_max
+        return TileCoverage.create_from_mask(valid_mask, tile_grid, flip_y=tile_grid.geo_extent.inv_y)
+
+    def run():
+        try:
+            tile_coverage_cache.get_or_create(array_id, compute_tile_coverage)
+        except Exception as e:
+            _LOG.warning(f'failed to compute tile coverage {array_id!r}: {e}')
+        finally:
+            with _TILE_COVERAGE_LOCK:
+                _TILE_COVERAGE_PENDING.discard(array_id)
+
+    threading.Thread(target=run, name='xcube-tile-coverage', daemon=True).start()
+    return None
+
+
 def get_tile_source_options(tile_grid: TileGrid, url: str, client: str = 'ol4'):
     if client == 'ol4':
         # OpenLayers 4.x
@@ -282,3 +444,7 @@ def _tile_grid_to_cesium1x_source_options(tile_grid: TileGrid, url: str):
                 tilingScheme=dict(rectangle=rectangle,
                                   numberOfLevelZeroTilesX=tile_grid.num_level_zero_tiles_x,
                                   numberOfLevelZeroTilesY=tile_grid.num_level_zero_tiles_y))
+
+
+def _hash_id(id_: str) -> str:
+    return hashlib.md5(id_.encode('utf-8')).hexdigest()
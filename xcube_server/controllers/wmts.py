@@ -9,6 +9,9 @@ _WGS84_MEAN_EARTH_PERIMETER_IN_METERS = 2.0 * math.pi * _WGS84_MEAN_EARTH_RADIUS
 _WGS84_METERS_PER_DEGREE = _WGS84_MEAN_EARTH_PERIMETER_IN_METERS / 360.0
 _STD_PIXEL_SIZE_IN_METERS = 0.28e-3
 
+# Tile formats as (MIME type, file name extension)
+_TILE_FORMATS = (('image/png', 'png'), ('image/webp', 'webp'), ('image/jpeg', 'jpg'))
+
 
 def get_wmts_capabilities_xml(ctx: ServiceContext, base_url: str):
 
@@ -100,7 +103,9 @@ def get_wmts_capabilities_xml(ctx: ServiceContext, base_url: str):
     tile_grids = dict()
     indent = '    '
 
-    layer_base_url = ctx.get_service_url(base_url, 'wmts/1.0.0/tile/%s/%s/{TileMatrix}/{TileRow}/{TileCol}.png')
+    layer_base_url = ctx.get_service_url(base_url, 'wmts/1.0.0/tile/%s/%s/{TileMatrix}/{TileRow}/{TileCol}')
+    versioned_layer_base_url = ctx.get_service_url(base_url,
+                                                   'wmts/1.0.0/tile/%s/%s/%s/{TileMatrix}/{TileRow}/{TileCol}')
 
     dimensions_xml_cache = dict()
 
@@ -108,6 +113,7 @@ def get_wmts_capabilities_xml(ctx: ServiceContext, base_url: str):
     for dataset_descriptor in dataset_descriptors:
         ds_name = dataset_descriptor['Identifier']
         ds = ctx.get_dataset(ds_name)
+        ds_version = ctx.get_dataset_version(ds_name)
         for var_name in ds.data_vars:
             var = ds[var_name]
             if len(var.shape) <= 2 or var.dims[-1] != 'lon' or var.dims[-2] != 'lat':
@@ -166,7 +172,10 @@ def get_wmts_capabilities_xml(ctx: ServiceContext, base_url: str):
                 var_title = ds_name + "/" + var.attrs.get('title', var.attrs.get('long_name', var_name))
                 var_abstract = var.attrs.get('comment', '')
 
-                layer_tile_url = layer_base_url % (ds_name, var_name)
+                if ds_version is not None:
+                    layer_tile_url = versioned_layer_base_url % (ds_name, var_name, ds_version)
+                else:
+                    layer_tile_url = layer_base_url % (ds_name, var_name)
                 contents_xml_lines.append((2, '<Layer>'))
                 contents_xml_lines.append((3, f'<ows:Identifier>{ds_name}.{var_name}</ows:Identifier>'))
                 contents_xml_lines.append((3, f'<ows:Title>{var_title}</ows:Title>'))
@@ -177,11 +186,14 @@ def get_wmts_capabilities_xml(ctx: ServiceContext, base_url: str):
                 contents_xml_lines.append((3, '</ows:WGS84BoundingBox>'))
                 contents_xml_lines.append(
                     (3, '<Style isDefault="true"><ows:Identifier>Default</ows:Identifier></Style>'))
-                contents_xml_lines.append((3, '<Format>image/png</Format>'))
+                for mime_type, _ in _TILE_FORMATS:
+                    contents_xml_lines.append((3, f'<Format>{mime_type}</Format>'))
                 contents_xml_lines.append(
                     (3, f'<TileMatrixSetLink><TileMatrixSet>{tile_grid_id}</TileMatrixSet></TileMatrixSetLink>'))
-                contents_xml_lines.append(
-                    (3, f'<ResourceURL format="image/png" resourceType="tile" template="{layer_tile_url}"/>'))
+                for mime_type, extension in _TILE_FORMATS:
+                    contents_xml_lines.append(
+                        (3, f'<ResourceURL format="{mime_type}" resourceType="tile" '
+                            f'template="{layer_tile_url}.{extension}"/>'))
 
                 non_spatial_dims = var.dims[0:-2]
                 for dim_name in non_spatial_dims:
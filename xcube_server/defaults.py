@@ -38,11 +38,29 @@ DEFAULT_CMAP_HEIGHT = 5
 
 DEFAULT_MAX_THREAD_COUNT = None
 
-FILE_TILE_CACHE_CAPACITY = 1000
+FILE_TILE_CACHE_CAPACITY = 1024 * 1024 * 1024
 FILE_TILE_CACHE_ENABLED = False
 FILE_TILE_CACHE_PATH = './image-cache'
 
-MEM_TILE_CACHE_CAPACITY = 1000
+MEM_TILE_CACHE_CAPACITY = 256 * 1024 * 1024
+RGB_TILE_CACHE_CAPACITY = 64 * 1024 * 1024
+
+TILE_CACHE_NUM_SHARDS = 16
+
+TILE_CACHE_SNAPSHOT_FRACTION = 0.25
+
+PYRAMID_CACHE_CAPACITY = 64
+
+TILE_COVERAGE_CACHE_CAPACITY = 1024
+TILE_COVERAGE_MAX_PENDING = 2
+
+DEFAULT_TILE_MAX_AGE = 600
+VERSIONED_TILE_MAX_AGE = 365 * 24 * 60 * 60
+
+DEFAULT_PALETTE_TILES = True
+
+ADAPTIVE_FAST_COMPRESS_LEVEL = 1
+ADAPTIVE_STRONG_COMPRESS_LEVEL = 9
 
 TRACE_PERF = False
 
@@ -20,17 +20,22 @@
 # SOFTWARE.
 
 import json
+from typing import Optional
 
 from tornado.ioloop import IOLoop
 
 from . import __version__, __description__
+from .controllers.caches import get_caches
 from .controllers.catalogue import get_datasets, get_dataset_variables, get_dataset_coordinates, get_color_bars
 from .controllers.features import find_features, find_dataset_features
-from .controllers.tiles import get_dataset_tile, get_dataset_tile_grid, get_ne2_tile, get_ne2_tile_grid, get_legend
+from .controllers.tiles import get_dataset_tile, get_dataset_tile_grid, get_ne2_tile, get_ne2_tile_grid, get_legend, \
+    get_dataset_tile_etag, get_ne2_tile_etag
 from .controllers.time_series import get_time_series_info, get_time_series_for_point, get_time_series_for_geometry, \
     get_time_series_for_geometry_collection, get_time_series_for_feature_collection
 from .controllers.wmts import get_wmts_capabilities_xml
+from .defaults import VERSIONED_TILE_MAX_AGE
 from .errors import ServiceBadRequestError
+from .im import TileEncoding, get_adaptive_encoder
 from .service import ServiceRequestHandler
 
 __author__ = "Norman Fomferra (Brockmann Consult GmbH)"
@@ -51,6 +56,53 @@ _WMTS_KVP_KEYS = [
 _WMTS_KVP_LOWER_KEYS = [k.lower() for k in _WMTS_KVP_KEYS]
 _WMTS_VERSION = "1.0.0"
 _WMTS_TILE_FORMAT = "image/png"
+_WMTS_TILE_FORMATS = {
+    "image/png": "png",
+    "png": "png",
+    "image/webp": "webp",
+    "webp": "webp",
+    "image/jpeg": "jpg",
+    "jpeg": "jpg",
+    "jpg": "jpg",
+}
+
+
+async def _run_tile_request(function, *args):
+    """
+    Run a tile request in the executor. While it waits for or runs in the executor, it counts as pending
+    tile request of the adaptive tile encoder.
+    """
+    adaptive_encoder = get_adaptive_encoder()
+    adaptive_encoder.begin_request()
+    try:
+        return await IOLoop.current().run_in_executor(None, function, *args)
+    finally:
+        adaptive_encoder.end_request()
+
+
+def get_accepted_tile_format(accept: Optional[str]) -> str:
+    """
+    Get the tile file name extension of the best tile format acceptable according to the
+    HTTP "Accept" header *accept*. WebP is preferred to PNG. JPEG is never chosen, because it has no transparency.
+
+    :param accept: value of the "Accept" header or None
+    :return: "webp" or "png"
+    """
+    for media_range in (accept or '').split(','):
+        media_type, *media_params = [part.strip() for part in media_range.split(';')]
+        if media_type.lower() != 'image/webp':
+            continue
+        for media_param in media_params:
+            name, _, value = media_param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    if float(value) <= 0.0:
+                        break
+                except ValueError:
+                    break
+        else:
+            return 'webp'
+    return 'png'
 
 
 # noinspection PyAbstractClass
@@ -87,18 +139,30 @@ class WMTSKvpHandler(ServiceRequestHandler):
             # tileMatrixSet = self.params.get_query_argument_int('tilematrixset')
             # style = self.params.get_query_argument("style"
             mime_type = self.params.get_query_argument("format", _WMTS_TILE_FORMAT).lower()
-            if mime_type not in (_WMTS_TILE_FORMAT, "png"):
-                raise ServiceBadRequestError(f'Value for "format" parameter must be "{_WMTS_TILE_FORMAT}"')
+            tile_format = _WMTS_TILE_FORMATS.get(mime_type)
+            if tile_format is None:
+                raise ServiceBadRequestError('Value for "format" parameter must be one of '
+                                             '"image/png", "image/webp", "image/jpeg"')
             x = self.params.get_query_argument_int("tilecol")
             y = self.params.get_query_argument_int("tilerow")
             z = self.params.get_query_argument_int("tilematrix")
-            tile = await IOLoop.current().run_in_executor(None,
-                                                          get_dataset_tile,
+            etag = await IOLoop.current().run_in_executor(None,
+                                                          get_dataset_tile_etag,
                                                           self.service_context,
                                                           ds_name, var_name,
                                                           x, y, z,
-                                                          self.params)
-            self.set_header("Content-Type", "image/png")
+                                                          self.params,
+                                                          tile_format)
+            if self.set_caching_headers(etag, self.service_context.get_tile_max_age(ds_name)):
+                self.finish()
+                return
+            tile = await _run_tile_request(get_dataset_tile,
+                                           self.service_context,
+                                           ds_name, var_name,
+                                           x, y, z,
+                                           self.params,
+                                           tile_format)
+            self.set_header("Content-Type", TileEncoding.from_extension(tile_format).mime_type)
             self.finish(tile)
         elif request == "GetFeatureInfo":
             raise ServiceBadRequestError('Request type "GetFeatureInfo" not yet implemented')
@@ -160,14 +224,35 @@ class GetCoordinatesJsonHandler(ServiceRequestHandler):
 # noinspection PyAbstractClass,PyBroadException
 class GetTileDatasetHandler(ServiceRequestHandler):
 
-    async def get(self, ds_name: str, var_name: str, z: str, x: str, y: str):
-        tile = await IOLoop.current().run_in_executor(None,
-                                                      get_dataset_tile,
+    async def get(self, ds_name: str, var_name: str, z: str, x: str, y: str,
+                  ds_version: str = None, tile_format: str = None):
+        if tile_format is None:
+            # URL without file name extension
+            tile_format = get_accepted_tile_format(self.request.headers.get('Accept'))
+            self.set_header('Vary', 'Accept')
+        etag = await IOLoop.current().run_in_executor(None,
+                                                      get_dataset_tile_etag,
                                                       self.service_context,
                                                       ds_name, var_name,
                                                       x, y, z,
-                                                      self.params)
-        self.set_header('Content-Type', 'image/png')
+                                                      self.params,
+                                                      tile_format)
+        if ds_version is not None and ds_version == self.service_context.get_dataset_version(ds_name):
+            # The URL changes with the dataset, so the tile will never change
+            not_modified = self.set_caching_headers(etag, VERSIONED_TILE_MAX_AGE, immutable=True)
+        else:
+            # Unversioned or outdated URL
+            not_modified = self.set_caching_headers(etag, self.service_context.get_tile_max_age(ds_name))
+        if not_modified:
+            self.finish()
+            return
+        tile = await _run_tile_request(get_dataset_tile,
+                                       self.service_context,
+                                       ds_name, var_name,
+                                       x, y, z,
+                                       self.params,
+                                       tile_format)
+        self.set_header('Content-Type', TileEncoding.from_extension(tile_format).mime_type)
         self.finish(tile)
 
 
@@ -199,6 +284,10 @@ class GetTileGridDatasetHandler(ServiceRequestHandler):
 class GetTileNE2Handler(ServiceRequestHandler):
 
     async def get(self, z: str, x: str, y: str):
+        etag = get_ne2_tile_etag(self.service_context, x, y, z, self.params)
+        if self.set_caching_headers(etag, self.service_context.get_tile_max_age()):
+            self.finish()
+            return
         response = await IOLoop.current().run_in_executor(None,
                                                           get_ne2_tile,
                                                           self.service_context,
@@ -294,6 +383,15 @@ class FindDatasetFeaturesHandler(ServiceRequestHandler):
         self.write(json.dumps(response, indent=2))
 
 
+# noinspection PyAbstractClass
+class GetCachesJsonHandler(ServiceRequestHandler):
+
+    def get(self):
+        response = get_caches(self.service_context)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(response, indent=2))
+
+
 # noinspection PyAbstractClass
 class InfoHandler(ServiceRequestHandler):
 
@@ -23,6 +23,8 @@
 from .cmaps import get_cmaps
 from .geoextent import GeoExtent
 from .tiledimage import *
+from .tilecoverage import TileCoverage
+from .tileencoding import TileEncoding, AdaptiveTileEncoding, AdaptiveEncoder, get_adaptive_encoder
 from .tilegrid import TileGrid
 from .utils import *
 
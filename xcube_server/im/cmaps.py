@@ -23,6 +23,7 @@ import base64
 import io
 import logging
 from threading import Lock
+from typing import Optional, Tuple
 
 import matplotlib
 import matplotlib.cm as cm
@@ -174,3 +175,176 @@ def ensure_cmaps_loaded():
             # import pprint
             # pprint.pprint(_CMAPS)
         _LOCK.release()
+
+
+_CMAP_LUTS = dict()
+
+
+def get_cmap_lut(cmap_name: str, num_colors: int = 256) -> np.ndarray:
+    """
+    Get the RGBA lookup table of a matplotlib color map as used by :py:func:`apply_cmap_lut`.
+    Lookup tables are created once per color map and number of colors.
+
+    The table is a read-only numpy uint8 array of shape (num_colors + 2, 4). The first *num_colors* entries
+    are the colors of the color map as returned by ``cmap(..., bytes=True)``, followed by the color for
+    values greater than one, and the transparent color for invalid values.
+
+    :param cmap_name: A Matplotlib color map name
+    :param num_colors: Number of colors
+    :return: the lookup table
+    """
+    key = cmap_name, num_colors
+    lut = _CMAP_LUTS.get(key)
+    if lut is None:
+        ensure_cmaps_loaded()
+        cmap = cm.get_cmap(cmap_name, num_colors)
+        cmap.set_bad('k', 0)
+        num_colors = cmap.N
+        lut = np.empty((num_colors + 2, 4), dtype=np.uint8)
+        lut[0:num_colors] = cmap(np.arange(num_colors), bytes=True)
+        # Same conversion from float to bytes as used by matplotlib
+        lut[num_colors] = (np.array(cmap.get_over()) * 255).astype(np.uint8)
+        lut[num_colors + 1] = (np.array(cmap.get_bad()) * 255).astype(np.uint8)
+        lut.setflags(write=False)
+        _CMAP_LUTS[key] = lut
+    return lut
+
+
+def apply_cmap_lut(array: np.ndarray,
+                   value_min: float,
+                   value_max: float,
+                   lut: np.ndarray,
+                   mask: np.ndarray = None) -> np.ndarray:
+    """
+    Map the values of *array* to RGBA colors using the lookup table *lut* obtained from :py:func:`get_cmap_lut`.
+    The result is pixel-identical to normalizing the values to the range 0 to 1 and passing them to the
+    color map with ``bytes=True``, but avoids the color map's overhead of creating a new lookup table,
+    copying the array and computing several masks for every call.
+
+    :param array: numpy array whose values have been clipped to the range *value_min* to *value_max*.
+           If it is of floating point type, it is modified in place.
+    :param value_min: the value mapped to the first color
+    :param value_max: the value mapped to the last color
+    :param lut: the lookup table
+    :param mask: optional mask of a masked array, True for invalid values. NaN values are always invalid.
+    :return: numpy uint8 array of shape array.shape + (4,)
+    """
+    indexes = get_cmap_lut_indexes(array, value_min, value_max, lut, mask=mask)
+    return get_cmap_lut_colors(indexes, lut)
+
+
+def get_cmap_lut_colors(indexes: np.ndarray, lut: np.ndarray) -> np.ndarray:
+    """
+    Get the RGBA colors of the lookup table *lut* for the *indexes* returned by :py:func:`get_cmap_lut_indexes`.
+
+    :param indexes: indexes into the lookup table
+    :param lut: the lookup table
+    :return: numpy uint8 array of shape indexes.shape + (4,)
+    """
+    # Indexing the colors as 32-bit integers avoids the temporary intp copy of the indexes made by take()
+    colors = lut.view(np.uint32).reshape(-1)[indexes]
+    return colors.view(np.uint8).reshape(indexes.shape + (4,))
+
+
+def get_cmap_lut_indexes(array: np.ndarray,
+                         value_min: float,
+                         value_max: float,
+                         lut: np.ndarray,
+                         mask: np.ndarray = None) -> np.ndarray:
+    """
+    Get the indexes into the lookup table *lut* used by :py:func:`apply_cmap_lut`.
+    Values less than *value_min* refer to the first entry.
+
+    :param array: numpy array whose values have been clipped to the range *value_min* to *value_max*.
+           If it is of floating point type, it is modified in place.
+    :param value_min: the value mapped to the first color
+    :param value_max: the value mapped to the last color
+    :param lut: the lookup table
+    :param mask: optional mask of a masked array, True for invalid values. NaN values are always invalid.
+    :return: numpy array of the smallest unsigned integer type for the size of *lut*, of the same shape as *array*
+    """
+    num_colors = lut.shape[0] - 2
+    if array.dtype.kind != 'f':
+        array = array.astype(np.float64)
+    # Same operations as done before by numpy and matplotlib, fusing them would change the rounding.
+    # In-place arithmetic of masked arrays is computed in double precision.
+    dtype = np.float64 if mask is not None else None
+    np.subtract(array, value_min, out=array, dtype=dtype, casting='unsafe')
+    np.multiply(array, 1.0 / (value_max - value_min), out=array, dtype=dtype, casting='unsafe')
+    array *= num_colors
+    if not np.array_equal(lut[num_colors], lut[num_colors - 1]):
+        # A value of one is not out of range
+        array[array == num_colors] = num_colors - 1
+    # Values less than zero use the first color, values greater than one the "over" color
+    np.clip(array, 0, num_colors, out=array)
+    invalid = np.isnan(array)
+    if mask is not None:
+        invalid |= mask
+    with np.errstate(invalid='ignore'):
+        # Casting NaN to integers is platform-dependent, NaN values are overwritten below
+        indexes = array.astype(np.min_scalar_type(num_colors + 1))
+    indexes[invalid] = num_colors + 1
+    return indexes
+
+
+_CMAP_PALETTES = dict()
+
+
+def get_cmap_palette(cmap_name: str, num_colors: int = 256) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Get the palette of distinct RGBA colors of the lookup table returned by :py:func:`get_cmap_lut`
+    for the same arguments, as used by :py:func:`new_cmap_palette_image`.
+    Colors that are not fully opaque come first.
+
+    :param cmap_name: A Matplotlib color map name
+    :param num_colors: Number of colors
+    :return: a tuple (palette, palette_indexes), where palette is a numpy uint8 array of shape (num_entries, 4)
+             and palette_indexes maps the indexes into the lookup table to indexes into the palette
+    """
+    key = cmap_name, num_colors
+    palette = _CMAP_PALETTES.get(key)
+    if palette is None:
+        lut = get_cmap_lut(cmap_name, num_colors)
+        colors, palette_indexes = np.unique(lut, axis=0, return_inverse=True)
+        order = np.argsort(colors[:, 3] == 255, kind='stable')
+        colors = colors[order]
+        palette_indexes = np.argsort(order).take(palette_indexes.ravel())
+        palette_indexes = palette_indexes.astype(np.uint8 if len(colors) <= 256 else np.uint16)
+        colors.setflags(write=False)
+        palette_indexes.setflags(write=False)
+        palette = colors, palette_indexes
+        _CMAP_PALETTES[key] = palette
+    return palette
+
+
+def new_cmap_palette_image(indexes: np.ndarray,
+                           palette: np.ndarray,
+                           palette_indexes: np.ndarray) -> Optional[Image.Image]:
+    """
+    Create an 8-bit palette image with transparency from the lookup table *indexes* returned by
+    :py:func:`get_cmap_lut_indexes`, using a palette returned by :py:func:`get_cmap_palette`.
+    Encoded as PNG, it has the same pixels as the RGBA image created from :py:func:`apply_cmap_lut`.
+
+    :param indexes: indexes into the lookup table
+    :param palette: the palette
+    :param palette_indexes: maps the indexes into the lookup table to indexes into the palette
+    :return: a PIL image of mode "P", or None, if the image uses more than 256 colors
+    """
+    indexes = palette_indexes[indexes]
+    if len(palette) > 256:
+        # Use only the colors present in the image
+        used_entries = np.flatnonzero(np.bincount(indexes.ravel(), minlength=len(palette)))
+        if len(used_entries) > 256:
+            return None
+        entry_map = np.zeros(len(palette), dtype=np.uint8)
+        entry_map[used_entries] = np.arange(len(used_entries))
+        indexes = entry_map[indexes]
+        palette = palette[used_entries]
+    image = Image.fromarray(indexes.astype(np.uint8, copy=False), mode='P')
+    image.putpalette(palette[:, 0:3].tobytes())
+    alpha = palette[:, 3]
+    # Omit the alpha values of the trailing opaque colors
+    num_alpha = np.count_nonzero(alpha != 255)
+    if num_alpha:
+        image.info['transparency'] = alpha[0:num_alpha].tobytes()
+    return image
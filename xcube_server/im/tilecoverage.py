@@ -0,0 +1,115 @@
+# The MIT License (MIT)
+# Copyright (c) 2018 by the xcube development team and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from typing import Sequence
+
+import numpy as np
+
+from .tilegrid import TileGrid
+
+__author__ = "Norman Fomferra (Brockmann Consult GmbH)"
+
+
+class TileCoverage:
+    """
+    Tells which tiles of an image pyramid contain any valid data.
+    There is a bitmap of shape (num_tiles_y, num_tiles_x) for each pyramid level, level 0 represents
+    the lowest resolution.
+
+    :param level_bitmaps: boolean arrays, one for each pyramid level, whose elements are True
+           for tiles that contain any valid data
+    """
+
+    def __init__(self, level_bitmaps: Sequence[np.ndarray]):
+        self._level_bitmaps = [np.asarray(bitmap, dtype=np.bool_) for bitmap in level_bitmaps]
+
+    @classmethod
+    def create_from_mask(cls, valid_mask, tile_grid: TileGrid, flip_y: bool = False) -> 'TileCoverage':
+        """
+        Create the tile coverage from the validity mask of the highest-resolution pyramid level.
+        The mask is read one row of tiles at a time, so it may be a lazily computed
+        (e.g. dask-backed) array that is much larger than the available memory.
+        Lower-resolution levels are derived from the highest-resolution level, a tile has data
+        if any of the four tiles it is downsampled from has data.
+
+        :param valid_mask: 2D boolean numpy-like array of the highest-resolution level, True for valid pixels
+        :param tile_grid: the pyramid's tile grid
+        :param flip_y: whether tile rows are flipped in y-direction with respect to the mask rows
+        :return: a new TileCoverage instance
+        """
+        num_levels = tile_grid.num_levels
+        tile_width, tile_height = tile_grid.tile_size
+        num_tiles_x, num_tiles_y = tile_grid.num_tiles(num_levels - 1)
+        mask_height, mask_width = valid_mask.shape
+        width = min(mask_width, num_tiles_x * tile_width)
+
+        bitmap = np.zeros((num_tiles_y, num_tiles_x), dtype=np.bool_)
+        for tile_y in range(num_tiles_y):
+            y = tile_y * tile_height
+            if y >= mask_height:
+                break
+            row = np.asarray(valid_mask[y:y + tile_height, 0:width], dtype=np.bool_).any(axis=0)
+            # Pad the last tile, so that the row can be reshaped into tiles
+            row = np.pad(row, (0, num_tiles_x * tile_width - width), mode='constant')
+            bitmap[tile_y] = row.reshape((num_tiles_x, tile_width)).any(axis=1)
+
+        if flip_y:
+            bitmap = bitmap[::-1, :]
+
+        level_bitmaps = [None] * num_levels
+        level_bitmaps[num_levels - 1] = bitmap
+        for z_index in range(num_levels - 2, -1, -1):
+            h, w = bitmap.shape
+            bitmap = bitmap.reshape((h // 2, 2, w // 2, 2)).any(axis=(1, 3))
+            level_bitmaps[z_index] = bitmap
+        return TileCoverage(level_bitmaps)
+
+    @property
+    def num_levels(self) -> int:
+        return len(self._level_bitmaps)
+
+    def get_level_bitmap(self, z_index: int) -> np.ndarray:
+        return self._level_bitmaps[z_index]
+
+    def has_data(self, tile_x: int, tile_y: int, z_index: int) -> bool:
+        """
+        Test whether a tile contains any valid data.
+        Tiles outside the pyramid are unknown and are therefore said to have data.
+
+        :param tile_x: the tile's x index
+        :param tile_y: the tile's y index
+        :param z_index: the pyramid level
+        :return: False, if the tile is known to have no valid data, True otherwise
+        """
+        if z_index < 0 or z_index >= len(self._level_bitmaps):
+            return True
+        bitmap = self._level_bitmaps[z_index]
+        num_tiles_y, num_tiles_x = bitmap.shape
+        if tile_x < 0 or tile_x >= num_tiles_x or tile_y < 0 or tile_y >= num_tiles_y:
+            return True
+        return bool(bitmap[tile_y, tile_x])
+
+    @property
+    def coverage(self) -> float:
+        """ The ratio of tiles with data at the highest-resolution level. """
+        bitmap = self._level_bitmaps[-1]
+        return float(np.count_nonzero(bitmap)) / bitmap.size if bitmap.size else 0.
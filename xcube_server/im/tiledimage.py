@@ -19,26 +19,29 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import io
+import threading
 import time
 import uuid
 from abc import ABCMeta, abstractmethod
 from typing import Tuple, Sequence, Union, Any, Callable, Optional
 
-import matplotlib.cm as cm
 import numpy as np
 from PIL import Image
 
-from .cmaps import ensure_cmaps_loaded
+from .cmaps import get_cmap_lut, apply_cmap_lut, get_cmap_lut_indexes, get_cmap_lut_colors, get_cmap_palette, \
+    new_cmap_palette_image
 from .geoextent import GeoExtent
+from .tileencoding import TileEncoding
 from .tilegrid import TileGrid
 from .utils import downsample_ndarray, aggregate_ndarray_first
-from ..cache import Cache, MemoryCacheStore
+from ..cache import Cache, MemoryCacheStore, SingleFlight, LruObjectCache
 
 __author__ = "Norman Fomferra (Brockmann Consult GmbH)"
 
 _DEFAULT_TILE_CACHE = None
 _DEBUG_OP_IMAGE = False
+_TILE_FLIGHT = SingleFlight()
+_UNIFORM_TILES = None
 
 X = int
 Y = int
@@ -61,7 +64,8 @@ def set_default_tile_cache(cache=None, no_cache=False, capacity=64 * 1024 * 1024
     if no_cache:
         _DEFAULT_TILE_CACHE = None
     elif cache is None:
-        _DEFAULT_TILE_CACHE = Cache(MemoryCacheStore(), capacity=capacity, threshold=threshold)
+        _DEFAULT_TILE_CACHE = Cache(MemoryCacheStore(), capacity=capacity, threshold=threshold,
+                                    namespace_function=get_tile_image_id)
     else:
         _DEFAULT_TILE_CACHE = cache
 
@@ -71,6 +75,37 @@ def get_default_tile_cache() -> Cache:
     return _DEFAULT_TILE_CACHE
 
 
+def get_tile_image_id(tile_id: str) -> str:
+    """
+    Get the image identifier from a tile identifier as returned by :py:meth:`TiledImage.get_tile_id`.
+    Tile caches use it as namespace function, so that all tiles of an image can be removed at once,
+    see :py:meth:`xcube_server.cache.Cache.remove_namespace`.
+
+    :param tile_id: the tile identifier
+    :return: the image identifier
+    """
+    return tile_id.rsplit('/', 2)[0]
+
+
+def get_tile_flight() -> SingleFlight:
+    """
+    :return: The object that deduplicates concurrent computations of the same tile. Its counters tell how many
+             tile computations have been performed and how many have been saved.
+    """
+    return _TILE_FLIGHT
+
+
+def get_uniform_tiles() -> 'UniformTiles':
+    """
+    :return: The registry of shared empty and solid tiles. Its counters tell how many color-mapped tiles
+             were empty (fully masked) or solid (constant-valued) and how many had to be color-mapped.
+    """
+    global _UNIFORM_TILES
+    if _UNIFORM_TILES is None:
+        _UNIFORM_TILES = UniformTiles()
+    return _UNIFORM_TILES
+
+
 class TiledImage(metaclass=ABCMeta):
     """
     The interface for tiled images.
@@ -229,30 +264,44 @@ class OpImage(AbstractTiledImage, metaclass=ABCMeta):
         return self._tile_cache
 
     def get_tile(self, tile_x: int, tile_y: int) -> Tile:
-        t0 = 0
-        tile_id = None
+        tile_id = self.get_tile_id(tile_x, tile_y)
+        tile = self._get_cached_tile(tile_id)
+        if tile is not None:
+            return tile
+        # Concurrent requests for the same tile wait for a single computation
+        return _TILE_FLIGHT.do(tile_id, self._compute_and_cache_tile, tile_x, tile_y, tile_id)
+
+    def _get_cached_tile(self, tile_id: str) -> Optional[Tile]:
         cache = self._tile_cache
-        if cache:
-            tile_id = self.get_tile_id(tile_x, tile_y)
-            if _DEBUG_OP_IMAGE:
-                t0 = time.clock()
-            tile = cache.get_value(tile_id)
-            if tile is not None:
-                if _DEBUG_OP_IMAGE:
-                    print('tile "%s": restored from cache, took %.4f sec' % (tile_id, time.clock() - t0))
-                return tile
-        tw, th = self.tile_size
+        if not cache:
+            return None
+        t0 = 0
         if _DEBUG_OP_IMAGE:
-            t0 = time.clock()
+            t0 = time.perf_counter()
+        tile = cache.get_value(tile_id)
+        if _DEBUG_OP_IMAGE and tile is not None:
+            print('tile "%s": restored from cache, took %.4f sec' % (tile_id, time.perf_counter() - t0))
+        return tile
+
+    def _compute_and_cache_tile(self, tile_x: int, tile_y: int, tile_id: str) -> Tile:
+        # Another computation of this tile may have finished since our cache lookup
+        tile = self._get_cached_tile(tile_id)
+        if tile is not None:
+            return tile
+        tw, th = self.tile_size
+        t0 = time.perf_counter()
         tile = self.compute_tile(tile_x, tile_y, (tw * tile_x, th * tile_y, tw, th))
+        # The compute time is the cost of recomputing the tile after it has been evicted from the cache
+        compute_time = time.perf_counter() - t0
         if _DEBUG_OP_IMAGE:
-            print('tile "%s": computed, took %.4f sec' % (self.get_tile_id(tile_x, tile_y), time.clock() - t0))
+            print('tile "%s": computed, took %.4f sec' % (tile_id, compute_time))
+        cache = self._tile_cache
         if cache:
             if _DEBUG_OP_IMAGE:
-                t0 = time.clock()
-            cache.put_value(tile_id, tile)
+                t0 = time.perf_counter()
+            cache.put_value(tile_id, tile, cost=compute_time)
             if _DEBUG_OP_IMAGE:
-                print('tile "%s": stored in cache, took %.4f sec' % (tile_id, time.clock() - t0))
+                print('tile "%s": stored in cache, took %.4f sec' % (tile_id, time.perf_counter() - t0))
         return tile
 
     @abstractmethod
@@ -260,8 +309,15 @@ class OpImage(AbstractTiledImage, metaclass=ABCMeta):
         pass
 
     def dispose(self) -> None:
+        """
+        Removes the tiles of this image from its tile cache.
+        If the cache has a namespace function, it is expected to be :py:func:`get_tile_image_id`.
+        """
         cache = self._tile_cache
         if cache:
+            if cache.namespace_function is not None:
+                cache.remove_namespace(self.id)
+                return
             num_tiles_x, num_tiles_y = self.num_tiles
             for tile_y in range(num_tiles_y):
                 for tile_x in range(num_tiles_x):
@@ -320,11 +376,17 @@ class TransformArrayImage(DecoratorImage):
     Performs basic (numpy) array tile transformations. Currently available: force_masked, flip_y.
     Expects the source image to provide (numpy) arrays.
 
+    With *force_masked*, invalid values of floating point tiles are set to NaN, keeping the tile's dtype,
+    and tiles of other types become masked arrays. Invalid values are those equal to *no_data_value*,
+    if given, or outside *valid_range*, if given, and NaN or infinite values otherwise.
+    Flipping and masking are done while copying the source tile into the target tile.
+
     :param source_image: the source image
     :param image_id: optional unique image identifier
     :param flip_y: weather to flip pixels in y-direction
-    :param force_masked: weather to force creation of masked arrays
+    :param force_masked: weather to mark invalid values
     :param no_data_value: optional no-data value for mask creation
+    :param valid_range: optional valid range (min, max) for mask creation, either may be None
     :param tile_cache: optional tile cache
     """
 
@@ -369,29 +431,40 @@ class TransformArrayImage(DecoratorImage):
     def compute_tile_from_source_tile(self, tile_x: int, tile_y: int, rectangle: Rectangle2D, tile: Tile) -> Tile:
         if self._force_2d and tile.ndim > 2:
             # Create 2D subset using basic indexing
-            # noinspection PyTypeChecker
-            index = (tile.ndim - 2) * [0] + [slice(None), slice(None)]
-            tile = tile[index]
+            tile = tile[(0,) * (tile.ndim - 2)]
         if self._flip_y:
-            # Flip tile using fancy indexing
+            # Flip tile using a view, the data is copied below
             tile = tile[..., ::-1, :]
-        if self._force_masked and not np.ma.is_masked(tile):
-            # if tile is not masked
-            if self._no_data_value is not None:
-                # and we have a fill value, return a masked tile
-                tile = np.ma.masked_equal(tile, self._no_data_value)
-            elif self._valid_range is not None:
-                valid_min, valid_max = self._valid_range
-                # and we have a valid min or max, return a masked tile
-                if valid_min is not None:
-                    tile = np.ma.masked_less(tile, valid_min)
-                if valid_max is not None:
-                    tile = np.ma.masked_greater(tile, valid_max)
-            elif np.issubdtype(tile.dtype, np.floating) or np.issubdtype(tile.dtype, np.complexfloating):
-                # and it is of float type, return a masked tile with a mask from invalids, i.e. NaN, -Inf, +Inf
-                tile = np.ma.masked_invalid(tile)
+        if self._force_masked and not np.ma.isMaskedArray(tile):
+            tile = np.asarray(tile)
+            invalid = self._get_invalid_mask(tile)
+            if invalid is not None:
+                target_tile = np.empty(tile.shape, dtype=tile.dtype)
+                np.copyto(target_tile, tile)
+                if tile.dtype.kind in 'fc':
+                    np.copyto(target_tile, np.nan, where=invalid)
+                    return target_tile
+                return np.ma.MaskedArray(target_tile, mask=invalid, copy=False)
         return tile
 
+    def _get_invalid_mask(self, tile: np.ndarray) -> Optional[np.ndarray]:
+        if self._no_data_value is not None:
+            invalid = tile == self._no_data_value
+        elif self._valid_range is not None:
+            valid_min, valid_max = self._valid_range
+            invalid = None
+            if valid_min is not None:
+                invalid = tile < valid_min
+            if valid_max is not None:
+                invalid = tile > valid_max if invalid is None else np.logical_or(invalid, tile > valid_max,
+                                                                                 out=invalid)
+        elif tile.dtype.kind in 'fc':
+            # NaN values are invalid already
+            invalid = np.isinf(tile)
+        else:
+            invalid = None
+        return invalid
+
 
 class ColorMappedRgbaImage(DecoratorImage):
     """
@@ -407,6 +480,8 @@ class ColorMappedRgbaImage(DecoratorImage):
     :param encode: Whether to create tiles that are encoded image bytes according to *format*.
     :param format: Image format, e.g. "JPEG", "PNG"
     :param tile_cache: optional tile cache
+    :param indexed: Whether to encode PNG tiles as 8-bit palette images with transparency instead of RGBA images.
+    :param encoding: optional encoding of tiles, overrides *format*
     """
 
     def __init__(self,
@@ -418,55 +493,60 @@ class ColorMappedRgbaImage(DecoratorImage):
                  no_data_value: Union[int, float] = None,
                  encode: bool = False,
                  format: str = None,
-                 tile_cache=None):
+                 tile_cache=None,
+                 indexed: bool = False,
+                 encoding: TileEncoding = None):
+        if encoding is None and format:
+            encoding = TileEncoding(format)
+        format = encoding.format if encoding is not None else format
         super().__init__(source_image, image_id=image_id, format=format, mode='RGBA', tile_cache=tile_cache)
         self._value_range = value_range
         self._cmap_name = cmap_name if cmap_name else 'jet'
-        ensure_cmaps_loaded()
-        self._cmap = cm.get_cmap(self._cmap_name, num_colors)
-        self._cmap.set_bad('k', 0)
+        self._cmap_lut = get_cmap_lut(self._cmap_name, num_colors)
+        self._cmap_palette = get_cmap_palette(self._cmap_name, num_colors) \
+            if indexed and encode and format == 'PNG' else None
         self._no_data_value = no_data_value
         self._encode = encode
+        self._encoding = encoding
 
     def compute_tile_from_source_tile(self,
                                       tile_x: int, tile_y: int,
                                       rectangle: Rectangle2D, source_tile: Tile) -> Tile:
         value_min, value_max = self._value_range
-        if not np.ma.is_masked(source_tile):
-            if self._no_data_value is not None:
-                array = np.ma.masked_equal(source_tile, self._no_data_value)
-                array = array.clip(value_min, value_max, out=array)
-            elif np.issubdtype(source_tile.dtype, np.floating):
-                array = np.ma.masked_invalid(source_tile)
-                array = array.clip(value_min, value_max, out=array)
-            else:
-                array = source_tile.clip(value_min, value_max)
-        else:
-            array = source_tile.clip(value_min, value_max)
-
-        old_shape = array.shape
-        height = old_shape[-2]
-        width = old_shape[-1]
-        if width * height == array.size:
-            array = np.reshape(array, (height, width))
-        else:
+        data = np.ma.getdata(source_tile)
+        mask = _get_mask(source_tile)
+        if data.ndim > 2:
             # noinspection PyTypeChecker
-            index = [0] * (array.ndim - 2) + [slice(None), slice(None)]
-            array = array[index]
-
-        # check if we can optimize the following calls by using Numexpr
-        # see https://github.com/pydata/numexpr/wiki/Numexpr-Users-Guide
-        array -= value_min
-        array *= 1.0 / (value_max - value_min)
-        array = self._cmap(array, bytes=True)
-        image = Image.fromarray(array, mode=self.mode)
-
-        if self._encode and self.format:
-            ostream = io.BytesIO()
-            image.save(ostream, format=self.format)
-            encoded_image = ostream.getvalue()
-            ostream.close()
-            return encoded_image
+            index = (0,) * (data.ndim - 2)
+            data = data[index]
+            mask = mask[index] if mask is not None else None
+        if mask is None and self._no_data_value is not None:
+            mask = data == self._no_data_value
+        height, width = data.shape
+        # The clipped copy is modified in place, floating point tiles keep their dtype
+        array = np.clip(data, value_min, value_max)
+
+        uniform_tiles = get_uniform_tiles()
+        is_empty = _is_empty_tile(array, mask)
+        if is_empty or _is_constant_tile(array, mask):
+            # Color-map a single pixel only, the rest of the tile looks the same
+            rgba = apply_cmap_lut(array[0:1, 0:1], value_min, value_max, self._cmap_lut,
+                                  mask=mask[0:1, 0:1] if mask is not None else None)
+            rgba = tuple(int(c) for c in rgba[0, 0])
+            return uniform_tiles.get_tile((width, height), self.mode, rgba,
+                                          self._encoding if self._encode else None,
+                                          is_empty=is_empty)
+        uniform_tiles.notify_computed()
+
+        indexes = get_cmap_lut_indexes(array, value_min, value_max, self._cmap_lut, mask=mask)
+        image = None
+        if self._cmap_palette is not None:
+            image = new_cmap_palette_image(indexes, *self._cmap_palette)
+        if image is None:
+            image = Image.fromarray(get_cmap_lut_colors(indexes, self._cmap_lut), mode=self.mode)
+
+        if self._encode and self._encoding is not None:
+            return self._encoding.encode(image, tile_id=self.get_tile_id(tile_x, tile_y), tile_cache=self._tile_cache)
         else:
             return image
 
@@ -476,6 +556,104 @@ class ColorMappedRgbaImage(DecoratorImage):
         return ImagePyramid.create_from_image(self, create_pil_downsampling_image, **kwargs)
 
 
+class UniformTiles:
+    """
+    Provides shared tiles that have the same color everywhere, e.g. the transparent tiles served for
+    fully masked source tiles. Tiles are created once per tile size, mode, color, and format and are
+    then reused, so encoded tiles are returned as the very same bytes object.
+    Images that are not encoded are shared too, so callers must not modify them.
+
+    :param capacity: maximum number of distinct tiles kept
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self._tiles = LruObjectCache(capacity, name='uniform_tiles')
+        self._lock = threading.Lock()
+        self._num_empty = 0
+        self._num_solid = 0
+        self._num_computed = 0
+
+    @property
+    def num_empty(self) -> int:
+        """ Number of requested tiles whose source tile was fully masked. """
+        return self._num_empty
+
+    @property
+    def num_solid(self) -> int:
+        """ Number of requested tiles whose source tile was constant-valued. """
+        return self._num_solid
+
+    @property
+    def num_computed(self) -> int:
+        """ Number of tiles that had to be color-mapped pixel by pixel. """
+        return self._num_computed
+
+    def notify_computed(self):
+        with self._lock:
+            self._num_computed += 1
+
+    def get_tile(self,
+                 size: Size2D,
+                 mode: str,
+                 color: Tuple[int, ...],
+                 format: Union[str, TileEncoding] = None,
+                 is_empty: bool = False) -> Tile:
+        """
+        Get a shared uniform tile.
+
+        :param size: tile size
+        :param mode: PIL image mode
+        :param color: the color of all pixels
+        :param format: if given, the tile is returned as image bytes encoded in this format, e.g. "PNG",
+               or using this tile encoding
+        :param is_empty: whether the tile is served for a fully masked source tile, used for counting only
+        :return: a PIL image or encoded image bytes
+        """
+        with self._lock:
+            if is_empty:
+                self._num_empty += 1
+            else:
+                self._num_solid += 1
+        key = (tuple(size), mode, tuple(color), format)
+        return self._tiles.get_or_create(key, lambda: _new_uniform_tile(size, mode, color, format))
+
+    def clear(self):
+        self._tiles.clear(dispose=False)
+        with self._lock:
+            self._num_empty = 0
+            self._num_solid = 0
+            self._num_computed = 0
+
+
+def _new_uniform_tile(size: Size2D, mode: str, color: Tuple[int, ...],
+                      format: Union[str, TileEncoding] = None) -> Tile:
+    image = Image.new(mode, tuple(size), color)
+    if format:
+        encoding = TileEncoding(format) if isinstance(format, str) else format
+        return encoding.encode(image)
+    return image
+
+
+def _get_mask(array: np.ndarray) -> Optional[np.ndarray]:
+    mask = np.ma.getmask(array)
+    return mask if mask is not np.ma.nomask else None
+
+
+def _is_empty_tile(array: np.ndarray, mask: Optional[np.ndarray]) -> bool:
+    if mask is not None and mask.all():
+        return True
+    # Check the first value before computing a mask for all of them
+    return array.dtype.kind == 'f' and array.size > 0 and bool(np.isnan(array.flat[0])) \
+        and bool(np.isnan(array).all())
+
+
+def _is_constant_tile(array: np.ndarray, mask: Optional[np.ndarray]) -> bool:
+    if mask is not None and mask.any():
+        return False
+    # NaN never compares equal, so tiles with NaNs are never constant
+    return array.size > 0 and bool((array == array.flat[0]).all())
+
+
 class DownsamplingImage(OpImage):
     """
     Abstract base class for images that downsample a tiled source image.
@@ -673,7 +851,8 @@ class FastNdarrayDownsamplingImage(OpImage):
             tile.load()
 
         # We do the resampling to lower resolution after loading the data, which is MUCH faster, see note above.
-        tile = tile[..., ::s, ::s]
+        # The tile is a view of the loaded data, it is copied by the images using it.
+        tile = np.asarray(tile[..., ::s, ::s])
 
         # ensure that our tile size is w x h: resize and fill in background value.
         return self.pad_tile(tile, self.tile_size)
@@ -681,18 +860,17 @@ class FastNdarrayDownsamplingImage(OpImage):
     @staticmethod
     def pad_tile(tile: Tile, target_tile_size: Size2D, fill_value: float = np.nan) -> Tile:
         (target_width, target_height) = target_tile_size
-        tile_width, tile_heigth = tile.shape[-1], tile.shape[-2]
-        if target_width > tile_width:
-            # expand in width
-            h_pad = np.empty((tile_heigth, target_width - tile_width))
-            h_pad.fill(fill_value)
-            tile = np.hstack((tile, h_pad))
-        if target_height > tile_heigth:
-            # expand in height
-            v_pad = np.empty((target_height - tile_heigth, target_width))
-            v_pad.fill(fill_value)
-            tile = np.vstack((tile, v_pad))
-        return tile
+        tile_width, tile_height = tile.shape[-1], tile.shape[-2]
+        if target_width <= tile_width and target_height <= tile_height:
+            return tile
+        # Floating point tiles keep their dtype, all others are promoted to float64 for the NaN fill value
+        dtype = tile.dtype if tile.dtype.kind == 'f' else np.float64
+        target_tile = np.empty(tile.shape[:-2] + (max(target_height, tile_height), max(target_width, tile_width)),
+                               dtype=dtype)
+        target_tile[..., :tile_height, :tile_width] = tile
+        target_tile[..., :tile_height, tile_width:] = fill_value
+        target_tile[..., tile_height:, :] = fill_value
+        return target_tile
 
 
 LC_STANDARD_NAMES = {'land_cover_lccs algorithmic_confidence', 'land_cover_lccs status_flag', 'land_cover_lccs',
@@ -0,0 +1,362 @@
+# The MIT License (MIT)
+# Copyright (c) 2018 by the xcube development team and contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import collections
+import io
+import threading
+import time
+from typing import Optional
+
+from PIL import Image
+
+__author__ = "Norman Fomferra (Brockmann Consult GmbH)"
+
+#: Maps tile file name extensions to PIL image format names
+TILE_FORMAT_NAMES = dict(png='PNG', webp='WEBP', jpg='JPEG', jpeg='JPEG')
+
+#: Maps PIL image format names to MIME types
+TILE_MIME_TYPES = dict(PNG='image/png', WEBP='image/webp', JPEG='image/jpeg')
+
+_ADAPTIVE_ENCODER = None
+_ADAPTIVE_ENCODER_LOCK = threading.Lock()
+
+
+def get_adaptive_encoder() -> 'AdaptiveEncoder':
+    """
+    :return: The adaptive encoder shared by all instances of :py:class:`AdaptiveTileEncoding`.
+             Its re-encoding thread is started by the first :py:class:`AdaptiveTileEncoding` using it.
+    """
+    global _ADAPTIVE_ENCODER
+    with _ADAPTIVE_ENCODER_LOCK:
+        if _ADAPTIVE_ENCODER is None:
+            _ADAPTIVE_ENCODER = AdaptiveEncoder()
+        return _ADAPTIVE_ENCODER
+
+
+class TileEncoding:
+    """
+    Describes how tile images are encoded as image bytes.
+    Instances are immutable and can be used as cache keys.
+
+    JPEG has no transparency, so transparent pixels become black. It should be used for opaque layers only.
+
+    :param format: PIL image format name, e.g. "PNG", "WEBP", "JPEG"
+    :param options: PIL encoder options, e.g. ``compress_level`` for PNG, ``lossless``, ``quality``,
+           and ``method`` for WebP, or ``quality`` for JPEG
+    """
+
+    def __init__(self, format: str = 'PNG', **options):
+        self._format = format
+        self._options = dict(options)
+        self._id = '-'.join([format.lower()] + [f'{k}={v}' for k, v in sorted(self._options.items())])
+
+    @classmethod
+    def from_extension(cls, extension: str, **options) -> Optional['TileEncoding']:
+        """
+        Create a tile encoding from a tile file name extension such as "png", "webp", or "jpg".
+
+        :param extension: the file name extension without the leading dot
+        :param options: PIL encoder options
+        :return: the tile encoding or None, if the extension is not supported
+        """
+        format = TILE_FORMAT_NAMES.get(extension.lower())
+        return cls(format, **options) if format else None
+
+    @property
+    def format(self) -> str:
+        """ The PIL image format name. """
+        return self._format
+
+    @property
+    def options(self) -> dict:
+        """ A copy of the PIL encoder options. """
+        return dict(self._options)
+
+    @property
+    def mime_type(self) -> Optional[str]:
+        """ The MIME type of encoded tiles, if known. """
+        return TILE_MIME_TYPES.get(self._format)
+
+    @property
+    def id(self) -> str:
+        """ A string identifying the format and the encoder options. """
+        return self._id
+
+    @property
+    def deterministic(self) -> bool:
+        """ Whether the same image is always encoded as the same bytes. """
+        return True
+
+    # noinspection PyUnusedLocal
+    def encode(self, image: Image.Image, tile_id: str = None, tile_cache=None) -> bytes:
+        """
+        Encode a tile image.
+
+        :param image: a PIL image
+        :param tile_id: optional identifier of the tile, used by encodings that re-encode tiles later
+        :param tile_cache: optional cache the tile will be put into, used by encodings that re-encode tiles later
+        :return: the encoded image bytes
+        """
+        return self._encode(image, self._options)
+
+    def _encode(self, image: Image.Image, options: dict) -> bytes:
+        if self._format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        ostream = io.BytesIO()
+        image.save(ostream, format=self._format, **options)
+        encoded_image = ostream.getvalue()
+        ostream.close()
+        return encoded_image
+
+    def __eq__(self, other):
+        return isinstance(other, TileEncoding) and self._id == other._id
+
+    def __hash__(self):
+        return hash(self._id)
+
+    def __repr__(self):
+        return f'TileEncoding({self._id!r})'
+
+
+class AdaptiveTileEncoding(TileEncoding):
+    """
+    A tile encoding that uses cheap encoder options while the server is busy, and strong ones otherwise.
+    Tiles encoded cheaply are re-encoded with the strong options later, when the server is idle, and replace
+    the tiles in their tile cache. The same image may therefore be encoded as different bytes.
+
+    :param format: PIL image format name, e.g. "PNG"
+    :param fast_options: PIL encoder options used while the server is busy, e.g. ``dict(compress_level=1)``
+    :param encoder: the adaptive encoder, defaults to :py:func:`get_adaptive_encoder`
+    :param options: PIL encoder options used otherwise, e.g. ``compress_level=9``
+    """
+
+    def __init__(self, format: str = 'PNG', fast_options: dict = None, encoder: 'AdaptiveEncoder' = None,
+                 **options):
+        super().__init__(format, **options)
+        self._fast_options = dict(fast_options or {})
+        self._encoder = encoder
+        self._id += '-adaptive-' + '-'.join(f'{k}={v}' for k, v in sorted(self._fast_options.items()))
+
+    @property
+    def fast_options(self) -> dict:
+        """ A copy of the PIL encoder options used while the server is busy. """
+        return dict(self._fast_options)
+
+    @property
+    def deterministic(self) -> bool:
+        return False
+
+    @property
+    def encoder(self) -> 'AdaptiveEncoder':
+        if self._encoder is not None:
+            return self._encoder
+        encoder = get_adaptive_encoder()
+        encoder.start()
+        return encoder
+
+    def encode(self, image: Image.Image, tile_id: str = None, tile_cache=None) -> bytes:
+        encoder = self.encoder
+        # Tiles that cannot be replaced later are always encoded with the strong options
+        fast = tile_id is not None and tile_cache is not None and encoder.is_busy
+        t0 = time.perf_counter()
+        encoded_image = self._encode(image, self._fast_options if fast else self._options)
+        encoder.notify_encoded(time.perf_counter() - t0, fast)
+        if fast:
+            encoder.defer(self, image, tile_id, tile_cache)
+        return encoded_image
+
+    def encode_strong(self, image: Image.Image) -> bytes:
+        """ Encode *image* with the strong encoder options. """
+        return self._encode(image, self._options)
+
+
+class AdaptiveEncoder:
+    """
+    Watches the server load and re-encodes tiles that have been encoded cheaply by
+    :py:class:`AdaptiveTileEncoding` once the server is idle.
+
+    The load is given by the number of pending tile requests, i.e. requests waiting for or running in the
+    executor, and the recent encoding time. The server is busy, if encoding all pending requests is estimated
+    to take longer than *max_backlog*.
+
+    :param max_backlog: maximum estimated encoding time in seconds of the pending tile requests
+    :param capacity: maximum size in bytes of the tile images waiting to be re-encoded, more tiles are dropped
+    :param latency_weight: weight of the last encoding time in the moving average of encoding times
+    """
+
+    def __init__(self, max_backlog: float = 0.25, capacity: int = 64 * 1024 * 1024, latency_weight: float = 0.2):
+        self._max_backlog = max_backlog
+        self._capacity = capacity
+        self._size = 0
+        self._latency_weight = latency_weight
+        self._condition = threading.Condition()
+        self._deferred = collections.OrderedDict()
+        self._thread = None
+        self._num_pending = 0
+        self._encode_latency = 0.0
+        self._num_fast = 0
+        self._num_strong = 0
+        self._num_reencoded = 0
+        self._num_dropped = 0
+
+    @property
+    def num_pending(self) -> int:
+        """ Number of pending tile requests. """
+        return self._num_pending
+
+    @property
+    def encode_latency(self) -> float:
+        """ Moving average of the time in seconds taken to encode a tile. """
+        return self._encode_latency
+
+    @property
+    def num_deferred(self) -> int:
+        """ Number of tiles waiting to be re-encoded. """
+        return len(self._deferred)
+
+    @property
+    def num_fast(self) -> int:
+        """ Number of tiles encoded with the fast encoder options. """
+        return self._num_fast
+
+    @property
+    def num_strong(self) -> int:
+        """ Number of tiles encoded with the strong encoder options, not counting re-encoded tiles. """
+        return self._num_strong
+
+    @property
+    def num_reencoded(self) -> int:
+        """ Number of tiles re-encoded and replaced in their cache. """
+        return self._num_reencoded
+
+    @property
+    def num_dropped(self) -> int:
+        """ Number of cheaply encoded tiles not re-encoded, because too many tiles were waiting. """
+        return self._num_dropped
+
+    @property
+    def is_busy(self) -> bool:
+        """ Whether tiles should be encoded cheaply now. """
+        return self._num_pending * self._encode_latency > self._max_backlog
+
+    @property
+    def is_idle(self) -> bool:
+        """ Whether there are no pending tile requests. """
+        return self._num_pending == 0
+
+    def begin_request(self):
+        """ Notify a new pending tile request. """
+        with self._condition:
+            self._num_pending += 1
+
+    def end_request(self):
+        """ Notify that a pending tile request has been finished. """
+        with self._condition:
+            self._num_pending -= 1
+            self._condition.notify_all()
+
+    def notify_encoded(self, duration: float, fast: bool):
+        """
+        Notify that a tile has been encoded.
+
+        :param duration: time in seconds taken to encode the tile
+        :param fast: whether the fast encoder options have been used
+        """
+        with self._condition:
+            if self._num_fast + self._num_strong == 0:
+                self._encode_latency = duration
+            else:
+                self._encode_latency += self._latency_weight * (duration - self._encode_latency)
+            if fast:
+                self._num_fast += 1
+            else:
+                self._num_strong += 1
+
+    def defer(self, encoding: AdaptiveTileEncoding, image: Image.Image, tile_id: str, tile_cache):
+        """
+        Remember a cheaply encoded tile for being re-encoded later.
+
+        :param encoding: the tile's encoding
+        :param image: the tile image
+        :param tile_id: the tile identifier
+        :param tile_cache: the cache the tile has been put into
+        """
+        size = image.width * image.height * len(image.getbands())
+        with self._condition:
+            old_item = self._deferred.pop(tile_id, None)
+            if old_item is not None:
+                self._size -= old_item[3]
+            while self._deferred and self._size + size > self._capacity:
+                # Keep the most recent tiles, they are more likely to be requested again
+                _, old_item = self._deferred.popitem(last=False)
+                self._size -= old_item[3]
+                self._num_dropped += 1
+            self._deferred[tile_id] = encoding, image, tile_cache, size
+            self._size += size
+            self._condition.notify_all()
+
+    def reencode_deferred(self, max_count: int = None) -> int:
+        """
+        Re-encode deferred tiles with the strong encoder options, as long as the server is idle,
+        and replace them in their tile cache. Tiles no longer in their cache are skipped.
+
+        :param max_count: maximum number of tiles to re-encode
+        :return: the number of tiles replaced in their cache
+        """
+        count = 0
+        while max_count is None or count < max_count:
+            with self._condition:
+                if not self._deferred or not self.is_idle:
+                    break
+                tile_id, (encoding, image, tile_cache, size) = self._deferred.popitem(last=False)
+                self._size -= size
+            # Don't encode tiles already evicted, replace_value() skips tiles evicted while encoding
+            if not tile_cache.has_value(tile_id) \
+                    or not tile_cache.replace_value(tile_id, encoding.encode_strong(image)):
+                continue
+            with self._condition:
+                self._num_reencoded += 1
+            count += 1
+        return count
+
+    def start(self):
+        """ Start the daemon thread that re-encodes deferred tiles. """
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='adaptive-encoder', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._deferred and self.is_idle)
+            self.reencode_deferred(max_count=1)
+
+    def clear(self):
+        """ Forget deferred tiles and reset the counters. """
+        with self._condition:
+            self._deferred.clear()
+            self._size = 0
+            self._encode_latency = 0.0
+            self._num_fast = 0
+            self._num_strong = 0
+            self._num_reencoded = 0
+            self._num_dropped = 0
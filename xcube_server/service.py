@@ -106,6 +106,7 @@ class Service:
                                       config=config,
                                       base_dir=os.path.dirname(self.config_file or os.path.abspath('')))
         self._maybe_load_config()
+        self.context.read_tile_cache_snapshots()
 
         application.service_context = self.context
         application.time_of_last_activity = time.clock()
@@ -151,6 +152,18 @@ class Service:
             self.server.stop()
             self.server = None
 
+        # noinspection PyBroadException
+        try:
+            self.context.write_tile_cache_snapshots()
+        except Exception as e:
+            _LOG.error(f'failed to write tile cache snapshots: {e}')
+
+        # noinspection PyBroadException
+        try:
+            self.context.close_tile_caches()
+        except Exception as e:
+            _LOG.error(f'failed to close tile caches: {e}')
+
         IOLoop.current().stop()
 
     # noinspection PyUnusedLocal
@@ -216,6 +229,29 @@ class ServiceRequestHandler(RequestHandler):
         self.set_header("Access-Control-Allow-Headers", "x-requested-with")
         self.set_header('Access-Control-Allow-Methods', 'PUT, DELETE, OPTIONS')
 
+    def set_caching_headers(self, etag: Optional[str], max_age: int, immutable: bool = False) -> bool:
+        """
+        Set the "ETag" and "Cache-Control" headers of a response whose body is computed afterwards.
+        If the request's "If-None-Match" header matches *etag*, the response status is set to 304 (Not Modified)
+        and the caller should finish the request without computing the body.
+
+        :param etag: the response body's quoted entity tag, or None if unknown
+        :param max_age: the time in seconds clients may use the response without revalidating it
+        :param immutable: whether the response for the requested URL will never change
+        :return: True, if the client's copy of the response body is still valid
+        """
+        if immutable:
+            self.set_header('Cache-Control', f'public, max-age={max_age}, immutable')
+        else:
+            self.set_header('Cache-Control', f'max-age={max_age}' if max_age > 0 else 'no-cache')
+        if etag is None:
+            return False
+        self.set_header('ETag', etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return True
+        return False
+
     def get_body_as_json_object(self, name="JSON object"):
         """ Get the body argument as JSON object. """
         try: